@@ -0,0 +1,145 @@
+"""
+Benchmark: lettura di un elenco di documenti con i modelli SDK o come JSON grezzo.
+
+Confronta, su un elenco sintetico di 5.000 fatture dettagliate, il percorso
+dell'SDK (deserializzazione nei modelli pydantic + to_plain) con il percorso
+usato da iter_rows quando FIC_RAW_LISTINGS è attivo (parse_raw_page).
+Non effettua chiamate di rete.
+
+Uso:
+    python benchmarks/listings.py [numero_documenti] [ripetizioni]
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+def make_document(i):
+    """Fattura dettagliata con la stessa forma restituita da list_issued_documents"""
+    client_id = i % 400 + 1
+    net = round(100 + (i % 37) * 12.5, 2)
+    vat = round(net * 0.22, 2)
+    return {
+        "id": i,
+        "type": "invoice",
+        "number": i,
+        "numeration": "",
+        "date": f"2025-{i % 12 + 1:02d}-{i % 28 + 1:02d}",
+        "year": 2025,
+        "currency": {"id": "EUR", "exchange_rate": "1.00000", "symbol": "€"},
+        "language": {"code": "it", "name": "Italiano"},
+        "subject": f"Servizio {i}",
+        "visible_subject": f"Canone {i}",
+        "entity": {
+            "id": client_id,
+            "name": f"Cliente {client_id} S.R.L.",
+            "vat_number": f"IT{client_id:011d}",
+            "tax_code": f"{client_id:011d}",
+            "address_street": "Via Roma 1",
+            "address_postal_code": "00100",
+            "address_city": "Roma",
+            "address_province": "RM",
+            "country": "Italia",
+            "ei_code": "0000000",
+        },
+        "amount_net": net,
+        "amount_vat": vat,
+        "amount_gross": round(net + vat, 2),
+        "items_list": [
+            {
+                "product_id": None,
+                "code": f"SRV{n}",
+                "name": f"Servizio {n}",
+                "description": f"Consulenza {i}/{n}",
+                "qty": 1,
+                "net_price": round(net / 2, 2),
+                "gross_price": round((net + vat) / 2, 2),
+                "discount": 0,
+                "vat": {"id": 0, "value": 22, "description": "Non imponibile"},
+                "not_taxable": False,
+            }
+            for n in range(2)
+        ],
+        "payments_list": [
+            {
+                "id": i * 10,
+                "amount": round(net + vat, 2),
+                "due_date": f"2025-{i % 12 + 1:02d}-28",
+                "paid_date": None if i % 3 else f"2025-{i % 12 + 1:02d}-28",
+                "status": "not_paid" if i % 3 else "paid",
+                "payment_account": {"id": 1, "name": "Banca"} if i % 3 == 0 else None,
+            }
+        ],
+        "e_invoice": True,
+        "ei_status": "accepted",
+        "created_at": "2025-01-01 10:00:00",
+        "updated_at": "2025-01-02 10:00:00",
+    }
+
+
+def make_page(count):
+    return json.dumps({
+        "current_page": 1,
+        "last_page": 1,
+        "per_page": count,
+        "total": count,
+        "data": [make_document(i) for i in range(1, count + 1)],
+    }).encode()
+
+
+def sdk_path(body):
+    response = server.api_client.deserialize(body.decode("utf-8"), "ListIssuedDocumentsResponse", "application/json")
+    return [server.to_plain(d) for d in response.data]
+
+
+def raw_path(body):
+    return server.parse_raw_page(body).get("data") or []
+
+
+def common_fields_equal(sdk_value, raw_value):
+    """Confronta due record sui soli campi presenti in entrambi, anche annidati"""
+    if isinstance(sdk_value, dict) and isinstance(raw_value, dict):
+        return all(common_fields_equal(v, raw_value[k]) for k, v in sdk_value.items() if k in raw_value)
+    if isinstance(sdk_value, list) and isinstance(raw_value, list):
+        return len(sdk_value) == len(raw_value) and all(map(common_fields_equal, sdk_value, raw_value))
+    return sdk_value == raw_value
+
+
+def best_of(func, body, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = func(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rows
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    body = make_page(count)
+
+    sdk_time, sdk_rows = best_of(sdk_path, body, repeat)
+    raw_time, raw_rows = best_of(raw_path, body, repeat)
+    # to_dict() scarta i campi read-only (amount_net, amount_gross, ...) e
+    # aggiunge i default del modello: si confrontano solo i campi comuni
+    for sdk_row, raw_row in zip(sdk_rows, raw_rows):
+        if not common_fields_equal(sdk_row, raw_row):
+            sys.exit(f"Il documento {raw_row.get('id')} differisce tra i due percorsi")
+    if len(sdk_rows) != len(raw_rows):
+        sys.exit("I due percorsi restituiscono un numero diverso di documenti")
+
+    print(f"{count} documenti, {len(body) / 1024 / 1024:.1f} MB di JSON, migliore di {repeat}")
+    print(f"  modelli SDK + to_plain: {sdk_time * 1000:8.1f} ms")
+    print(f"  JSON grezzo:            {raw_time * 1000:8.1f} ms  ({sdk_time / raw_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -18,10 +18,28 @@ License: MIT
 
 """
 
+import asyncio
+import base64
+import calendar
+import collections
+import contextvars
+import functools
+import heapq
+import itertools
 import json
+import math
 import os
+import random
+import re
+import secrets
+import socket
+import sqlite3
+import time
 import traceback
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 
 import fattureincloud_python_sdk as fic
 from fattureincloud_python_sdk.api.issued_documents_api import IssuedDocumentsApi
@@ -31,50 +49,1843 @@ from fattureincloud_python_sdk.api.clients_api import ClientsApi
 from fattureincloud_python_sdk.api.companies_api import CompaniesApi
 from fattureincloud_python_sdk.api.settings_api import SettingsApi
 from fattureincloud_python_sdk.api.cashbook_api import CashbookApi
+from fattureincloud_python_sdk.api.info_api import InfoApi
+from fattureincloud_python_sdk.exceptions import ApiException
+
+from urllib3.connection import HTTPConnection
 
 from mcp.server import Server
 from mcp.server.stdio import stdio_server
 from mcp.types import Tool, TextContent
 
+def env_flag(name, default):
+    """Legge una variabile d'ambiente booleana (0/false/no/off = disattivata)"""
+    return os.getenv(name, default).strip().lower() not in ("0", "false", "no", "off")
+
+
 # Configurazione da variabili d'ambiente
 ACCESS_TOKEN = os.getenv("FIC_ACCESS_TOKEN", "")
 COMPANY_ID = int(os.getenv("FIC_COMPANY_ID", "0"))
+# Altre aziende servite dallo stesso processo: file JSON [{"company_id": ..., "name": ..., "access_token": ...}]
+COMPANIES_FILE = os.getenv("FIC_COMPANIES_FILE", "")
 SENDER_EMAIL = os.getenv("FIC_SENDER_EMAIL", "")
+# Numero massimo di chiamate API eseguite in parallelo
+MAX_CONCURRENCY = max(1, int(os.getenv("FIC_MAX_CONCURRENCY", "8")))
+# Limite di richieste lato client (token bucket): richieste al secondo e raffica massima (0 = nessun limite)
+RATE_LIMIT = float(os.getenv("FIC_RATE_LIMIT", "1"))
+RATE_BURST = max(1, int(os.getenv("FIC_RATE_BURST", "30")))
+# Tentativi aggiuntivi dopo un 429 (o un 5xx su chiamate di sola lettura)
+MAX_RETRIES = max(0, int(os.getenv("FIC_MAX_RETRIES", "4")))
+# Secondi per cui il risultato di una lettura resta condiviso con le letture identiche successive (0 = solo quelle contemporanee)
+COALESCE_TTL = max(0.0, float(os.getenv("FIC_COALESCE_TTL", "2")))
+# Numero massimo di pagine di un elenco scaricate in parallelo
+PAGE_CONCURRENCY = max(1, int(os.getenv("FIC_PAGE_CONCURRENCY", "4")))
+# Dimensione pagina massima consentita dall'API
+PER_PAGE = 100
+# Elenchi letti come JSON grezzo (metodi *_without_preload_content) invece che come modelli SDK
+RAW_LISTINGS = env_flag("FIC_RAW_LISTINGS", "1")
+# Archivio locale SQLite (mirror) di documenti e clienti
+LOCAL_STORE = env_flag("FIC_LOCAL_STORE", "1")
+DB_PATH = os.getenv("FIC_DB_PATH", os.path.join("~", ".fattureincloud-mcp", "mirror.sqlite3"))
+# Secondi entro cui il mirror è considerato aggiornato senza interrogare l'API
+SYNC_INTERVAL = float(os.getenv("FIC_SYNC_INTERVAL", "30"))
+# Ogni quante ore confrontare gli ID remoti con il mirror (intercetta i documenti eliminati)
+FULL_SYNC_INTERVAL = float(os.getenv("FIC_FULL_SYNC_HOURS", "24")) * 3600
+# Record per transazione quando il mirror salva un allineamento, e per lettura dal mirror
+STORE_BATCH = 500
+# Cache anagrafiche clienti: durata (secondi) e numero massimo di voci
+CLIENT_CACHE_TTL = float(os.getenv("FIC_CLIENT_CACHE_TTL", "300"))
+CLIENT_CACHE_SIZE = max(1, int(os.getenv("FIC_CLIENT_CACHE_SIZE", "1000")))
+# Cache dei documenti emessi letti in dettaglio: durata massima (secondi) e numero di voci
+DOCUMENT_CACHE_TTL = float(os.getenv("FIC_DOCUMENT_CACHE_TTL", "3600"))
+DOCUMENT_CACHE_SIZE = max(1, int(os.getenv("FIC_DOCUMENT_CACHE_SIZE", "200")))
+# Durata (secondi) della cache di metodi di pagamento, conti e aliquote IVA
+SETTINGS_CACHE_TTL = float(os.getenv("FIC_SETTINGS_CACHE_TTL", "3600"))
+# Numero massimo di invii allo SDI in parallelo negli invii in blocco
+SDI_CONCURRENCY = max(1, int(os.getenv("FIC_SDI_CONCURRENCY", "2")))
+# Numero massimo di aziende elaborate in parallelo da get_portfolio_report
+PORTFOLIO_CONCURRENCY = max(1, int(os.getenv("FIC_PORTFOLIO_CONCURRENCY", "4")))
+
+# Stati e-invoice: descrizioni, stati da cui si può (re)inviare, stati finali (esito SDI definitivo)
+EI_STATUS_DESCRIPTIONS = {
+    None: "Bozza (non inviata)",
+    "not_sent": "Bozza (non inviata)",
+    "attempt": "Invio in corso",
+    "pending": "In attesa di invio",
+    "sent": "Inviata, in attesa di risposta SDI",
+    "processing": "In consegna al destinatario",
+    "delivered": "Consegnata al destinatario",
+    "accepted": "Accettata",
+    "rejected": "Rifiutata",
+    "discarded": "Scartata dallo SDI",
+    "error": "Errore durante l'invio",
+    "not_delivered": "Non consegnata (messa a disposizione)",
+    "no_response": "Nessuna risposta entro i termini",
+    "manual_accepted": "Accettata (manualmente)",
+    "manual_rejected": "Rifiutata (manualmente)"
+}
+EI_SENDABLE_STATUSES = ["null", "rejected", None, "not_sent"]
+EI_FINAL_STATUSES = ["delivered", "accepted", "rejected", "discarded", "error", "not_delivered",
+                     "no_response", "manual_accepted", "manual_rejected"]
+EI_REJECTED_STATUSES = ["rejected", "discarded", "error", "manual_rejected"]
+
+# Proiezioni: campi chiesti all'API dai tool che non usano righe e pagamenti
+# (fieldset="detailed" resta solo dove servono items_list o payments_list)
+INVOICE_LIST_FIELDS = "id,number,numeration,date,entity,subject,visible_subject,amount_net,amount_vat,amount_gross"
+RECEIVED_LIST_FIELDS = "id,type,invoice_number,date,entity,description,amount_net,amount_vat,amount_gross"
+CLIENT_LIST_FIELDS = "id,name,vat_number,tax_code,email"
+NUMERATION_FIELDS = "id,number,numeration,date"
+DOCUMENT_STATUS_FIELDS = "id,number,numeration,date,entity,ei_status"
+ISSUED_PAYMENT_FIELDS = "id,type,number,date,entity,payments_list"
+RECEIVED_PAYMENT_FIELDS = "id,type,invoice_number,date,entity,payments_list"
+PORTFOLIO_ISSUED_FIELDS = "id,number,numeration,date,entity,amount_gross,payments_list,ei_status"
+PORTFOLIO_RECEIVED_FIELDS = "id,date,amount_net,amount_gross"
+# Ordinamento chiesto all'API negli elenchi: lo stesso del mirror locale, così le
+# pagine lette in parallelo e i due percorsi restituiscono le righe nello stesso ordine
+DOCUMENT_SORT = "date,id"
+CLIENT_SORT = "name,id"
+# Campi in cui cerca l'argomento query degli elenchi (filtro q dell'API o mirror locale)
+INVOICE_SEARCH_FIELDS = ("entity.name", "subject", "visible_subject")
+RECEIVED_SEARCH_FIELDS = ("entity.name", "description")
+CLIENT_SEARCH_FIELDS = ("name", "vat_number", "tax_code")
+LIST_SEARCH_FIELDS = {
+    "issued": INVOICE_SEARCH_FIELDS,
+    "received": RECEIVED_SEARCH_FIELDS,
+    "clients": CLIENT_SEARCH_FIELDS,
+}
+# Ricerca fuzzy: quota minima dei trigrammi di ogni parola cercata che il record deve contenere
+SEARCH_MIN_SCORE = min(1.0, max(0.0, float(os.getenv("FIC_SEARCH_MIN_SCORE", "0.6"))))
+
+# Risposte dei tool: indentazione JSON (0 = compatto), righe per risposta negli elenchi
+OUTPUT_INDENT = max(0, int(os.getenv("FIC_OUTPUT_INDENT", "0")))
+MAX_ROWS = max(1, int(os.getenv("FIC_MAX_ROWS", "500")))
+# Secondi di validità dei cursori per leggere il resto di un elenco
+RESULT_CURSOR_TTL = float(os.getenv("FIC_RESULT_CURSOR_TTL", "900"))
+OUTPUT_FORMATS = ["json", "columns", "tsv"]
+
+# Connessioni HTTP: il pool segue la concorrenza del server, così le richieste
+# parallele riusano connessioni TLS già aperte invece di riaprirle
+POOL_MAXSIZE = max(1, int(os.getenv("FIC_POOL_MAXSIZE", str(MAX_CONCURRENCY))))
+TCP_KEEPALIVE = env_flag("FIC_TCP_KEEPALIVE", "1")
+HTTP_COMPRESSION = env_flag("FIC_HTTP_COMPRESSION", "1")
+# Timeout di connessione e lettura in secondi (0 = nessun timeout)
+CONNECT_TIMEOUT = float(os.getenv("FIC_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("FIC_READ_TIMEOUT", "60"))
+REQUEST_TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT) if CONNECT_TIMEOUT > 0 and READ_TIMEOUT > 0 else None
+
 
-configuration = fic.Configuration()
-configuration.access_token = ACCESS_TOKEN
-api_client = fic.ApiClient(configuration)
+def new_api_client(access_token):
+    """ApiClient con il proprio pool di connessioni, configurato secondo le variabili FIC_*"""
+    configuration = fic.Configuration()
+    configuration.access_token = access_token
+    configuration.connection_pool_maxsize = POOL_MAXSIZE
+    if TCP_KEEPALIVE:
+        # Keep-alive TCP: evita che connessioni inattive nel pool vengano chiuse da NAT/proxy
+        socket_options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            socket_options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60), (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 30)]
+        configuration.socket_options = socket_options
+    api_client = fic.ApiClient(configuration)
+    if HTTP_COMPRESSION:
+        api_client.set_default_header("Accept-Encoding", "gzip, deflate")
+    return api_client
 
-issued_api = IssuedDocumentsApi(api_client)
-einvoice_api = IssuedEInvoicesApi(api_client)
-received_api = ReceivedDocumentsApi(api_client)
-clients_api = ClientsApi(api_client)
-companies_api = CompaniesApi(api_client)
-settings_api = SettingsApi(api_client)
-cashbook_api = CashbookApi(api_client)
+
+# L'SDK è sincrono: le chiamate girano in un pool di thread limitato
+# così una richiesta HTTP lenta non blocca l'event loop della sessione MCP.
+# Il pool è unico per tutte le aziende e fa da limite globale di concorrenza
+sdk_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="fic-sdk")
+# Il mirror SQLite lavora in un thread dedicato, che possiede la connessione:
+# salvataggi e indicizzazione non bloccano l'event loop e le operazioni
+# restano in ordine di invio
+store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fic-store")
 
 app = Server("fattureincloud")
 
 
+class TokenBucket:
+    """Limitatore a token bucket: rate richieste al secondo con raffiche fino a capacity.
+
+    Dopo un 429 block() sospende tutte le chiamate fino allo scadere del Retry-After,
+    così i worker paralleli non continuano a consumare la quota.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+def is_read_call(func):
+    """True per i metodi di sola lettura dell'SDK (get_*, list_*)"""
+    return getattr(func, "__name__", "").startswith(("get_", "list_"))
+
+
+def retry_delay(error, attempt, func):
+    """Secondi da attendere prima di ritentare una chiamata fallita, o None se non va ritentata.
+
+    Un 429 si ritenta sempre (la richiesta non è stata elaborata); i 5xx solo
+    per le chiamate di lettura, per non duplicare creazioni o invii.
+    """
+    if attempt >= MAX_RETRIES or not isinstance(error, ApiException):
+        return None
+    status = error.status or 0
+    if status != 429 and not (status in (500, 502, 503, 504) and is_read_call(func)):
+        return None
+
+    retry_after = (error.headers or {}).get("Retry-After")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now().astimezone()).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return min(60.0, 2 ** attempt) + random.uniform(0, 0.5)
+
+
+def read_key(func, args, kwargs):
+    """Chiave di una lettura: metodo (con l'istanza API) e parametri, o None se non hashabile"""
+    key = (func, args, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+async def run_sdk(func, /, *args, fresh=False, **kwargs):
+    """Esegue una chiamata dell'SDK nel pool di thread e ne attende il risultato.
+
+    Le letture (get_*, list_*) identiche per metodo e parametri vengono
+    unificate: se la stessa lettura è già in corso si attende quella, e il
+    risultato resta condiviso per COALESCE_TTL secondi. Il risultato è lo
+    stesso oggetto per tutti i chiamanti e non va modificato. Ogni scrittura
+    conclusa scarta le letture recenti e quelle in corso, così una lettura
+    successiva vede sempre la modifica. Con fresh=True la lettura parte
+    comunque (per i controlli di stato ripetuti nel tempo). Letture in corso
+    e scritture sono contate per azienda. Una modifica o eliminazione di un
+    cliente lo toglie anche da client_cache (vedi invalidate_client).
+    """
+    company = current_company()
+    if not is_read_call(func):
+        try:
+            return await call_sdk(func, *args, **kwargs)
+        finally:
+            company.write_generation += 1
+            company.inflight_reads.clear()
+            company.recent_reads.invalidate()
+            if getattr(func, "__name__", "").startswith(CLIENT_WRITE_CALLS) and "client_id" in kwargs:
+                invalidate_client(kwargs["client_id"], deleted=func.__name__.startswith("delete_"))
+    key = read_key(func, args, kwargs)
+    if key is None:
+        return await call_sdk(func, *args, **kwargs)
+    cached = company.recent_reads.get(key, company.recent_reads)
+    if cached is not company.recent_reads and not fresh:
+        return cached
+    future = company.inflight_reads.get(key)
+    if future is None or fresh:
+        future = asyncio.ensure_future(call_sdk(func, *args, **kwargs))
+        company.inflight_reads[key] = future
+        future.add_done_callback(functools.partial(finish_read, company, key, company.write_generation))
+    # shield: se un chiamante viene annullato la lettura prosegue per gli altri
+    return await asyncio.shield(future)
+
+
+def finish_read(company, key, generation, future):
+    """Toglie una lettura conclusa da quelle in corso e ne conserva il risultato
+    se nel frattempo non ci sono state scritture"""
+    if company.inflight_reads.get(key) is future:
+        del company.inflight_reads[key]
+    if future.cancelled() or future.exception() is not None:
+        return
+    if COALESCE_TTL and generation == company.write_generation:
+        company.recent_reads.set(key, future.result())
+
+
+async def call_sdk(func, /, *args, **kwargs):
+    """Esegue una chiamata sincrona dell'SDK nel pool di thread e ne attende il risultato.
+
+    Ogni tentativo passa dal rate_limiter dell'azienda corrente; 429 e 5xx
+    ritentabili vengono ripetuti con backoff esponenziale o secondo l'header
+    Retry-After.
+    """
+    loop = asyncio.get_running_loop()
+    rate_limiter = current_company().rate_limiter
+    if REQUEST_TIMEOUT:
+        kwargs.setdefault("_request_timeout", REQUEST_TIMEOUT)
+    call = functools.partial(func, *args, **kwargs)
+    attempt = 0
+    while True:
+        await rate_limiter.acquire()
+        try:
+            return await loop.run_in_executor(sdk_executor, call)
+        except ApiException as e:
+            delay = retry_delay(e, attempt, func)
+            if delay is None:
+                raise
+            if e.status == 429:
+                rate_limiter.block(delay)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+def drop_nulls(obj):
+    """object_hook per json.loads: scarta i campi null come fa to_dict() dei modelli SDK"""
+    return {k: v for k, v in obj.items() if v is not None}
+
+
+def parse_raw_page(body):
+    """Decodifica la risposta JSON di un elenco in dict semplici, senza costruire i modelli SDK"""
+    return json.loads(body, object_hook=drop_nulls)
+
+
+def call_raw(func, **kwargs):
+    """Chiama la variante _without_preload_content di un metodo dell'SDK e ne decodifica il JSON.
+
+    Gli errori HTTP sollevano le stesse ApiException della chiamata normale,
+    così run_sdk può ritentare 429 e 5xx allo stesso modo.
+    """
+    raw_func = getattr(func.__self__, f"{func.__name__}_without_preload_content")
+    response = raw_func(**kwargs)
+    body = response.data
+    if not 200 <= response.status <= 299:
+        raise ApiException.from_response(http_resp=response, body=body.decode("utf-8", "replace"), data=None)
+    return parse_raw_page(body)
+
+
+def list_raw_page(list_func, **kwargs):
+    """Una pagina di un metodo list_* come JSON grezzo (data, last_page, ...)"""
+    return call_raw(list_func, **kwargs)
+
+
+def get_raw_record(get_func, **kwargs):
+    """Il record (data) restituito da un metodo get_*, come JSON grezzo"""
+    return call_raw(get_func, **kwargs).get("data") or {}
+
+
+async def fetch_page(list_func, page, raw, per_page=PER_PAGE, **kwargs):
+    """Una pagina di un elenco come (record, last_page)"""
+    if raw:
+        response = await run_sdk(list_raw_page, list_func, page=page, per_page=per_page, **kwargs)
+        return response.get("data") or [], response.get("last_page") or 1
+    response = await run_sdk(list_func, page=page, per_page=per_page, **kwargs)
+    return response.data or [], getattr(response, 'last_page', 1) or 1
+
+
+async def iter_pages(list_func, raw=False, **kwargs):
+    """Scorre tutte le pagine di un elenco dell'API restituendo i record in ordine.
+
+    Legge last_page dalla prima pagina, poi scarica le successive in parallelo
+    (al massimo PAGE_CONCURRENCY alla volta) mantenendo l'ordine di pagina.
+    Con raw=True i record sono dict letti direttamente dal JSON invece di modelli SDK.
+    """
+    items, last_page = await fetch_page(list_func, 1, raw, **kwargs)
+    for item in items:
+        yield item
+
+    pending = collections.deque()
+    next_page = 2
+    try:
+        while next_page <= last_page or pending:
+            while next_page <= last_page and len(pending) < PAGE_CONCURRENCY:
+                pending.append(asyncio.ensure_future(fetch_page(list_func, next_page, raw, **kwargs)))
+                next_page += 1
+            items, _ = await pending.popleft()
+            for item in items:
+                yield item
+    finally:
+        # Se il chiamante interrompe l'iterazione, annulla le pagine ancora in volo
+        for task in pending:
+            task.cancel()
+
+
+async def iter_rows(list_func, **kwargs):
+    """Come iter_pages, ma restituisce sempre dict JSON semplici (vedi to_plain).
+
+    Con RAW_LISTINGS attivo il JSON viene decodificato direttamente, senza
+    passare dai modelli SDK e da to_dict(), che sui report annuali occupano
+    la maggior parte del tempo di CPU.
+    """
+    if RAW_LISTINGS:
+        async for row in iter_pages(list_func, raw=True, **kwargs):
+            yield row
+    else:
+        async for item in iter_pages(list_func, **kwargs):
+            yield to_plain(item)
+
+
+async def run_bounded(func, items, limit=MAX_CONCURRENCY):
+    """Esegue la coroutine func su ogni elemento, al massimo limit alla volta.
+
+    Restituisce i risultati nello stesso ordine degli elementi.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def worker(item):
+        async with semaphore:
+            return await func(item)
+
+    return await asyncio.gather(*(worker(item) for item in items))
+
+
+class TTLCache:
+    """Cache LRU con scadenza: le voci valgono ttl secondi, oltre maxsize si scarta la meno usata"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Rimuove una voce, o tutte se key è None"""
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+
+class Company:
+    """Un'azienda servita dal processo, con client API (e quindi pool di
+    connessioni), limitatore di richieste e cache propri"""
+
+    def __init__(self, company_id, access_token, name=None):
+        self.id = company_id
+        self.name = name
+        self.api_client = new_api_client(access_token)
+        self.issued_api = IssuedDocumentsApi(self.api_client)
+        self.einvoice_api = IssuedEInvoicesApi(self.api_client)
+        self.received_api = ReceivedDocumentsApi(self.api_client)
+        self.clients_api = ClientsApi(self.api_client)
+        self.companies_api = CompaniesApi(self.api_client)
+        self.settings_api = SettingsApi(self.api_client)
+        self.cashbook_api = CashbookApi(self.api_client)
+        self.info_api = InfoApi(self.api_client)
+        self.rate_limiter = TokenBucket(RATE_LIMIT, RATE_BURST)
+        self.client_cache = TTLCache(CLIENT_CACHE_SIZE, CLIENT_CACHE_TTL)
+        self.settings_cache = TTLCache(16, SETTINGS_CACHE_TTL)
+        self.document_cache = TTLCache(DOCUMENT_CACHE_SIZE, DOCUMENT_CACHE_TTL)
+        # Risultati delle letture appena concluse, condivisi dalle letture identiche (vedi run_sdk)
+        self.recent_reads = TTLCache(256, COALESCE_TTL)
+        # Letture in corso (chiave → future condiviso) e numero di scritture completate
+        self.inflight_reads = {}
+        self.write_generation = 0
+
+
+def load_companies():
+    """Registro delle aziende configurate: ID → (nome, token).
+
+    FIC_COMPANY_ID/FIC_ACCESS_TOKEN restano l'azienda di default; le voci di
+    FIC_COMPANIES_FILE senza access_token usano FIC_ACCESS_TOKEN.
+    """
+    registry = {COMPANY_ID: (None, ACCESS_TOKEN)} if COMPANY_ID else {}
+    if COMPANIES_FILE:
+        with open(os.path.expanduser(COMPANIES_FILE), encoding="utf-8") as f:
+            for entry in json.load(f):
+                registry[int(entry["company_id"])] = (entry.get("name"), entry.get("access_token") or ACCESS_TOKEN)
+    return registry or {COMPANY_ID: (None, ACCESS_TOKEN)}
+
+
+COMPANIES = load_companies()
+DEFAULT_COMPANY_ID = COMPANY_ID if COMPANY_ID in COMPANIES else next(iter(COMPANIES))
+# Aziende già usate: client e cache si creano solo alla prima tool call che le riguarda
+_companies = {}
+_current_company = contextvars.ContextVar("fic_company", default=None)
+
+
+def get_company(company_id=None):
+    """Stato dell'azienda indicata (default DEFAULT_COMPANY_ID); KeyError se non configurata"""
+    company_id = DEFAULT_COMPANY_ID if company_id is None else int(company_id)
+    company = _companies.get(company_id)
+    if company is None:
+        name, access_token = COMPANIES[company_id]
+        company = _companies[company_id] = Company(company_id, access_token, name)
+    return company
+
+
+def current_company():
+    """Azienda della tool call in corso (vedi call_tool), o quella di default"""
+    return _current_company.get() or get_company()
+
+
+class CompanyProxy:
+    """Inoltra l'accesso agli attributi all'oggetto omonimo dell'azienda corrente.
+
+    Così issued_api.get_issued_document(...) o client_cache.get(...) usano
+    sempre client e cache dell'azienda della tool call in corso.
+    """
+
+    def __init__(self, attribute):
+        self._attribute = attribute
+
+    def __getattr__(self, name):
+        return getattr(getattr(current_company(), self._attribute), name)
+
+
+api_client = CompanyProxy("api_client")
+issued_api = CompanyProxy("issued_api")
+einvoice_api = CompanyProxy("einvoice_api")
+received_api = CompanyProxy("received_api")
+clients_api = CompanyProxy("clients_api")
+companies_api = CompanyProxy("companies_api")
+settings_api = CompanyProxy("settings_api")
+cashbook_api = CompanyProxy("cashbook_api")
+info_api = CompanyProxy("info_api")
+client_cache = CompanyProxy("client_cache")
+settings_cache = CompanyProxy("settings_cache")
+document_cache = CompanyProxy("document_cache")
+# Righe non ancora restituite degli elenchi troppo lunghi, per cursore
+result_cursors = TTLCache(256, RESULT_CURSOR_TTL)
+
+
+def dump_json(data):
+    """JSON delle risposte: compatto, o indentato con FIC_OUTPUT_INDENT"""
+    if OUTPUT_INDENT:
+        return json.dumps(data, indent=OUTPUT_INDENT, ensure_ascii=False, default=str)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def text_result(data):
+    return [TextContent(type="text", text=dump_json(data))]
+
+
+def tsv_cell(value):
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        value = dump_json(value) if isinstance(value, (dict, list)) else str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "")
+
+
+def encode_rows(rows, fmt, columns):
+    """Codifica righe omogenee: json (lista di oggetti), columns (intestazione + valori) o tsv"""
+    if fmt == "tsv":
+        lines = ["\t".join(columns)]
+        lines.extend("\t".join(tsv_cell(row.get(c)) for c in columns) for row in rows)
+        return "\n".join(lines)
+    if fmt == "columns":
+        return {"columns": columns, "rows": [[row.get(c) for c in columns] for row in rows]}
+    return rows
+
+
+async def take_rows(rows, count):
+    """Le prime count righe di un iteratore (anche asincrono), senza leggerne altre"""
+    if not hasattr(rows, "__anext__"):
+        return list(itertools.islice(rows, count))
+    taken = []
+    while len(taken) < count:
+        try:
+            taken.append(await rows.__anext__())
+        except StopAsyncIteration:
+            break
+    return taken
+
+
+async def table_result(rows, fmt="json", offset=0, head=()):
+    """Risposta di un elenco, al massimo MAX_ROWS righe alla volta.
+
+    rows è una lista o un iteratore (anche asincrono) da cui si leggono solo
+    MAX_ROWS + 1 righe: se ce ne sono altre, l'iteratore resta in memoria per
+    RESULT_CURSOR_TTL secondi e il blocco successivo si legge con il tool
+    get_more_results passando more_cursor (head sono le righe già lette e non
+    ancora restituite). total è noto solo sull'ultimo blocco. Il nome
+    more_cursor distingue questi cursori dal next_cursor delle pagine lette
+    con limit (page_result), che torna invece allo stesso tool dell'elenco.
+    Senza cursore la risposta json è la semplice lista, come in passato.
+    """
+    fmt = fmt if fmt in OUTPUT_FORMATS else "json"
+    if not hasattr(rows, "__anext__"):
+        rows = iter(rows)
+    page = list(head) + await take_rows(rows, MAX_ROWS + 1 - len(head))
+    columns = list(page[0]) if page else []
+    cursor = None
+    if len(page) > MAX_ROWS:
+        cursor = secrets.token_urlsafe(12)
+        result_cursors.set(cursor, {"rows": rows, "head": page[MAX_ROWS:], "offset": offset + MAX_ROWS,
+                                    "company_id": current_company().id})
+        page = page[:MAX_ROWS]
+    encoded = encode_rows(page, fmt, columns)
+    if cursor is None and offset == 0:
+        return [TextContent(type="text", text=encoded if fmt == "tsv" else dump_json(encoded))]
+
+    total = None if cursor else offset + len(page)
+    position = {"offset": offset, "returned": len(page), "total": total, "more_cursor": cursor}
+    if fmt == "tsv":
+        footer = f"# righe {offset + 1}-{offset + len(page)}" + (f" di {total}" if total is not None else "")
+        footer += f"; more_cursor: {cursor}" if cursor else ""
+        return [TextContent(type="text", text=f"{encoded}\n{footer}")]
+    if fmt == "columns":
+        return text_result({**encoded, **position})
+    return text_result({"items": encoded, **position})
+
+
+def page_result(rows, fmt, next_cursor):
+    """Una pagina di un elenco letto con limit/cursor: righe e next_cursor (null sull'ultima pagina).
+
+    next_cursor va ripassato come cursor allo stesso tool (vedi list_paging).
+    """
+    fmt = fmt if fmt in OUTPUT_FORMATS else "json"
+    encoded = encode_rows(rows, fmt, list(rows[0]) if rows else [])
+    if fmt == "tsv":
+        footer = f"# {len(rows)} righe; " + (f"next_cursor: {next_cursor}" if next_cursor else "fine elenco")
+        return [TextContent(type="text", text=f"{encoded}\n{footer}")]
+    position = {"returned": len(rows), "next_cursor": next_cursor}
+    if fmt == "columns":
+        return text_result({**encoded, **position})
+    return text_result({"items": encoded, **position})
+
+
+def encode_cursor(state):
+    """Cursore opaco di un elenco paginato: argomenti della richiesta e posizione, in base64url"""
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return state["args"], state["pos"]
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Cursore non valido: ripetere la richiesta senza cursor")
+
+
+def list_paging(arguments):
+    """Argomenti effettivi, limit e posizione di un elenco.
+
+    Con cursor gli argomenti della richiesta sono quelli salvati nel cursore
+    (resta modificabile solo format). limit None significa elenco completo,
+    restituito a blocchi da table_result.
+    """
+    check_query(arguments.get("query"))
+    if arguments.get("cursor"):
+        if result_cursors.get(arguments["cursor"]) is not None:
+            raise ValueError("Questo è un more_cursor: passarlo al tool get_more_results, non come cursor dell'elenco")
+        args, position = decode_cursor(arguments["cursor"])
+        if args.get("company_id", current_company().id) != current_company().id:
+            raise ValueError(f"Il cursore appartiene all'azienda {args['company_id']}: ripetere la richiesta con quel company_id")
+        return {**args, "format": arguments.get("format", "json")}, args["limit"], position
+    limit = arguments.get("limit")
+    if not limit:
+        return arguments, None, None
+    limit = max(1, min(int(limit), MAX_ROWS))
+    return {**arguments, "limit": limit}, limit, None
+
+
+def next_list_cursor(arguments, position):
+    """next_cursor di una pagina, o None se l'elenco è finito"""
+    if position is None:
+        return None
+    args = {k: v for k, v in arguments.items() if k not in ("cursor", "format")}
+    args["company_id"] = current_company().id
+    return encode_cursor({"args": args, "pos": position})
+
+
+def vat_rate_key(item):
+    """Aliquota IVA di una riga come stringa ("22", "10", "0"), usata come chiave dei totali"""
+    return f"{float((item.get('vat') or {}).get('value') or 0):g}"
+
+
+def document_vat_rates(d, net_of):
+    """Imponibile per aliquota dalle righe del documento; senza righe, un'unica aliquota dedotta dai totali"""
+    rates = collections.defaultdict(float)
+    for item in d.get("items_list") or []:
+        rates[vat_rate_key(item)] += net_of(item)
+    if not rates and d.get("amount_net"):
+        rates[f"{round((d.get('amount_vat') or 0) / d['amount_net'] * 100):g}"] += d["amount_net"]
+    return rates
+
+
+def issued_document_facts(d):
+    """Contributi di un documento emesso ai totali mensili: (mese, metrica, aliquota, importo).
+
+    Fatturato e IVA cadono nel mese del documento, gli incassi nel mese di
+    pagamento; le note di credito contribuiscono con segno negativo.
+    """
+    month = str(d.get("date") or "")[:7]
+    if len(month) != 7:
+        return []
+    sign = -1 if d.get("type") == "credit_note" else 1
+    rates = document_vat_rates(d, lambda i: (i.get("qty") or 0) * (i.get("net_price") or 0) * (1 - (i.get("discount") or 0) / 100))
+    net = d["amount_net"] if d.get("amount_net") is not None else sum(rates.values())
+    vat = d["amount_vat"] if d.get("amount_vat") is not None else sum(n * float(r) / 100 for r, n in rates.items())
+    facts = [
+        (month, "fatturato_netto", "", sign * net),
+        (month, "fatturato_iva", "", sign * vat),
+        (month, "fatturato", "", sign * get_total_from_doc(d)),
+    ]
+    for rate, taxable in rates.items():
+        facts.append((month, "imponibile_vendite", rate, sign * taxable))
+        facts.append((month, "iva_vendite", rate, sign * taxable * float(rate) / 100))
+    if d.get("use_split_payment"):
+        # Split payment: l'IVA viene versata dal committente pubblico, non dal fornitore
+        facts.append((month, "iva_split_payment", "", sign * vat))
+    for p in d.get("payments_list") or []:
+        if str(p.get("status", "")) == "paid" and p.get("paid_date"):
+            facts.append((str(p["paid_date"])[:7], "incassato", "", sign * (p.get("amount") or 0)))
+    return facts
+
+
+def open_payments_of(d):
+    """Rate non pagate di un documento: (scadenza, importo, numero, id e nome controparte).
+
+    Senza data di scadenza la rata si considera dovuta alla data del documento.
+    """
+    entity = d.get("entity") or {}
+    number = d.get("number") if d.get("number") is not None else d.get("invoice_number")
+    return [
+        (str(p.get("due_date") or d.get("date") or ""), p.get("amount") or 0,
+         None if number is None else str(number), entity.get("id"), entity.get("name"))
+        for p in d.get("payments_list") or []
+        if str(p.get("status", "")) == "not_paid"
+    ]
+
+
+def received_document_facts(d):
+    """Contributi di un documento ricevuto ai totali mensili (costi, IVA acquisti e detraibile, pagamenti)"""
+    month = str(d.get("date") or "")[:7]
+    if len(month) != 7:
+        return []
+    sign = -1 if d.get("type") == "passive_credit_note" else 1
+    rates = document_vat_rates(d, lambda i: (i.get("qty") or 0) * (i.get("net_price") or 0))
+    deductible = collections.defaultdict(float)
+    for item in d.get("items_list") or []:
+        share = item.get("deductibility_vat_percentage", d.get("vat_deductibility", 100))
+        deductible[vat_rate_key(item)] += (item.get("qty") or 0) * (item.get("net_price") or 0) * share / 100
+    if not d.get("items_list"):
+        for rate, taxable in rates.items():
+            deductible[rate] += taxable * d.get("vat_deductibility", 100) / 100
+    net = d["amount_net"] if d.get("amount_net") is not None else sum(rates.values())
+    vat = d["amount_vat"] if d.get("amount_vat") is not None else sum(n * float(r) / 100 for r, n in rates.items())
+    gross = d["amount_gross"] if d.get("amount_gross") is not None else net + vat
+    facts = [
+        (month, "costi_netti", "", sign * net),
+        (month, "costi_iva", "", sign * vat),
+        (month, "costi", "", sign * gross),
+    ]
+    for rate, taxable in rates.items():
+        facts.append((month, "imponibile_acquisti", rate, sign * taxable))
+        facts.append((month, "iva_acquisti", rate, sign * taxable * float(rate) / 100))
+        facts.append((month, "iva_detraibile", rate, sign * deductible[rate] * float(rate) / 100))
+    for p in d.get("payments_list") or []:
+        if str(p.get("status", "")) == "paid" and p.get("paid_date"):
+            facts.append((str(p["paid_date"])[:7], "pagato", "", sign * (p.get("amount") or 0)))
+    return facts
+
+
+def search_words(text):
+    """Parole normalizzate per la ricerca: minuscole, senza accenti né punteggiatura.
+
+    I punti e gli apostrofi vengono tolti senza spezzare la parola, così
+    "ROSSI S.R.L." diventa ["rossi", "srl"] come "Rossi srl".
+    """
+    text = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode().lower()
+    return re.findall(r"[a-z0-9]+", re.sub(r"[.']", "", text))
+
+
+def check_query(query):
+    """Solleva ValueError se un filtro testuale indicato non contiene lettere o cifre.
+
+    Un filtro fatto solo di spazi o punteggiatura non selezionerebbe nulla
+    di sensato: meglio rifiutarlo che ignorarlo e restituire tutto. Un
+    filtro assente o vuoto resta valido e non filtra.
+    """
+    if query and not search_words(query):
+        raise ValueError(f"Il filtro query {query!r} deve contenere almeno una lettera o una cifra")
+
+
+def word_trigrams(word):
+    """Trigrammi di una parola delimitata da spazi, come in pg_trgm"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def trigrams(text):
+    """Trigrammi di tutte le parole di un testo"""
+    grams = set()
+    for word in search_words(text):
+        grams |= word_trigrams(word)
+    return grams
+
+
+def query_terms(query, min_score=SEARCH_MIN_SCORE):
+    """Per ogni parola cercata: i suoi trigrammi e quanti ne devono comparire nel record.
+
+    Le parole con cifre (partite IVA, codici, numeri) vanno trovate intere
+    come sottostringa, quindi senza i trigrammi di bordo; le altre tollerano
+    piccoli errori di battitura (almeno min_score dei trigrammi).
+    """
+    terms = []
+    for word in search_words(query):
+        if len(word) >= 3 and any(c.isdigit() for c in word):
+            grams = {word[i:i + 3] for i in range(len(word) - 2)}
+            terms.append((sorted(grams), len(grams)))
+        else:
+            grams = word_trigrams(word)
+            terms.append((sorted(grams), max(1, math.ceil(min_score * len(grams) - 1e-9))))
+    return terms
+
+
+def fuzzy_score(terms, grams):
+    """Punteggio di un record (trigrammi grams) per una ricerca: quota dei trigrammi
+    cercati presenti, o None se una parola non è stata trovata"""
+    if not terms:
+        return None
+    for word_grams, required in terms:
+        if sum(g in grams for g in word_grams) < required:
+            return None
+    query_grams = set().union(*(set(word_grams) for word_grams, _ in terms))
+    return len(query_grams & grams) / len(query_grams)
+
+
+def issued_search_text(d):
+    """Testo indicizzato di un documento emesso: cliente, oggetto e righe"""
+    entity = d.get("entity") or {}
+    parts = [entity.get("name"), entity.get("vat_number"), entity.get("tax_code"),
+             d.get("subject"), d.get("visible_subject")]
+    for item in d.get("items_list") or []:
+        parts += [item.get("name"), item.get("description")]
+    return " ".join(str(p) for p in parts if p)
+
+
+def received_search_text(d):
+    """Testo indicizzato di un documento ricevuto: fornitore, descrizione e righe"""
+    entity = d.get("entity") or {}
+    parts = [entity.get("name"), entity.get("vat_number"), entity.get("tax_code"), d.get("description")]
+    for item in d.get("items_list") or []:
+        parts += [item.get("name"), item.get("description")]
+    return " ".join(str(p) for p in parts if p)
+
+
+def client_search_text(c):
+    """Testo indicizzato di un cliente: ragione sociale, partita IVA, codice fiscale ed email"""
+    parts = [c.get("name"), c.get("vat_number"), c.get("tax_code"), c.get("email"), c.get("certified_email")]
+    return " ".join(str(p) for p in parts if p)
+
+
+class LocalStore:
+    """Mirror SQLite di documenti emessi, documenti ricevuti e clienti.
+
+    Ogni riga conserva il JSON completo del record (colonna data) più le
+    colonne usate per filtrare e ordinare. Le tabelle sono indicizzate per
+    company_id così un unico file può servire più aziende.
+
+    Per i documenti si mantengono anche i totali mensili (monthly_rollups):
+    ogni documento salvato registra i propri contributi in document_facts e
+    i totali vengono corretti per differenza, senza ricalcolare il resto.
+    Le rate non pagate sono copiate in open_payments, indicizzata per scadenza.
+
+    Per la ricerca ogni record ha i trigrammi del proprio testo (nomi, partita
+    IVA, oggetto, righe...) in search_trigrams, un indice invertito
+    aggiornato a ogni salvataggio: una ricerca conta i trigrammi in comune
+    senza leggere i record.
+    """
+
+    # Da incrementare quando cambiano *_document_facts, open_payments_of o *_search_text:
+    # gli indici derivati vengono ricostruiti
+    INDEX_VERSION = 4
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS issued_documents (
+            company_id INTEGER NOT NULL,
+            id INTEGER NOT NULL,
+            type TEXT,
+            number INTEGER,
+            numeration TEXT,
+            date TEXT,
+            entity_id INTEGER,
+            entity_name TEXT,
+            ei_status TEXT,
+            updated_at TEXT,
+            data TEXT NOT NULL,
+            PRIMARY KEY (company_id, id)
+        );
+        DROP INDEX IF EXISTS issued_documents_type_date;
+        CREATE INDEX IF NOT EXISTS issued_documents_keyset
+            ON issued_documents (company_id, type, date, id);
+        CREATE INDEX IF NOT EXISTS issued_documents_numbering
+            ON issued_documents (company_id, type, numeration, number);
+        CREATE TABLE IF NOT EXISTS received_documents (
+            company_id INTEGER NOT NULL,
+            id INTEGER NOT NULL,
+            type TEXT,
+            date TEXT,
+            entity_id INTEGER,
+            entity_name TEXT,
+            updated_at TEXT,
+            data TEXT NOT NULL,
+            PRIMARY KEY (company_id, id)
+        );
+        DROP INDEX IF EXISTS received_documents_type_date;
+        CREATE INDEX IF NOT EXISTS received_documents_keyset
+            ON received_documents (company_id, type, date, id);
+        CREATE TABLE IF NOT EXISTS clients (
+            company_id INTEGER NOT NULL,
+            id INTEGER NOT NULL,
+            name TEXT,
+            vat_number TEXT,
+            tax_code TEXT,
+            updated_at TEXT,
+            data TEXT NOT NULL,
+            PRIMARY KEY (company_id, id)
+        );
+        CREATE INDEX IF NOT EXISTS clients_keyset
+            ON clients (company_id, coalesce(name, ''), id);
+        CREATE TABLE IF NOT EXISTS document_facts (
+            company_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            doc_id INTEGER NOT NULL,
+            resource TEXT NOT NULL,
+            month TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            rate TEXT NOT NULL DEFAULT '',
+            amount REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS document_facts_doc
+            ON document_facts (company_id, kind, doc_id);
+        CREATE TABLE IF NOT EXISTS monthly_rollups (
+            company_id INTEGER NOT NULL,
+            resource TEXT NOT NULL,
+            month TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            rate TEXT NOT NULL DEFAULT '',
+            amount REAL NOT NULL,
+            PRIMARY KEY (company_id, resource, month, metric, rate)
+        );
+        CREATE TABLE IF NOT EXISTS open_payments (
+            company_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            doc_id INTEGER NOT NULL,
+            resource TEXT NOT NULL,
+            due_date TEXT NOT NULL,
+            amount REAL NOT NULL,
+            number TEXT,
+            entity_id INTEGER,
+            entity_name TEXT
+        );
+        CREATE INDEX IF NOT EXISTS open_payments_due
+            ON open_payments (company_id, due_date);
+        CREATE INDEX IF NOT EXISTS open_payments_doc
+            ON open_payments (company_id, kind, doc_id);
+        CREATE TABLE IF NOT EXISTS search_trigrams (
+            company_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            trigram TEXT NOT NULL,
+            doc_id INTEGER NOT NULL,
+            PRIMARY KEY (company_id, kind, trigram, doc_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS search_documents (
+            company_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            doc_id INTEGER NOT NULL,
+            trigrams TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (company_id, kind, doc_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS sync_state (
+            company_id INTEGER NOT NULL,
+            resource TEXT NOT NULL,
+            last_updated_at TEXT,
+            last_sync REAL NOT NULL DEFAULT 0,
+            last_full_sync REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (company_id, resource)
+        );
+    """
+
+    # Risorsa → (tabella, funzione che estrae le colonne indicizzate dal record)
+    TABLES = {
+        "issued": ("issued_documents", lambda d: {
+            "type": d.get("type"),
+            "number": d.get("number"),
+            "numeration": d.get("numeration") or "",
+            "date": d.get("date"),
+            "entity_id": (d.get("entity") or {}).get("id"),
+            "entity_name": (d.get("entity") or {}).get("name"),
+            "ei_status": d.get("ei_status"),
+        }),
+        "received": ("received_documents", lambda d: {
+            "type": d.get("type"),
+            "date": d.get("date"),
+            "entity_id": (d.get("entity") or {}).get("id"),
+            "entity_name": (d.get("entity") or {}).get("name"),
+        }),
+        "clients": ("clients", lambda d: {
+            "name": d.get("name"),
+            "vat_number": d.get("vat_number"),
+            "tax_code": d.get("tax_code"),
+        }),
+    }
+
+    # Risorsa → funzione che calcola i contributi di un record ai totali mensili
+    FACTS = {
+        "issued": issued_document_facts,
+        "received": received_document_facts,
+    }
+
+    # Risorsa → funzione che estrae il testo indicizzato per la ricerca
+    SEARCH_TEXT = {
+        "issued": issued_search_text,
+        "received": received_search_text,
+        "clients": client_search_text,
+    }
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self._conn = None
+
+    @property
+    def conn(self):
+        """Connessione SQLite, aperta al primo uso nel thread che la userà (vedi run_store)"""
+        if self._conn is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.executescript(self.SCHEMA)
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] != self.INDEX_VERSION:
+                self.rebuild_indexes()
+        return self._conn
+
+    def rebuild_indexes(self):
+        """Ricalcola totali mensili, rate aperte e indice di ricerca dei record già presenti nel mirror"""
+        with self.conn:
+            for derived in ("document_facts", "monthly_rollups", "open_payments", "search_trigrams", "search_documents"):
+                self.conn.execute(f"DELETE FROM {derived}")
+            for kind, (table, _) in self.TABLES.items():
+                type_col = "type" if kind in self.FACTS else "NULL AS type"
+                for row in self.conn.execute(f"SELECT company_id, id, {type_col}, data FROM {table}").fetchall():
+                    record = json.loads(row["data"])
+                    if kind in self.FACTS:
+                        self._index_document(row["company_id"], kind, f"{kind}:{row['type']}", row["id"], record)
+                    self._index_search(row["company_id"], kind, row["id"], record)
+            self.conn.execute(f"PRAGMA user_version = {self.INDEX_VERSION}")
+
+    def _index_document(self, company_id, kind, resource, doc_id, doc):
+        """Aggiorna totali mensili e rate aperte di un documento salvato (doc=None se eliminato)"""
+        self._replace_facts(company_id, kind, resource, doc_id, self.FACTS[kind](doc) if doc else [])
+        self.conn.execute("DELETE FROM open_payments WHERE company_id = ? AND kind = ? AND doc_id = ?", (company_id, kind, doc_id))
+        if doc:
+            self.conn.executemany(
+                """INSERT INTO open_payments (company_id, kind, doc_id, resource, due_date, amount, number, entity_id, entity_name)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                [(company_id, kind, doc_id, resource) + p for p in open_payments_of(doc)]
+            )
+
+    def _index_search(self, company_id, kind, doc_id, record):
+        """Sostituisce i trigrammi di un record nell'indice di ricerca (record=None se eliminato)"""
+        key = (company_id, kind, doc_id)
+        old = self.conn.execute(
+            "SELECT trigrams FROM search_documents WHERE company_id = ? AND kind = ? AND doc_id = ?", key
+        ).fetchone()
+        old_grams = set(json.loads(old["trigrams"])) if old else set()
+        grams = trigrams(self.SEARCH_TEXT[kind](record)) if record else set()
+        self.conn.executemany(
+            "DELETE FROM search_trigrams WHERE company_id = ? AND kind = ? AND trigram = ? AND doc_id = ?",
+            [(company_id, kind, g, doc_id) for g in old_grams - grams]
+        )
+        self.conn.executemany(
+            "INSERT INTO search_trigrams (company_id, kind, trigram, doc_id) VALUES (?, ?, ?, ?)",
+            [(company_id, kind, g, doc_id) for g in grams - old_grams]
+        )
+        if record:
+            if old is None or grams != old_grams:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO search_documents (company_id, kind, doc_id, trigrams, size) VALUES (?, ?, ?, ?, ?)",
+                    key + (json.dumps(sorted(grams)), len(grams))
+                )
+        elif old is not None:
+            self.conn.execute("DELETE FROM search_documents WHERE company_id = ? AND kind = ? AND doc_id = ?", key)
+
+    def _replace_facts(self, company_id, kind, resource, doc_id, facts):
+        """Sostituisce i contributi di un documento, correggendo i totali mensili per differenza"""
+        upsert = """INSERT INTO monthly_rollups (company_id, resource, month, metric, rate, amount)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (company_id, resource, month, metric, rate)
+                    DO UPDATE SET amount = amount + excluded.amount"""
+        old = self.conn.execute(
+            "SELECT resource, month, metric, rate, amount FROM document_facts WHERE company_id = ? AND kind = ? AND doc_id = ?",
+            (company_id, kind, doc_id)
+        ).fetchall()
+        if old:
+            self.conn.executemany(upsert, [(company_id, r["resource"], r["month"], r["metric"], r["rate"], -r["amount"]) for r in old])
+            self.conn.execute("DELETE FROM document_facts WHERE company_id = ? AND kind = ? AND doc_id = ?", (company_id, kind, doc_id))
+        if facts:
+            self.conn.executemany(
+                "INSERT INTO document_facts (company_id, kind, doc_id, resource, month, metric, rate, amount) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(company_id, kind, doc_id, resource) + tuple(f) for f in facts]
+            )
+            self.conn.executemany(upsert, [(company_id, resource) + tuple(f) for f in facts])
+
+    def get_sync_state(self, company_id, resource):
+        row = self.conn.execute(
+            "SELECT * FROM sync_state WHERE company_id = ? AND resource = ?",
+            (company_id, resource)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def mark_stale(self, company_id, resource):
+        """Forza un allineamento incrementale alla prossima lettura"""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE sync_state SET last_sync = 0 WHERE company_id = ? AND resource = ?",
+                (company_id, resource)
+            )
+
+    def save(self, company_id, resource, rows, full=False):
+        """Salva un blocco di record scaricati per una risorsa ('issued:invoice', 'clients', ...).
+
+        Con full=True sostituisce prima tutti i record della risorsa (primo
+        blocco di un allineamento completo). Nella stessa transazione avanza
+        last_updated_at fino al record più recente del blocco: gli
+        allineamenti scaricano in ordine di updated_at, quindi se uno si
+        interrompe il successivo riparte da dove è arrivato questo blocco.
+        """
+        kind, _, doc_type = resource.partition(":")
+        table, extract = self.TABLES[kind]
+        scope_sql = "company_id = ? AND type = ?" if doc_type else "company_id = ?"
+        scope = (company_id, doc_type) if doc_type else (company_id,)
+        last_updated_at = max((r.get("updated_at") for r in rows if r.get("updated_at")), default=None)
+
+        indexed = kind in self.FACTS
+
+        with self.conn:
+            if full:
+                for row in self.conn.execute(f"SELECT id FROM {table} WHERE {scope_sql}", scope).fetchall():
+                    self._index_search(company_id, kind, row["id"], None)
+                self.conn.execute(f"DELETE FROM {table} WHERE {scope_sql}", scope)
+                if indexed:
+                    for derived in ("document_facts", "monthly_rollups", "open_payments"):
+                        self.conn.execute(f"DELETE FROM {derived} WHERE company_id = ? AND resource = ?", (company_id, resource))
+            for r in rows:
+                cols = extract(r)
+                cols.update(company_id=company_id, id=r.get("id"), updated_at=r.get("updated_at"),
+                            data=json.dumps(r, ensure_ascii=False))
+                names = ", ".join(cols)
+                marks = ", ".join("?" for _ in cols)
+                self.conn.execute(f"INSERT OR REPLACE INTO {table} ({names}) VALUES ({marks})", tuple(cols.values()))
+                if indexed:
+                    self._index_document(company_id, kind, resource, r.get("id"), r)
+                self._index_search(company_id, kind, r.get("id"), r)
+            self.conn.execute(
+                """INSERT INTO sync_state (company_id, resource, last_updated_at) VALUES (?, ?, ?)
+                   ON CONFLICT (company_id, resource) DO UPDATE SET
+                       last_updated_at = max(coalesce(sync_state.last_updated_at, ''), coalesce(excluded.last_updated_at, ''))""",
+                (company_id, resource, last_updated_at)
+            )
+
+    def finish_sync(self, company_id, resource, full=False, keep_ids=None, since=None):
+        """Chiude un allineamento dopo l'ultimo blocco salvato.
+
+        Con keep_ids (elenco completo degli ID remoti) elimina i record non
+        più presenti su Fatture in Cloud. since è l'updated_at da cui ripartire
+        se la risorsa non ha ancora record, così gli allineamenti successivi
+        restano incrementali anche per un'azienda senza documenti.
+        """
+        kind, _, doc_type = resource.partition(":")
+        table, _ = self.TABLES[kind]
+        scope_sql = "company_id = ? AND type = ?" if doc_type else "company_id = ?"
+        scope = (company_id, doc_type) if doc_type else (company_id,)
+        now = time.time()
+        verified = full or keep_ids is not None
+        with self.conn:
+            if keep_ids is not None:
+                keep = set(keep_ids)
+                stale = [(company_id, row["id"]) for row in self.conn.execute(f"SELECT id FROM {table} WHERE {scope_sql}", scope)
+                         if row["id"] not in keep]
+                self.conn.executemany(f"DELETE FROM {table} WHERE company_id = ? AND id = ?", stale)
+                for _, stale_id in stale:
+                    if kind in self.FACTS:
+                        self._index_document(company_id, kind, resource, stale_id, None)
+                    self._index_search(company_id, kind, stale_id, None)
+            self.conn.execute(
+                """INSERT INTO sync_state (company_id, resource, last_updated_at, last_sync, last_full_sync)
+                   VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (company_id, resource) DO UPDATE SET
+                       last_updated_at = coalesce(nullif(sync_state.last_updated_at, ''), excluded.last_updated_at),
+                       last_sync = excluded.last_sync,
+                       last_full_sync = CASE WHEN ? THEN excluded.last_full_sync ELSE sync_state.last_full_sync END""",
+                (company_id, resource, since, now, now if verified else 0, verified)
+            )
+
+    def delete(self, company_id, kind, record_id):
+        table, _ = self.TABLES[kind]
+        with self.conn:
+            self.conn.execute(f"DELETE FROM {table} WHERE company_id = ? AND id = ?", (company_id, record_id))
+            if kind in self.FACTS:
+                self._index_document(company_id, kind, None, record_id, None)
+            self._index_search(company_id, kind, record_id, None)
+
+    def open_payments(self, company_id, resources, due_to):
+        """Rate aperte delle risorse indicate con scadenza fino a due_to (in ordine di scadenza)
+        e, per risorsa, numero e importo di quelle che scadono dopo"""
+        marks = ", ".join("?" for _ in resources)
+        rows = self.conn.execute(
+            f"""SELECT resource, doc_id, number, entity_id, entity_name, due_date, amount FROM open_payments
+                WHERE company_id = ? AND due_date <= ? AND resource IN ({marks}) ORDER BY due_date""",
+            (company_id, due_to, *resources)
+        ).fetchall()
+        later = self.conn.execute(
+            f"""SELECT resource, COUNT(*) AS count, SUM(amount) AS amount FROM open_payments
+                WHERE company_id = ? AND due_date > ? AND resource IN ({marks}) GROUP BY resource""",
+            (company_id, due_to, *resources)
+        ).fetchall()
+        return [dict(r) for r in rows], {r["resource"]: (r["count"], r["amount"]) for r in later}
+
+    def rollups(self, company_id, resources, month_from, month_to):
+        """Totali mensili (resource, month, metric, rate, amount) delle risorse indicate tra due mesi YYYY-MM"""
+        marks = ", ".join("?" for _ in resources)
+        return self.conn.execute(
+            f"""SELECT resource, month, metric, rate, amount FROM monthly_rollups
+                WHERE company_id = ? AND resource IN ({marks}) AND month BETWEEN ? AND ?""",
+            (company_id, *resources, month_from, month_to)
+        ).fetchall()
+
+    @staticmethod
+    def _matches_sql(company_id, kind, terms):
+        """Sottoquery (doc_id, hits) dei record che contengono ogni parola cercata (vedi query_terms)
+        e parametri; hits è il numero di trigrammi cercati presenti nel record"""
+        words, params = [], []
+        for word_grams, required in terms:
+            marks = ", ".join("?" for _ in word_grams)
+            words.append(f"""SELECT doc_id FROM search_trigrams
+                             WHERE company_id = ? AND kind = ? AND trigram IN ({marks})
+                             GROUP BY doc_id HAVING COUNT(*) >= ?""")
+            params += [company_id, kind, *word_grams, required]
+        query_grams = sorted(set().union(*(word_grams for word_grams, _ in terms)))
+        marks = ", ".join("?" for _ in query_grams)
+        sql = f"""SELECT doc_id, COUNT(*) AS hits FROM search_trigrams
+                  WHERE company_id = ? AND kind = ? AND trigram IN ({marks})
+                    AND doc_id IN ({" INTERSECT ".join(words)})
+                  GROUP BY doc_id"""
+        return sql, [company_id, kind, *query_grams, *params], len(query_grams)
+
+    @staticmethod
+    def search_sql(search_fields, query):
+        """Condizione SQL (e parametri) che cerca query come sottostringa in uno dei campi JSON,
+        come il filtro like dell'API (vedi q_filter); ValueError se query non ha lettere o cifre"""
+        check_query(query)
+        pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        conditions = " OR ".join(f"json_extract(data, '$.{f}') LIKE ? ESCAPE '\\'" for f in search_fields)
+        return f" AND ({conditions})", [pattern] * len(search_fields)
+
+    def search(self, company_id, kind, query, limit=20, date_from=None, date_to=None):
+        """(record, punteggio) dei record trovati da query, dal più simile.
+
+        Il punteggio è la quota dei trigrammi cercati presenti nel record; a
+        parità vince il record con meno trigrammi, cioè più vicino al testo
+        cercato. date_from e date_to limitano i documenti a un periodo.
+        """
+        table, _ = self.TABLES[kind]
+        terms = query_terms(query)
+        if not terms:
+            raise ValueError("Il testo da cercare deve contenere almeno una lettera o una cifra")
+        sql, params, size = self._matches_sql(company_id, kind, terms)
+        sql = f"""SELECT t.data, m.hits FROM ({sql}) AS m
+                  JOIN search_documents d ON d.company_id = ? AND d.kind = ? AND d.doc_id = m.doc_id
+                  JOIN {table} t ON t.company_id = ? AND t.id = m.doc_id"""
+        params += [company_id, kind, company_id]
+        if date_from and date_to and kind != "clients":
+            sql += " WHERE t.date BETWEEN ? AND ?"
+            params += [date_from, date_to]
+        rows = self.conn.execute(sql + " ORDER BY m.hits DESC, d.size, m.doc_id LIMIT ?", params + [limit])
+        return [(json.loads(row["data"]), row["hits"] / size) for row in rows]
+
+    def iter_documents(self, company_id, kind, doc_type, date_from=None, date_to=None, query=None,
+                       after=None, limit=None):
+        """Documenti di un tipo in ordine di data, opzionalmente filtrati per date e per testo.
+
+        query è cercata come sottostringa nei campi di LIST_SEARCH_FIELDS,
+        con lo stesso risultato del filtro q dell'API (la ricerca fuzzy è
+        solo nel tool search). after è la chiave (data, id) dell'ultimo
+        documento già letto: si riparte dal successivo, al massimo limit
+        documenti. I documenti vengono letti dal cursore uno alla volta.
+        """
+        table, _ = self.TABLES[kind]
+        sql = f"SELECT data FROM {table} WHERE company_id = ? AND type = ?"
+        params = [company_id, doc_type]
+        if date_from:
+            sql += " AND date >= ?"
+            params.append(date_from)
+        if date_to:
+            sql += " AND date <= ?"
+            params.append(date_to)
+        if query:
+            search_sql, search_params = self.search_sql(LIST_SEARCH_FIELDS[kind], query)
+            sql += search_sql
+            params += search_params
+        if after:
+            sql += " AND (date > ? OR (date = ? AND id > ?))"
+            params += [after[0], after[0], after[1]]
+        sql += " ORDER BY date, id"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        for row in self.conn.execute(sql, params):
+            yield json.loads(row["data"])
+
+    def documents(self, company_id, kind, doc_type, date_from=None, date_to=None, query=None,
+                  after=None, limit=None):
+        return list(self.iter_documents(company_id, kind, doc_type, date_from, date_to, query, after, limit))
+
+    def numbering(self, company_id, doc_type, date_from, date_to, numeration=None):
+        """(numeration, number, date, id) dei documenti emessi nel periodo, ordinati per numerazione e numero"""
+        sql = """SELECT numeration, number, date, id FROM issued_documents
+                 WHERE company_id = ? AND type = ? AND date BETWEEN ? AND ? AND number > 0"""
+        params = [company_id, doc_type, date_from, date_to]
+        if numeration is not None:
+            sql += " AND numeration = ?"
+            params.append(numeration)
+        return self.conn.execute(sql + " ORDER BY numeration, number, date", params).fetchall()
+
+    def iter_clients(self, company_id, query=None, after=None, limit=None):
+        """Clienti in ordine di nome; after è la chiave (nome, id) dell'ultimo già letto"""
+        sql = "SELECT data FROM clients WHERE company_id = ?"
+        params = [company_id]
+        if query:
+            search_sql, search_params = self.search_sql(CLIENT_SEARCH_FIELDS, query)
+            sql += search_sql
+            params += search_params
+        if after:
+            sql += " AND (coalesce(name, '') > ? OR (coalesce(name, '') = ? AND id > ?))"
+            params += [after[0], after[0], after[1]]
+        sql += " ORDER BY coalesce(name, ''), id"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        for row in self.conn.execute(sql, params):
+            yield json.loads(row["data"])
+
+    def clients(self, company_id, query=None, after=None, limit=None):
+        return list(self.iter_clients(company_id, query, after, limit))
+
+    def clients_by_id(self, company_id, client_ids):
+        """Clienti con gli ID indicati (lettura per chiave primaria)"""
+        clients = []
+        for start in range(0, len(client_ids), 500):
+            batch = list(client_ids[start:start + 500])
+            rows = self.conn.execute(
+                f"SELECT data FROM clients WHERE company_id = ? AND id IN ({','.join('?' * len(batch))})",
+                [company_id] + batch)
+            clients += [json.loads(row["data"]) for row in rows]
+        return clients
+
+
+_store = None
+_sync_locks = {}
+
+
+def get_store():
+    """Restituisce il mirror locale, o None se disattivato.
+
+    I metodi del mirror vanno eseguiti con run_store o iter_store.
+    """
+    global _store
+    if LOCAL_STORE and _store is None:
+        _store = LocalStore(DB_PATH)
+    return _store
+
+
+async def run_store(func, /, *args, **kwargs):
+    """Esegue un metodo del mirror nel thread del mirror e ne attende il risultato"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(store_executor, functools.partial(func, *args, **kwargs))
+
+
+async def iter_store(func, /, *args, batch=STORE_BATCH):
+    """Scorre un metodo generatore del mirror (iter_documents) a blocchi di batch record,
+    letti ciascuno nel thread del mirror"""
+    rows = func(*args)
+    try:
+        while True:
+            chunk = await run_store(lambda: list(itertools.islice(rows, batch)))
+            if not chunk:
+                return
+            for row in chunk:
+                yield row
+    finally:
+        await run_store(rows.close)
+
+
+async def sync_store(resource, list_func, **scope):
+    """Allinea il mirror locale di una risorsa con Fatture in Cloud.
+
+    Il primo allineamento scarica tutto in forma dettagliata; gli altri
+    chiedono solo i record con updated_at successivo all'ultimo visto. Ogni
+    FULL_SYNC_INTERVAL si scarica anche l'elenco dei soli ID (fields="id")
+    per eliminare dal mirror i record cancellati su Fatture in Cloud.
+    Entro SYNC_INTERVAL dall'ultimo allineamento non viene fatta alcuna chiamata.
+
+    I record arrivano in ordine di updated_at e vengono salvati a blocchi di
+    STORE_BATCH, ciascuno nella propria transazione: la memoria non dipende
+    dalla dimensione del primo allineamento, e uno interrotto riprende dal
+    punto raggiunto.
+    """
+    store = get_store()
+    company_id = current_company().id
+    lock = _sync_locks.setdefault((company_id, resource), asyncio.Lock())
+    async with lock:
+        state = await run_store(store.get_sync_state, company_id, resource)
+        now = time.time()
+        if state and now - state["last_sync"] < SYNC_INTERVAL:
+            return
+        full = not state or not state["last_updated_at"]
+        list_kwargs = dict(scope, fieldset="detailed", sort="updated_at")
+        if not full:
+            list_kwargs["q"] = f"updated_at >= '{state['last_updated_at']}'"
+        # Il giorno prima dell'allineamento: tollera differenze di orario con il server
+        since = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+        batch = []
+        replace = full
+        async for r in iter_rows(list_func, company_id=company_id, **list_kwargs):
+            batch.append(r)
+            if len(batch) >= STORE_BATCH:
+                await run_store(store.save, company_id, resource, batch, full=replace)
+                batch, replace = [], False
+        if batch or replace:
+            await run_store(store.save, company_id, resource, batch, full=replace)
+        keep_ids = None
+        if not full and now - state["last_full_sync"] >= FULL_SYNC_INTERVAL:
+            # Dopo il delta: un record presente nel delta ma assente qui è stato davvero eliminato
+            keep_ids = [r["id"] async for r in iter_rows(list_func, company_id=company_id, fields="id", **scope)]
+        await run_store(store.finish_sync, company_id, resource, full=full, keep_ids=keep_ids, since=since)
+
+
+def resource_list_func(resource):
+    """Metodo list_* dell'API da cui si allinea una risorsa del mirror ('issued:invoice', ...)"""
+    kind = resource.partition(":")[0]
+    if kind == "issued":
+        return issued_api.list_issued_documents
+    if kind == "received":
+        return received_api.list_received_documents
+    return clients_api.list_clients
+
+
+def invalidate_store(resource, deleted_id=None):
+    """Segnala una scrittura: la prossima lettura rifà un allineamento incrementale.
+
+    Non attende il thread del mirror: le operazioni vi vengono eseguite in
+    ordine, quindi ogni lettura successiva vede già la modifica.
+    """
+    store = get_store()
+    if store is None:
+        return
+    company_id = current_company().id
+    if deleted_id is not None:
+        store_executor.submit(store.delete, company_id, resource.partition(":")[0], deleted_id)
+    store_executor.submit(store.mark_stale, company_id, resource)
+
+
+def period_bounds(year, month=None):
+    """Primo e ultimo giorno (YYYY-MM-DD) di un anno o di un mese"""
+    if month:
+        last_day = calendar.monthrange(year, month)[1]
+        return f"{year}-{month:02d}-01", f"{year}-{month:02d}-{last_day}"
+    return f"{year}-01-01", f"{year}-12-31"
+
+
+def q_text(value):
+    """Stringa tra apici per un filtro q dell'API (apici e backslash con escape)"""
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def q_filter(date_from=None, date_to=None, search_fields=None, query=None):
+    """Espressione q per gli elenchi: intervallo di date e ricerca testuale (like) su più campi.
+
+    ValueError se query non contiene lettere o cifre (vedi check_query).
+    """
+    conditions = []
+    if date_from and date_to:
+        conditions.append(f"date >= '{date_from}' and date <= '{date_to}'")
+    if query and search_fields:
+        check_query(query)
+        pattern = q_text(f"%{query}%")
+        conditions.append("(" + " or ".join(f"{f} like {pattern}" for f in search_fields) + ")")
+    return " and ".join(conditions) or None
+
+
+def projection(fields):
+    """Parametri di proiezione per un elenco: solo i campi indicati, altrimenti il dettaglio completo"""
+    return {"fields": fields} if fields else {"fieldset": "detailed"}
+
+
+async def iter_issued_documents(doc_type, date_from=None, date_to=None, fields=None, query=None):
+    """Documenti emessi nel periodo, uno alla volta, dal mirror locale o dall'API.
+
+    fields limita i campi scaricati quando si legge dall'API (il mirror
+    contiene già i documenti completi); senza fields si usa il dettaglio.
+    query cerca un testo (sottostringa) in cliente, oggetto e descrizione:
+    il filtro viene applicato dall'API (q) o dal mirror, con lo stesso
+    risultato e senza scaricare i documenti esclusi.
+    """
+    store = get_store()
+    if store is not None:
+        await sync_store(f"issued:{doc_type}", issued_api.list_issued_documents, type=doc_type)
+        async for d in iter_store(store.iter_documents, current_company().id, "issued", doc_type, date_from, date_to, query):
+            yield d
+        return
+    q = q_filter(date_from, date_to, INVOICE_SEARCH_FIELDS, query)
+    async for d in iter_rows(issued_api.list_issued_documents, company_id=current_company().id,
+            type=doc_type, q=q, sort=DOCUMENT_SORT, **projection(fields)):
+        yield d
+
+
+async def iter_received_documents(doc_type, date_from=None, date_to=None, fields=None, query=None):
+    """Documenti ricevuti nel periodo, uno alla volta, dal mirror locale o dall'API.
+
+    fields e query come sopra; query cerca in fornitore e descrizione.
+    """
+    store = get_store()
+    if store is not None:
+        await sync_store(f"received:{doc_type}", received_api.list_received_documents, type=doc_type)
+        async for d in iter_store(store.iter_documents, current_company().id, "received", doc_type, date_from, date_to, query):
+            yield d
+        return
+    q = q_filter(date_from, date_to, RECEIVED_SEARCH_FIELDS, query)
+    async for d in iter_rows(received_api.list_received_documents, company_id=current_company().id,
+            type=doc_type, q=q, sort=DOCUMENT_SORT, **projection(fields)):
+        yield d
+
+
+async def load_issued_documents(doc_type, date_from=None, date_to=None, fields=None, query=None):
+    """Documenti emessi nel periodo come lista (vedi iter_issued_documents)"""
+    return [d async for d in iter_issued_documents(doc_type, date_from, date_to, fields, query)]
+
+
+async def load_received_documents(doc_type, date_from=None, date_to=None, fields=None, query=None):
+    """Documenti ricevuti nel periodo come lista (vedi iter_received_documents)"""
+    return [d async for d in iter_received_documents(doc_type, date_from, date_to, fields, query)]
+
+
+async def iter_clients(fields=None, query=None):
+    """Anagrafica clienti, uno alla volta, dal mirror locale o dall'API (fields come sopra).
+
+    query cerca un testo in nome, partita IVA e codice fiscale, filtrando
+    lato API o nel mirror. I record completi letti rinfrescano anche la
+    cache usata da get_client_by_id.
+    """
+    store = get_store()
+    if store is not None:
+        await sync_store("clients", clients_api.list_clients)
+        async for c in iter_store(store.iter_clients, current_company().id, query):
+            client_cache.set(c.get("id"), c)
+            yield c
+        return
+    async for c in iter_rows(clients_api.list_clients, company_id=current_company().id,
+            q=q_filter(search_fields=CLIENT_SEARCH_FIELDS, query=query), sort=CLIENT_SORT, **projection(fields)):
+        if not fields:
+            client_cache.set(c.get("id"), c)
+        yield c
+
+
+async def load_clients(fields=None, query=None):
+    """Anagrafica clienti come lista (vedi iter_clients)"""
+    return [c async for c in iter_clients(fields, query)]
+
+
+async def load_clients_by_id(client_ids):
+    """Anagrafiche dettagliate dei soli clienti indicati, come dict id → cliente.
+
+    Dal mirror è una lettura per chiave; dall'API un elenco filtrato per ID,
+    PER_PAGE ID per richiesta. I clienti restano fuori da client_cache: chi
+    li chiede li usa per la durata della propria operazione.
+    """
+    client_ids = sorted({int(i) for i in client_ids if i})
+    if not client_ids:
+        return {}
+    store = get_store()
+    if store is not None:
+        await sync_store("clients", clients_api.list_clients)
+        clients = await run_store(store.clients_by_id, current_company().id, client_ids)
+    else:
+        async def fetch(batch):
+            q = "(" + " or ".join(f"id = {client_id}" for client_id in batch) + ")"
+            return [c async for c in iter_rows(clients_api.list_clients, company_id=current_company().id,
+                                               q=q, **projection(None))]
+        batches = [client_ids[i:i + PER_PAGE] for i in range(0, len(client_ids), PER_PAGE)]
+        clients = [c for batch in await run_bounded(fetch, batches) for c in batch]
+    return {c.get("id"): c for c in clients}
+
+
+async def load_page(kind, doc_type=None, date_from=None, date_to=None, fields=None, query=None,
+                    limit=MAX_ROWS, position=None):
+    """Una pagina di documenti ('issued', 'received') o di clienti e la posizione successiva.
+
+    Con il mirror la posizione è la chiave dell'ultima riga letta, (data, id)
+    per i documenti e (nome, id) per i clienti, e la pagina è una lettura
+    per intervallo sull'indice. Senza mirror la posizione è il numero di
+    righe già lette: fino a PER_PAGE righe la pagina è una pagina dell'API
+    con per_page=limit, oltre si leggono più pagine dell'API in parallelo.
+    La posizione restituita è None quando non ci sono altre righe.
+    """
+    search_fields = LIST_SEARCH_FIELDS[kind]
+    resource = f"{kind}:{doc_type}" if doc_type else kind
+    scope = {"type": doc_type} if doc_type else {}
+    store = get_store()
+    if store is not None:
+        await sync_store(resource, resource_list_func(resource), **scope)
+        after = (position or {}).get("after")
+        if kind == "clients":
+            rows = await run_store(store.clients, current_company().id, query, after, limit + 1)
+            key = lambda r: [r.get("name") or "", r.get("id")]
+        else:
+            rows = await run_store(store.documents, current_company().id, kind, doc_type, date_from, date_to,
+                                   query, after, limit + 1)
+            key = lambda r: [r.get("date"), r.get("id")]
+        if len(rows) > limit:
+            return rows[:limit], {"after": key(rows[limit - 1])}
+        return rows, None
+    # L'API restituisce al massimo PER_PAGE righe per pagina: oltre si leggono più pagine
+    offset = (position or {}).get("offset", 0)
+    per_page = min(limit, PER_PAGE)
+    first, skip = divmod(offset, per_page)
+    list_kwargs = dict(company_id=current_company().id, q=q_filter(date_from, date_to, search_fields, query),
+                       sort=CLIENT_SORT if kind == "clients" else DOCUMENT_SORT, **scope, **projection(fields))
+    fetch = lambda page: fetch_page(resource_list_func(resource), page, RAW_LISTINGS, per_page=per_page, **list_kwargs)
+    rows, last_page = await fetch(first + 1)
+    needed = -(-(skip + limit) // per_page)
+    for more, _ in await run_bounded(fetch, range(first + 2, min(first + needed, last_page) + 1), PAGE_CONCURRENCY):
+        rows += more
+    has_more = len(rows) > skip + limit or first + needed < last_page
+    rows = rows[skip:skip + limit]
+    if not RAW_LISTINGS:
+        rows = [to_plain(r) for r in rows]
+    return rows, ({"offset": offset + limit} if has_more else None)
+
+
+def invoice_list_row(d):
+    """Riga di list_invoices per una fattura emessa"""
+    return {
+        "id": d.get("id"),
+        "number": d.get("number"),
+        "date": str(d.get("date", "")),
+        "client": d.get("entity", {}).get("name") if d.get("entity") else None,
+        "total": get_total_from_doc(d),
+        "subject": d.get("subject"),
+        "description": d.get("visible_subject")
+    }
+
+
+def received_list_row(d):
+    """Riga di list_received_documents per un documento ricevuto"""
+    supplier_name = d.get('entity', {}).get('name', '') if d.get('entity') else ''
+    desc = d.get('description', '') or ''
+    return {
+        "id": d.get("id"),
+        "number": d.get("invoice_number"),
+        "date": str(d.get("date", "")),
+        "supplier": supplier_name,
+        "description": desc[:80],
+        "total": d.get('amount_gross') or d.get('amount_net') or 0
+    }
+
+
+def client_list_row(cd):
+    """Riga di list_clients per un cliente"""
+    return {
+        "id": cd.get("id"),
+        "name": cd.get("name"),
+        "vat": cd.get("vat_number"),
+        "tax_code": cd.get("tax_code"),
+        "email": cd.get("email")
+    }
+
+
+# Ambiti del tool search → (risorsa del mirror, tipo di documento)
+SEARCH_SCOPES = {
+    "clients": ("clients", None),
+    "invoices": ("issued", "invoice"),
+    "received": ("received", "expense"),
+}
+
+
+def search_hit(kind, r, score):
+    """Riga di risultato di search per un cliente o un documento"""
+    entity = r.get("entity") or {}
+    if kind == "clients":
+        hit = {"kind": "client", "id": r.get("id"), "name": r.get("name"), "vat": r.get("vat_number"),
+               "tax_code": r.get("tax_code"), "email": r.get("email")}
+    elif kind == "issued":
+        hit = {"kind": r.get("type"), "id": r.get("id"), "number": r.get("number"), "date": r.get("date"),
+               "client": entity.get("name"), "subject": r.get("subject"), "total": get_total_from_doc(r)}
+    else:
+        hit = {"kind": r.get("type"), "id": r.get("id"), "number": r.get("invoice_number"), "date": r.get("date"),
+               "supplier": entity.get("name"), "description": (r.get("description") or "")[:80],
+               "total": r.get("amount_gross") or r.get("amount_net") or 0}
+    hit["score"] = round(score, 2)
+    return hit
+
+
+async def search_records(query, scopes=None, year=None, limit=20):
+    """Ricerca fuzzy in clienti, fatture emesse e documenti ricevuti, in ordine di somiglianza.
+
+    Con il mirror usa l'indice di trigrammi (tutti gli anni, o solo year se
+    indicato). Senza mirror scarica clienti e documenti dell'anno (default
+    quello corrente) e li confronta in memoria con lo stesso punteggio.
+    """
+    if not search_words(query or ""):
+        raise ValueError("Il testo da cercare deve contenere almeno una lettera o una cifra")
+    scopes = [sc for sc in (scopes or SEARCH_SCOPES) if sc in SEARCH_SCOPES]
+    date_from, date_to = period_bounds(year) if year else (None, None)
+    scored = []
+    store = get_store()
+    if store is not None:
+        for scope in scopes:
+            kind, doc_type = SEARCH_SCOPES[scope]
+            resource = f"{kind}:{doc_type}" if doc_type else kind
+            await sync_store(resource, resource_list_func(resource), **({"type": doc_type} if doc_type else {}))
+            scored += [(score, 0, search_hit(kind, r, score))
+                       for r, score in await run_store(store.search, current_company().id, kind, query, limit,
+                                                       date_from, date_to)]
+    else:
+        terms = query_terms(query)
+        date_from, date_to = period_bounds(year or datetime.now().year)
+        for scope in scopes:
+            kind, doc_type = SEARCH_SCOPES[scope]
+            if kind == "clients":
+                records = await load_clients()
+            elif kind == "issued":
+                records = await load_issued_documents(doc_type, date_from, date_to)
+            else:
+                records = await load_received_documents(doc_type, date_from, date_to)
+            for r in records:
+                grams = trigrams(LocalStore.SEARCH_TEXT[kind](r))
+                score = fuzzy_score(terms, grams)
+                if score is not None:
+                    scored.append((score, -len(grams), search_hit(kind, r, score)))
+    scored.sort(key=lambda t: (t[0], t[1]), reverse=True)
+    return {"query": query, "results": [hit for _, _, hit in scored[:limit]]}
+
+
+# Totali read-only dei documenti: to_dict() dei modelli SDK li scarta
+READ_ONLY_AMOUNTS = ("amount_net", "amount_vat", "amount_gross", "amount_rivalsa", "amount_cassa",
+                     "amount_cassa2", "amount_withholding_tax", "amount_other_withholding_tax")
+
+
+def to_plain(model):
+    """Converte un modello SDK in un dict JSON (date come stringhe, enum come valori).
+
+    I totali read-only vengono ripresi dal modello, così un documento letto
+    con i modelli SDK ha gli stessi campi di quello letto come JSON grezzo.
+    """
+    data = model.to_dict()
+    for field in READ_ONLY_AMOUNTS:
+        value = getattr(model, field, None)
+        if value is not None:
+            data.setdefault(field, value)
+    return json.loads(json.dumps(data, default=str))
+
+
 def get_total_from_doc(d):
-    """Calcola totale documento da pagamenti o righe"""
+    """Calcola totale documento da pagamenti o righe (o amount_gross se proiettato senza)"""
     payments = d.get('payments_list', [])
     if payments:
         return sum(p.get('amount', 0) for p in payments)
     items = d.get('items_list', [])
+    if not items and 'amount_gross' in d:
+        return d.get('amount_gross') or 0
     return sum((i.get('qty', 0) * i.get('gross_price', 0)) for i in items)
 
 
-def get_client_by_id(client_id):
-    """Recupera dati cliente per ID"""
+# Campi che cambiano a ogni modifica di un documento: bastano per rivalidare la copia in cache
+DOCUMENT_VERSION_FIELDS = "id,updated_at,ei_status"
+
+
+async def fetch_issued_document(doc_id, **kwargs):
+    """Legge un documento emesso dall'API come dict (JSON grezzo o modello SDK, come gli elenchi)"""
+    if RAW_LISTINGS:
+        return await run_sdk(get_raw_record, issued_api.get_issued_document,
+            company_id=current_company().id, document_id=doc_id, **kwargs)
+    response = await run_sdk(issued_api.get_issued_document, company_id=current_company().id, document_id=doc_id, **kwargs)
+    return to_plain(response.data)
+
+
+async def get_document_by_id(doc_id):
+    """Documento emesso in dettaglio (righe e pagamenti), dalla cache se ancora valido.
+
+    Una copia in cache viene rivalidata con una lettura leggera dei soli
+    id, updated_at ed ei_status: se coincidono si usa la copia, altrimenti
+    si rilegge il dettaglio. Le scritture sul documento lo tolgono dalla
+    cache (invalidate_document), quindi dopo una modifica si rilegge sempre.
+    """
+    cached = document_cache.get(doc_id)
+    if cached is not None:
+        version = await fetch_issued_document(doc_id, fields=DOCUMENT_VERSION_FIELDS)
+        if version.get("updated_at") == cached.get("updated_at") and version.get("ei_status") == cached.get("ei_status"):
+            return cached
+    document = await fetch_issued_document(doc_id, fieldset="detailed")
+    document_cache.set(doc_id, document)
+    return document
+
+
+def invalidate_document(doc_id):
+    """Segnala una scrittura su un documento emesso: la prossima lettura rilegge il dettaglio"""
+    document_cache.invalidate(doc_id)
+
+
+# Metodi dell'SDK che modificano o eliminano un cliente (vedi run_sdk)
+CLIENT_WRITE_CALLS = ("modify_client", "delete_client")
+
+
+def invalidate_client(client_id, deleted=False):
+    """Segnala una scrittura su un cliente: ei_code e PEC si rileggono prima del prossimo uso"""
+    client_cache.invalidate(client_id)
+    invalidate_store("clients", deleted_id=client_id if deleted else None)
+
+
+async def get_client_by_id(client_id):
+    """Recupera dati cliente per ID (con cache TTL condivisa)"""
+    cached = client_cache.get(client_id)
+    if cached is not None:
+        return cached
     try:
-        response = clients_api.get_client(company_id=COMPANY_ID, client_id=client_id)
-        return response.data.to_dict()
+        response = await run_sdk(clients_api.get_client, company_id=current_company().id, client_id=client_id)
+        client = to_plain(response.data)
     except:
         return None
+    client_cache.set(client_id, client)
+    return client
 
 
-def get_ei_code_for_client(client_id):
+async def get_ei_code_for_client(client_id):
     """Recupera il codice univoco SDI dall'anagrafica cliente.
     
     Logica:
@@ -83,31 +1894,35 @@ def get_ei_code_for_client(client_id):
     - Fallback → '0000000'
     """
     try:
-        client = get_client_by_id(client_id)
-        if client:
-            ei_code = (client.get('ei_code') or '').strip()
-            if ei_code:
-                return ei_code
-            # Se ha PEC, il codice univoco può essere 0000000
-            pec = (client.get('certified_email') or '').strip()
-            if pec:
-                return '0000000'
-        return '0000000'
+        return ei_code_of(await get_client_by_id(client_id))
     except:
         return '0000000'
 
 
-def build_entity_from_client(client_id, client_data=None):
+def ei_code_of(client):
+    """Codice univoco SDI di un'anagrafica cliente già letta (vedi get_ei_code_for_client)"""
+    if client:
+        ei_code = (client.get('ei_code') or '').strip()
+        if ei_code:
+            return ei_code
+        # Se ha PEC, il codice univoco può essere 0000000
+        pec = (client.get('certified_email') or '').strip()
+        if pec:
+            return '0000000'
+    return '0000000'
+
+
+async def build_entity_from_client(client_id, client_data=None):
     """Costruisce l'oggetto entity completo per la fattura, incluso ei_code.
     
     Centralizza la logica di costruzione entity per create e duplicate.
     """
     if not client_data:
-        client_data = get_client_by_id(client_id)
+        client_data = await get_client_by_id(client_id)
     if not client_data:
         return None
 
-    ei_code = get_ei_code_for_client(client_id)
+    ei_code = ei_code_of(client_data)
 
     entity = {
         "id": client_id,
@@ -130,13 +1945,138 @@ def build_entity_from_client(client_id, client_data=None):
     return entity
 
 
-def get_payment_methods():
+def vat_of_rate(vat_rate, vat_types):
+    """Aliquota IVA di una riga per percentuale: il tipo IVA attivo dell'azienda con quel
+    valore (prima quelli senza natura e-fattura), altrimenti l'id 0 come in passato"""
+    matches = [v for v in vat_types if v.get("value") == vat_rate and not v.get("is_disabled")]
+    if not matches:
+        return {"id": 0, "value": vat_rate}
+    vat_type = min(matches, key=lambda v: (bool(v.get("ei_type")), v.get("id") or 0))
+    return {"id": vat_type.get("id"), "value": vat_rate}
+
+
+def items_from_spec(items_data, vat_types=()):
+    """Converte gli articoli in input (name, qty, net_price, vat_rate...) in items_list.
+
+    vat_types è l'elenco dei tipi IVA dell'azienda (get_cached_settings).
+    """
+    items_list = []
+    for item in items_data:
+        vat_rate = item.get("vat_rate", 22)
+        items_list.append({
+            "name": item["name"],
+            "description": item.get("description", ""),
+            "qty": item["qty"],
+            "net_price": item["net_price"],
+            "vat": vat_of_rate(vat_rate, vat_types)
+        })
+    return items_list
+
+
+def duplicate_items(orig, desc_replace=None):
+    """Copia righe e oggetto di una fattura applicando l'eventuale sostituzione di testo"""
+    desc_replace = desc_replace or {}
+    replace = desc_replace.get("old") and desc_replace.get("new")
+    items_list = []
+    for i in orig.get("items_list", []):
+        name = i.get("name", "")
+        desc = i.get("description", "")
+        if replace:
+            name = name.replace(desc_replace["old"], desc_replace["new"])
+            desc = desc.replace(desc_replace["old"], desc_replace["new"])
+        items_list.append({
+            "name": name,
+            "description": desc,
+            "qty": i.get("qty"),
+            "net_price": i.get("net_price"),
+            "vat": {"id": 0, "value": i.get("vat", {}).get("value", 22)}
+        })
+
+    visible_subject = orig.get("visible_subject", "")
+    if replace:
+        visible_subject = visible_subject.replace(desc_replace["old"], desc_replace["new"])
+    return items_list, visible_subject
+
+
+def payment_days_of(orig):
+    """Giorni di pagamento della prima rata di una fattura (default 30)"""
+    orig_payments = orig.get("payments_list", [{}])
+    return orig_payments[0].get("payment_terms", {}).get("days", 30) if orig_payments else 30
+
+
+def build_invoice_body(entity, items_list, date_str, payment_days, visible_subject=""):
+    """Costruisce il body per creare una fattura bozza.
+
+    Restituisce (body, totale lordo, data di scadenza).
+    """
+    invoice_date = datetime.strptime(date_str, "%Y-%m-%d")
+    due_date = invoice_date + timedelta(days=payment_days)
+    total_gross = sum(i["qty"] * i["net_price"] * (1 + i["vat"]["value"]/100) for i in items_list)
+
+    body = {
+        "data": {
+            "type": "invoice",
+            "e_invoice": True,
+            "ei_data": {"payment_method": "MP05"},
+            "entity": entity,
+            "date": date_str,
+            "visible_subject": visible_subject,
+            "items_list": items_list,
+            "payments_list": [{
+                "amount": round(total_gross, 2),
+                "due_date": due_date.strftime("%Y-%m-%d"),
+                "status": "not_paid",
+                "payment_terms": {"days": payment_days, "type": "standard"}
+            }]
+        }
+    }
+    return body, total_gross, due_date
+
+
+async def get_cached_settings(kind):
+    """Elenco impostazioni dell'azienda con cache TTL.
+
+    kind: 'payment_methods', 'payment_accounts' o 'vat_types'. Cambiano
+    raramente, quindi vengono scaricati al primo uso e poi ogni SETTINGS_CACHE_TTL.
+    """
+    cached = settings_cache.get(kind)
+    if cached is not None:
+        return cached
+    list_func = getattr(info_api, f"list_{kind}")
+    response = await run_sdk(list_func, company_id=current_company().id, fieldset="detailed")
+    items = [to_plain(item) for item in (response.data or [])]
+    settings_cache.set(kind, items)
+    return items
+
+
+async def get_payment_method(payment_method_id):
+    """Recupera un metodo di pagamento dalla cache, con fallback sull'API"""
+    for method in await get_cached_settings("payment_methods"):
+        if method.get("id") == payment_method_id:
+            return method
+    response = await run_sdk(settings_api.get_payment_method,
+        company_id=current_company().id,
+        payment_method_id=payment_method_id
+    )
+    return to_plain(response.data)
+
+
+async def get_payment_account(account):
+    """Conto di pagamento indicato da un metodo di pagamento (oggetto o id), dalla cache impostazioni"""
+    account_id = account.get("id") if isinstance(account, dict) else account
+    if account_id is None:
+        return None
+    for cached in await get_cached_settings("payment_accounts"):
+        if cached.get("id") == account_id:
+            return {"id": account_id, "name": cached.get("name")}
+    return {"id": account_id}
+
+
+async def get_payment_methods():
     """Recupera i metodi di pagamento disponibili"""
     try:
-        response = settings_api.list_payment_methods(company_id=COMPANY_ID)
         methods = []
-        for method in (response.data or []):
-            method_data = method.to_dict()
+        for method_data in await get_cached_settings("payment_methods"):
             methods.append({
                 "id": method_data.get("id"),
                 "name": method_data.get("name"),
@@ -148,26 +2088,17 @@ def get_payment_methods():
         return []
 
 
-def add_payment_to_invoice(document_id, amount, payment_date, payment_method_id):
+async def add_payment_to_invoice(document_id, amount, payment_date, payment_method_id):
     """Aggiunge un pagamento a una fattura esistente"""
     try:
-        # Ottieni i dettagli della fattura
-        response = issued_api.get_issued_document(
-            company_id=COMPANY_ID,
-            document_id=document_id,
-            fieldset="detailed"
-        )
-        invoice_data = response.data.to_dict()
+        # Ottieni i dettagli della fattura (dalla cache documenti se non è cambiata)
+        invoice_data = await get_document_by_id(document_id)
 
-        # Recupera il metodo di pagamento
-        payment_method_response = settings_api.get_payment_method(
-            company_id=COMPANY_ID,
-            payment_method_id=payment_method_id
-        )
-        payment_method = payment_method_response.data.to_dict()
+        # Recupera il metodo di pagamento (dalla cache impostazioni)
+        payment_method = await get_payment_method(payment_method_id)
 
-        # Recupera il conto di pagamento associato al metodo
-        payment_account_id = payment_method.get("default_payment_account")
+        # Recupera il conto di pagamento associato al metodo (dalla cache impostazioni)
+        payment_account = await get_payment_account(payment_method.get("default_payment_account"))
 
         # Aggiorna la fattura aggiungendo il pagamento
         payments_list = invoice_data.get("payments_list", [])
@@ -194,7 +2125,7 @@ def add_payment_to_invoice(document_id, amount, payment_date, payment_method_id)
                         "paid_date": payment_date,
                         "status": "IssuedDocumentStatus.paid" if abs(amount - total_amount) < 0.01 else "IssuedDocumentStatus.not_paid",  # rimane non pagato se non è il totale
                         "payment_terms": payment_dict.get("payment_terms", {}),
-                        "payment_account_id": payment_account_id
+                        "payment_account": payment_account
                     }
                     
                     # Creiamo un nuovo pagamento per la differenza se non è il pagamento completo
@@ -209,7 +2140,7 @@ def add_payment_to_invoice(document_id, amount, payment_date, payment_method_id)
                             "due_date": original_due_date,
                             "status": "IssuedDocumentStatus.not_paid",
                             "payment_terms": payment_dict.get("payment_terms", {}),
-                            "payment_account_id": payment_account_id
+                            "payment_account": payment_account
                         }
                         
                         updated_payments.append(updated_payment)
@@ -223,7 +2154,7 @@ def add_payment_to_invoice(document_id, amount, payment_date, payment_method_id)
                             "paid_date": payment_date,
                             "status": "IssuedDocumentStatus.paid",
                             "payment_terms": payment_dict.get("payment_terms", {}),
-                            "payment_account_id": payment_account_id
+                            "payment_account": payment_account
                         }
                         updated_payments.append(paid_payment)
                     
@@ -249,40 +2180,1009 @@ def add_payment_to_invoice(document_id, amount, payment_date, payment_method_id)
                 "paid_date": payment_date,
                 "status": status,
                 "payment_terms": {"days": 0, "type": "standard"},
-                "payment_account_id": payment_account_id
+                "payment_account": payment_account
             }
             updated_payments.append(new_payment)
 
-        # Aggiorniamo la fattura con i nuovi pagamenti
-        update_data = {
-            "data": {
-                "payments_list": updated_payments
-            }
+        # Aggiorniamo la fattura con i nuovi pagamenti
+        update_data = {
+            "data": {
+                "payments_list": updated_payments
+            }
+        }
+
+        response = await run_sdk(issued_api.modify_issued_document,
+            company_id=current_company().id,
+            document_id=document_id,
+            modify_issued_document_request=update_data
+        )
+        invalidate_document(document_id)
+        invalidate_store("issued:invoice")
+
+        return {"success": True, "message": f"Pagamento di €{amount} aggiunto alla fattura {document_id}"}
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+
+async def reconcile_payments(payments, default_payment_method_id=None):
+    """Registra in blocco una lista di pagamenti (riconciliazione bancaria).
+
+    Ogni voce indica la fattura per document_id oppure per number (+ year e
+    numeration opzionali). Senza year si cerca la fattura con quel numero
+    nell'anno del pagamento, datata non oltre il pagamento, e altrimenti
+    nell'anno precedente: un pagamento di gennaio salda spesso una fattura di
+    dicembre. Le fatture diverse vengono aggiornate in parallelo; più
+    pagamenti sulla stessa fattura sono applicati in sequenza, nell'ordine
+    della lista. Una voce con data o anno non validi fallisce da sola, con
+    il proprio errore, senza fermare le altre.
+    """
+    results = [None] * len(payments)
+
+    def entry_error(p):
+        """Errore di formato di una voce, o None"""
+        if p.get("payment_date"):
+            try:
+                datetime.strptime(str(p["payment_date"]), "%Y-%m-%d")
+            except ValueError:
+                return f"Data del pagamento non valida: {p['payment_date']!r} (usare AAAA-MM-GG)"
+        if p.get("year"):
+            try:
+                int(p["year"])
+            except (TypeError, ValueError):
+                return f"Anno della fattura non valido: {p['year']!r}"
+        return None
+
+    entries = []
+    for index, p in enumerate(payments):
+        error = entry_error(p)
+        if error:
+            results[index] = {"index": index, "amount": p.get("amount"), "payment_date": p.get("payment_date"),
+                              "success": False, "error": error}
+        else:
+            entries.append((index, p))
+
+    def candidate_years(p):
+        if p.get("year"):
+            return [int(p["year"])]
+        year = int(str(p.get("payment_date") or "")[:4] or datetime.now().year)
+        return [year, year - 1]
+
+    # Risolve i numeri fattura in ID usando gli elenchi annuali (mirror locale)
+    years = set()
+    for _, p in entries:
+        if not p.get("document_id") and p.get("number"):
+            years.update(candidate_years(p))
+    by_number = {}
+    yearly = await asyncio.gather(*(load_issued_documents("invoice", *period_bounds(y)) for y in years))
+    for docs in yearly:
+        for d in docs:
+            key = (int(str(d.get("date", ""))[:4]), d.get("number"), d.get("numeration") or "")
+            by_number.setdefault(key, []).append((d.get("id"), str(d.get("date", ""))))
+
+    def find_invoice(p):
+        """ID delle fatture con il numero indicato, nel primo anno candidato che ne ha"""
+        payment_date = str(p.get("payment_date") or "")
+        for year in candidate_years(p):
+            found = by_number.get((year, p.get("number"), p.get("numeration") or ""), [])
+            if not p.get("year") and payment_date:
+                found = [(i, date) for i, date in found if date <= payment_date]
+            if found:
+                return [i for i, _ in found]
+        return []
+
+    groups = {}
+    for index, p in entries:
+        item = {"index": index, "amount": p.get("amount"), "payment_date": p.get("payment_date")}
+        document_id = p.get("document_id")
+        if not document_id and p.get("number"):
+            item["number"] = p.get("number")
+            ids = find_invoice(p)
+            if len(ids) == 1:
+                document_id = ids[0]
+            else:
+                period = " o del ".join(str(y) for y in candidate_years(p))
+                results[index] = {**item, "success": False,
+                                  "error": f"Fattura n. {p.get('number')} del {period} " + ("non trovata" if not ids else "ambigua")}
+                continue
+        payment_method_id = p.get("payment_method_id") or default_payment_method_id
+        if not document_id or p.get("amount") is None or not p.get("payment_date") or not payment_method_id:
+            results[index] = {**item, "success": False,
+                              "error": "Indicare document_id o number, amount, payment_date e payment_method_id"}
+            continue
+        item["document_id"] = document_id
+        groups.setdefault(document_id, []).append((item, payment_method_id))
+
+    async def apply_group(entries):
+        for item, payment_method_id in entries:
+            outcome = await add_payment_to_invoice(item["document_id"], item["amount"], item["payment_date"], payment_method_id)
+            results[item["index"]] = {**item, **outcome}
+
+    await run_bounded(apply_group, list(groups.values()))
+
+    succeeded = sum(1 for r in results if r.get("success"))
+    return {
+        "total": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "results": results
+    }
+
+
+async def create_invoices_bulk(invoices=None, duplicate=None):
+    """Crea in blocco fatture bozza da una lista di specifiche o duplicando un mese.
+
+    invoices: lista di specifiche come create_invoice (client_id, items, date,
+    payment_days, visible_subject).
+    duplicate: {year, month, query, new_date, payment_days, description_replace}
+    duplica tutte le fatture del mese indicato (filtrate per query).
+
+    Le anagrafiche clienti vengono caricate in un solo passaggio, i body sono
+    costruiti localmente e le creazioni inviate in parallelo. Le fatture con
+    date diverse vengono create in ordine di data, così la numerazione
+    assegnata da Fatture in Cloud resta coerente con le date.
+    """
+    today = datetime.now().strftime("%Y-%m-%d")
+    jobs = []
+    if duplicate:
+        # Un filtro senza testo utile duplicherebbe l'intero mese: meglio fermarsi
+        check_query(duplicate.get("query"))
+        year = duplicate["year"]
+        month = duplicate["month"]
+        for orig in await load_issued_documents("invoice", *period_bounds(year, month), query=duplicate.get("query")):
+            items_list, visible_subject = duplicate_items(orig, duplicate.get("description_replace"))
+            payment_days = duplicate.get("payment_days")
+            jobs.append({
+                "client_id": (orig.get("entity") or {}).get("id"),
+                "entity": orig.get("entity") or {},
+                "items_list": items_list,
+                "date": duplicate.get("new_date") or today,
+                "payment_days": payment_days if payment_days is not None else payment_days_of(orig),
+                "visible_subject": visible_subject,
+                "source_invoice": orig.get("number"),
+            })
+    for spec in (invoices or []):
+        jobs.append({
+            "client_id": spec.get("client_id"),
+            "items": spec.get("items") or [],
+            "date": spec.get("date") or today,
+            "payment_days": spec.get("payment_days", 30),
+            "visible_subject": spec.get("visible_subject", ""),
+        })
+
+    # Solo i clienti usati, letti in blocco e tenuti per questa chiamata
+    clients = await load_clients_by_id(job["client_id"] for job in jobs)
+    vat_types = await get_cached_settings("vat_types") if any(job.get("items") for job in jobs) else []
+
+    results = [None] * len(jobs)
+
+    async def create(index):
+        job = jobs[index]
+        item = {"index": index, "client_id": job["client_id"], "date": job["date"]}
+        if "source_invoice" in job:
+            item["source_invoice"] = job["source_invoice"]
+        try:
+            client_data = None
+            if job["client_id"]:
+                client_data = clients.get(job["client_id"]) or await get_client_by_id(job["client_id"])
+            if client_data:
+                entity = await build_entity_from_client(job["client_id"], client_data)
+            elif "entity" in job:
+                entity = job["entity"]
+            else:
+                raise ValueError(f"Cliente con ID {job['client_id']} non trovato")
+            items_list = job.get("items_list") or items_from_spec(job["items"], vat_types)
+            if not items_list:
+                raise ValueError("Nessun articolo indicato")
+            body, total_gross, due_date = build_invoice_body(
+                entity, items_list, job["date"], job["payment_days"], job["visible_subject"])
+            response = await run_sdk(issued_api.create_issued_document,
+                company_id=current_company().id,
+                create_issued_document_request=body
+            )
+            d = response.data.to_dict()
+            results[index] = {
+                **item,
+                "success": True,
+                "id": d.get("id"),
+                "number": d.get("number"),
+                "client": entity.get("name"),
+                "ei_code": entity.get("ei_code", "N/A"),
+                "due_date": due_date.strftime("%Y-%m-%d"),
+                "total": round(total_gross, 2),
+            }
+        except Exception as e:
+            results[index] = {**item, "success": False, "error": str(e)}
+
+    # Date crescenti in sequenza, fatture della stessa data in parallelo
+    by_date = {}
+    for index, job in enumerate(jobs):
+        by_date.setdefault(job["date"], []).append(index)
+    for date_str in sorted(by_date):
+        await run_bounded(create, by_date[date_str])
+    if jobs:
+        invalidate_store("issued:invoice")
+
+    succeeded = sum(1 for r in results if r.get("success"))
+    return {
+        "total": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "status": "bozza",
+        "results": results
+    }
+
+
+async def send_to_sdi_bulk(document_ids, wait=True, max_wait=120, verify_xml=True):
+    """Invia in blocco più fatture allo SDI e ne segue lo stato.
+
+    1. Pre-validazione in parallelo: stato e-invoice inviabile e, se richiesto,
+       verifica dell'XML (verify_e_invoice_xml).
+    2. Invio delle fatture valide, al massimo SDI_CONCURRENCY alla volta.
+    3. Se wait, interroga ei_status con attesa crescente (2s, x1.5, max 30s)
+       finché ogni fattura arriva a uno stato finale (EI_FINAL_STATUSES) o
+       scade max_wait: "sent" e gli stati intermedi restano in attesa.
+    """
+    document_ids = list(dict.fromkeys(document_ids))
+    reports = {doc_id: {"document_id": doc_id} for doc_id in document_ids}
+
+    async def validate(doc_id):
+        report = reports[doc_id]
+        try:
+            check = await run_sdk(issued_api.get_issued_document,
+                company_id=current_company().id,
+                document_id=doc_id,
+                fields=DOCUMENT_STATUS_FIELDS
+            )
+            d = check.data.to_dict()
+            report.update(number=d.get("number"), client=(d.get("entity") or {}).get("name"))
+            current_status = d.get("ei_status")
+            if current_status and current_status not in EI_SENDABLE_STATUSES:
+                report.update(stage="validation", success=False, ei_status=current_status,
+                              error=f"Fattura già inviata o in elaborazione. Stato attuale: {current_status}")
+                return False
+            if verify_xml:
+                await run_sdk(einvoice_api.verify_e_invoice_xml, company_id=current_company().id, document_id=doc_id)
+            return True
+        except Exception as e:
+            report.update(stage="validation", success=False, error=str(e))
+            return False
+
+    async def send(doc_id):
+        report = reports[doc_id]
+        try:
+            await run_sdk(einvoice_api.send_e_invoice,
+                company_id=current_company().id,
+                document_id=doc_id,
+                send_e_invoice_request={"data": {"withholding_tax_causal": None}}
+            )
+            invalidate_document(doc_id)
+            report.update(success=True, ei_status="sent")
+            return True
+        except Exception as e:
+            report.update(stage="send", success=False, error=str(e))
+            return False
+
+    async def poll(doc_id):
+        try:
+            response = await run_sdk(issued_api.get_issued_document,
+                company_id=current_company().id,
+                document_id=doc_id,
+                fields="id,ei_status",
+                fresh=True
+            )
+            reports[doc_id]["ei_status"] = response.data.to_dict().get("ei_status")
+        except Exception:
+            # Un errore di lettura non interrompe il monitoraggio: si riprova al giro successivo
+            pass
+
+    valid = await run_bounded(validate, document_ids)
+    to_send = [doc_id for doc_id, ok in zip(document_ids, valid) if ok]
+    sent_ok = await run_bounded(send, to_send, limit=SDI_CONCURRENCY)
+    sent = [doc_id for doc_id, ok in zip(to_send, sent_ok) if ok]
+    if sent:
+        invalidate_store("issued:invoice")
+
+    pending = list(sent)
+    if wait and pending:
+        deadline = time.monotonic() + max_wait
+        delay = 2.0
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(delay, remaining))
+            await run_bounded(poll, pending)
+            pending = [doc_id for doc_id in pending if reports[doc_id].get("ei_status") not in EI_FINAL_STATUSES]
+            delay = min(delay * 1.5, 30.0)
+        if len(pending) != len(sent):
+            invalidate_store("issued:invoice")
+
+    by_status = {}
+    for report in reports.values():
+        if report.get("success"):
+            report["ei_status_description"] = EI_STATUS_DESCRIPTIONS.get(report.get("ei_status"), report.get("ei_status"))
+            by_status[report.get("ei_status")] = by_status.get(report.get("ei_status"), 0) + 1
+
+    return {
+        "total": len(document_ids),
+        "sent": len(sent),
+        "failed": len(document_ids) - len(sent),
+        "still_processing": len(pending) if wait else None,
+        "by_status": by_status,
+        "results": [reports[doc_id] for doc_id in document_ids]
+    }
+
+
+async def compute_situation(year, due_limit=10, top_clients=10, issued_fields=None, received_fields=None,
+                            on_issued=None):
+    """Situazione dell'anno calcolata in un solo passaggio sui documenti.
+
+    Fatture emesse e spese vengono lette in streaming: si tengono solo le
+    somme correnti, i totali per mese e per cliente e un heap limitato a
+    due_limit voci per le prossime scadenze, così la memoria non dipende
+    dal numero di documenti. issued_fields e received_fields limitano i
+    campi letti dall'API; on_issued, se indicata, riceve ogni fattura letta
+    (get_portfolio_report la usa per le fatture rifiutate dallo SDI).
+    """
+    date_from, date_to = period_bounds(year)
+    today = datetime.now().strftime("%Y-%m-%d")
+    months = [{"mese": m, "fatturato": 0, "incassato": 0, "costi": 0} for m in range(1, 13)]
+    by_client = {}
+    # Max-heap (chiave negata) delle scadenze non pagate: la radice è la più lontana
+    due_heap = []
+    totals = {"fatturato": 0, "incassato": 0, "scaduto": 0, "costi": 0, "fatture": 0, "spese": 0}
+
+    def month_of(d):
+        date_str = str(d.get("date") or "")
+        return months[int(date_str[5:7]) - 1] if len(date_str) >= 7 and date_str[5:7].isdigit() else None
+
+    async def aggregate_issued():
+        seq = 0
+        async for d in iter_issued_documents("invoice", date_from, date_to, fields=issued_fields):
+            if on_issued:
+                on_issued(d)
+            total = get_total_from_doc(d)
+            entity = d.get("entity") or {}
+            month = month_of(d)
+            client = by_client.setdefault(entity.get("id") or entity.get("name"), {
+                "client_id": entity.get("id"), "client": entity.get("name", ""),
+                "fatture": 0, "fatturato": 0, "incassato": 0
+            })
+            totals["fatturato"] += total
+            totals["fatture"] += 1
+            client["fatturato"] += total
+            client["fatture"] += 1
+            if month:
+                month["fatturato"] += total
+
+            for p in d.get("payments_list") or []:
+                status = str(p.get("status", ""))
+                amount = p.get("amount", 0)
+                if status == "paid":
+                    totals["incassato"] += amount
+                    client["incassato"] += amount
+                    if month:
+                        month["incassato"] += amount
+                elif status == "not_paid":
+                    due_date = str(p.get("due_date", ""))
+                    if due_date and due_date < today:
+                        totals["scaduto"] += amount
+                    key = datetime.strptime(due_date, "%Y-%m-%d").toordinal() if due_date else 0
+                    entry = (-key, -seq, {
+                        "number": d.get("number"),
+                        "client": entity.get("name", ""),
+                        "amount": amount,
+                        "due_date": due_date
+                    })
+                    seq += 1
+                    if len(due_heap) < due_limit:
+                        heapq.heappush(due_heap, entry)
+                    else:
+                        heapq.heappushpop(due_heap, entry)
+
+    async def aggregate_received():
+        async for d in iter_received_documents("expense", date_from, date_to, fields=received_fields):
+            total = d.get("amount_gross") or d.get("amount_net") or 0
+            totals["costi"] += total
+            totals["spese"] += 1
+            month = month_of(d)
+            if month:
+                month["costi"] += total
+
+    await asyncio.gather(aggregate_issued(), aggregate_received())
+
+    for month in months:
+        for k in ("fatturato", "incassato", "costi"):
+            month[k] = round(month[k], 2)
+        month["margine"] = round(month["fatturato"] - month["costi"], 2)
+    clients = heapq.nlargest(top_clients, by_client.values(), key=lambda c: c["fatturato"])
+    for client in clients:
+        client["da_incassare"] = round(client["fatturato"] - client["incassato"], 2)
+        client["fatturato"] = round(client["fatturato"], 2)
+        client["incassato"] = round(client["incassato"], 2)
+
+    return {
+        "anno": year,
+        "fatturato_totale": round(totals["fatturato"], 2),
+        "incassato": round(totals["incassato"], 2),
+        "da_incassare": round(totals["fatturato"] - totals["incassato"], 2),
+        "scaduto": round(totals["scaduto"], 2),
+        "costi_totali": round(totals["costi"], 2),
+        "margine_lordo": round(totals["fatturato"] - totals["costi"], 2),
+        "numero_fatture": totals["fatture"],
+        "numero_spese": totals["spese"],
+        "prossime_scadenze": [entry[2] for entry in sorted(due_heap, reverse=True)],
+        "per_mese": months,
+        "clienti_principali": clients,
+        "numero_clienti": len(by_client)
+    }
+
+
+# Totali di compute_situation riportati per azienda da get_portfolio_report
+PORTFOLIO_TOTALS = ("fatturato_totale", "incassato", "da_incassare", "scaduto", "costi_totali",
+                    "margine_lordo", "numero_fatture", "numero_spese")
+
+
+async def compute_company_summary(year, rejected_limit=10):
+    """Totali dell'anno dell'azienda corrente per get_portfolio_report.
+
+    I totali sono quelli di compute_situation (stesso calcolo di
+    get_situation), letti con i soli campi necessari; in più si tengono le
+    fatture rifiutate o scartate dallo SDI (le prime rejected_limit, con il
+    conteggio per stato).
+    """
+    rejected_by_status = collections.Counter()
+    rejected = []
+
+    def collect_rejected(d):
+        ei_status = d.get("ei_status")
+        if ei_status in EI_REJECTED_STATUSES:
+            rejected_by_status[ei_status] += 1
+            if len(rejected) < rejected_limit:
+                rejected.append({
+                    "id": d.get("id"),
+                    "number": f"{d.get('number')}{d.get('numeration') or ''}",
+                    "date": str(d.get("date", "")),
+                    "client": (d.get("entity") or {}).get("name"),
+                    "ei_status": ei_status,
+                    "ei_status_description": EI_STATUS_DESCRIPTIONS.get(ei_status, ei_status)
+                })
+
+    situation = await compute_situation(year, due_limit=0, top_clients=0,
+                                        issued_fields=PORTFOLIO_ISSUED_FIELDS,
+                                        received_fields=PORTFOLIO_RECEIVED_FIELDS,
+                                        on_issued=collect_rejected)
+    return {
+        **{key: situation[key] for key in PORTFOLIO_TOTALS},
+        "rifiutate_sdi": sum(rejected_by_status.values()),
+        "rifiutate_sdi_per_stato": dict(rejected_by_status),
+        "fatture_rifiutate": rejected
+    }
+
+
+async def compute_portfolio(year, company_ids=None, rejected_limit=10):
+    """Situazione dell'anno su più aziende: totali per azienda e complessivi.
+
+    Le aziende vengono elaborate in parallelo (al massimo PORTFOLIO_CONCURRENCY
+    alla volta), ognuna con i propri client, limitatore e mirror; il pool di
+    thread dell'SDK limita comunque le chiamate HTTP complessive. L'errore di
+    un'azienda non interrompe le altre: viene riportato in errori.
+    """
+    company_ids = list(dict.fromkeys(int(c) for c in company_ids or COMPANIES))
+
+    async def summarize(company_id):
+        entry = {"company_id": company_id, "name": COMPANIES.get(company_id, (None, None))[0]}
+        try:
+            company = get_company(company_id)
+        except KeyError:
+            return {**entry, "success": False, "error": "Azienda non configurata"}
+        token = _current_company.set(company)
+        try:
+            return {**entry, "success": True, **await compute_company_summary(year, rejected_limit)}
+        except Exception as e:
+            if isinstance(e, ApiException) and e.status in (401, 403):
+                error = "Token non valido o senza accesso all'azienda"
+            elif isinstance(e, ApiException) and e.status == 429:
+                error = "Limite di richieste API raggiunto anche dopo i tentativi automatici"
+            else:
+                error = str(e)
+            return {**entry, "success": False, "error": error}
+        finally:
+            _current_company.reset(token)
+
+    results = await run_bounded(summarize, company_ids, limit=PORTFOLIO_CONCURRENCY)
+    companies, errors = [], []
+    for result in results:
+        (companies if result.pop("success") else errors).append(result)
+
+    totals = {k: 0 for k in PORTFOLIO_TOTALS + ("rifiutate_sdi",)}
+    rejected_by_status = collections.Counter()
+    for company in companies:
+        for k in totals:
+            totals[k] += company[k]
+        rejected_by_status.update(company["rifiutate_sdi_per_stato"])
+    totals = {k: round(v, 2) for k, v in totals.items()}
+    totals["rifiutate_sdi_per_stato"] = dict(rejected_by_status)
+
+    return {
+        "anno": year,
+        "aziende": len(company_ids),
+        "aziende_elaborate": len(companies),
+        "aziende_in_errore": len(errors),
+        "totali": totals,
+        "per_azienda": sorted(companies, key=lambda c: c["fatturato_totale"], reverse=True),
+        "errori": errors
+    }
+
+
+def format_range(first, last):
+    return str(first) if first == last else f"{first}-{last}"
+
+
+def analyze_numbering(numbers, max_items=50):
+    """Verifica una numerazione: (numero, data, id) in ordine di numero.
+
+    I numeri mancanti sono riportati come intervalli compressi; si segnalano
+    anche i numeri duplicati e le date non crescenti rispetto al numero
+    precedente. Gli elenchi sono limitati a max_items voci.
+    """
+    gaps, duplicates, inversions = [], [], []
+    missing_count = gap_count = duplicate_count = inversion_count = 0
+    first = previous = None
+    count = 0
+    for number, date, doc_id in numbers:
+        count += 1
+        if previous is None:
+            first = number
+            if number != 1:
+                missing_count += number - 1
+                gap_count += 1
+                gaps.append({
+                    "type": "start",
+                    "missing": format_range(1, number - 1),
+                    "missing_count": number - 1,
+                    "note": f"La numerazione parte da {number} invece che da 1"
+                })
+        else:
+            prev_number, prev_date, prev_id = previous
+            if number == prev_number:
+                duplicate_count += 1
+                if len(duplicates) < max_items:
+                    duplicates.append({"number": number, "ids": [prev_id, doc_id], "dates": [prev_date, date]})
+            elif number - prev_number > 1:
+                missing = number - prev_number - 1
+                missing_count += missing
+                gap_count += 1
+                if len(gaps) < max_items:
+                    missing_range = format_range(prev_number + 1, number - 1)
+                    gaps.append({
+                        "type": "gap",
+                        "after": prev_number,
+                        "before": number,
+                        "missing": missing_range,
+                        "missing_count": missing,
+                        "note": (f"Manca il numero {missing_range}" if missing == 1 else f"Mancano {missing} numeri ({missing_range})")
+                                + f" tra {prev_number} e {number}"
+                    })
+            if date and prev_date and date < prev_date:
+                inversion_count += 1
+                if len(inversions) < max_items:
+                    inversions.append({
+                        "number": number, "date": date,
+                        "previous_number": prev_number, "previous_date": prev_date,
+                        "note": f"Il n. {number} ha data {date}, precedente al n. {prev_number} del {prev_date}"
+                    })
+        previous = (number, date, doc_id)
+
+    return {
+        "total": count,
+        "first_number": first,
+        "last_number": previous[0] if previous else None,
+        "continuous": not missing_count and not duplicate_count,
+        "dates_in_order": not inversion_count,
+        "missing_count": missing_count,
+        "gap_count": gap_count,
+        "gaps": gaps,
+        "duplicate_count": duplicate_count,
+        "duplicates": duplicates,
+        "date_inversion_count": inversion_count,
+        "date_inversions": inversions
+    }
+
+
+async def check_numbering(year, doc_type="invoice", numeration=None):
+    """Controllo della numerazione di un anno per ogni serie (numeration) di un tipo di documento.
+
+    Con il mirror i numeri arrivano già ordinati dall'indice su
+    (tipo, numerazione, numero); altrimenti si scaricano i soli campi
+    necessari e si ordinano in memoria.
+    """
+    date_from, date_to = period_bounds(year)
+    store = get_store()
+    if store is not None:
+        await sync_store(f"issued:{doc_type}", issued_api.list_issued_documents, type=doc_type)
+        rows = [(r["numeration"] or "", r["number"], r["date"], r["id"])
+                for r in await run_store(store.numbering, current_company().id, doc_type, date_from, date_to, numeration)]
+    else:
+        rows = [(d.get("numeration") or "", d.get("number"), str(d.get("date") or ""), d.get("id"))
+                async for d in iter_issued_documents(doc_type, date_from, date_to, fields=NUMERATION_FIELDS)
+                if (d.get("number") or 0) > 0 and (numeration is None or (d.get("numeration") or "") == numeration)]
+        rows.sort(key=lambda r: (r[0], r[1], r[2]))
+
+    series = []
+    for series_name, group in itertools.groupby(rows, key=lambda r: r[0]):
+        series.append({"numeration": series_name, **analyze_numbering((r[1], r[2], r[3]) for r in group)})
+    return series
+
+
+# Documenti che alimentano i report: note di credito incluse, con segno negativo
+REPORT_RESOURCES = ["issued:invoice", "issued:credit_note", "received:expense", "received:passive_credit_note"]
+REPORT_METRICS = ["fatturato_netto", "fatturato_iva", "fatturato", "incassato", "costi_netti", "costi_iva", "costi", "pagato",
+                  "iva_split_payment"]
+# Metrica per aliquota → (sezione del report, campo)
+REPORT_RATE_METRICS = {
+    "imponibile_vendite": ("iva_vendite", "imponibile"),
+    "iva_vendite": ("iva_vendite", "iva"),
+    "imponibile_acquisti": ("iva_acquisti", "imponibile"),
+    "iva_acquisti": ("iva_acquisti", "iva"),
+    "iva_detraibile": ("iva_acquisti", "detraibile"),
+}
+
+
+def month_range(month_from, month_to):
+    """Mesi YYYY-MM da month_from a month_to inclusi"""
+    year, month = int(month_from[:4]), int(month_from[5:7])
+    months = []
+    while f"{year}-{month:02d}" <= month_to:
+        months.append(f"{year}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+async def load_monthly_totals(month_from, month_to):
+    """Totali {mese: {(metrica, aliquota): importo}} tra due mesi YYYY-MM.
+
+    Con il mirror si leggono i totali mensili precalcolati (dopo un
+    allineamento incrementale); senza, si calcolano in streaming dai
+    documenti datati nel periodo, quindi gli incassi di documenti emessi
+    prima dell'intervallo non vengono conteggiati.
+    """
+    totals = collections.defaultdict(lambda: collections.defaultdict(float))
+    store = get_store()
+    if store is not None:
+        await asyncio.gather(*(sync_store(resource, resource_list_func(resource), type=resource.partition(":")[2])
+                               for resource in REPORT_RESOURCES))
+        for row in await run_store(store.rollups, current_company().id, REPORT_RESOURCES, month_from, month_to):
+            totals[row["month"]][(row["metric"], row["rate"])] += row["amount"]
+        return totals
+
+    date_from = f"{month_from}-01"
+    date_to = period_bounds(int(month_to[:4]), int(month_to[5:7]))[1]
+
+    async def add(documents, facts_of):
+        async for d in documents:
+            for month, metric, rate, amount in facts_of(d):
+                if month_from <= month <= month_to:
+                    totals[month][(metric, rate)] += amount
+
+    sources = []
+    for resource in REPORT_RESOURCES:
+        kind, _, doc_type = resource.partition(":")
+        if kind == "issued":
+            sources.append(add(iter_issued_documents(doc_type, date_from, date_to), issued_document_facts))
+        else:
+            sources.append(add(iter_received_documents(doc_type, date_from, date_to), received_document_facts))
+    await asyncio.gather(*sources)
+    return totals
+
+
+def summarize_months(totals, months):
+    """Somma i totali mensili dei mesi indicati nel formato del report"""
+    sums = collections.defaultdict(float)
+    for month in months:
+        for key, amount in totals.get(month, {}).items():
+            sums[key] += amount
+    result = {metric: round(sums.get((metric, ""), 0), 2) for metric in REPORT_METRICS}
+    result["margine"] = round(result["fatturato_netto"] - result["costi_netti"], 2)
+    result["iva_vendite"] = {}
+    result["iva_acquisti"] = {}
+    for (metric, rate), amount in sorted(sums.items(), key=lambda kv: (kv[0][0], float(kv[0][1] or 0))):
+        if metric in REPORT_RATE_METRICS:
+            section, field = REPORT_RATE_METRICS[metric]
+            result[section].setdefault(rate, {})[field] = round(amount, 2)
+    return result
+
+
+def report_buckets(months, group_by):
+    """Suddivide i mesi di un periodo per mese, trimestre o anno: [(etichetta, mesi)]"""
+    buckets = {}
+    for month in months:
+        if group_by == "month":
+            label = month
+        elif group_by == "quarter":
+            label = f"{month[:4]}-Q{(int(month[5:7]) - 1) // 3 + 1}"
+        else:
+            label = month[:4]
+        buckets.setdefault(label, []).append(month)
+    return list(buckets.items())
+
+
+def percent_change(current, previous):
+    return round((current - previous) / abs(previous) * 100, 1) if previous else None
+
+
+async def compute_report(year=None, quarter=None, month=None, date_from=None, date_to=None,
+                         compare_years=0, group_by="total"):
+    """Report di fatturato, incassi, costi, margine e IVA per aliquota su un periodo qualsiasi.
+
+    Il periodo è un anno, un trimestre, un mese o un intervallo di mesi
+    (date_from/date_to, YYYY-MM o YYYY-MM-DD); compare_years aggiunge lo
+    stesso periodo degli anni precedenti. Tutto viene letto in una sola
+    volta dai totali mensili.
+    """
+    if date_from or date_to:
+        year = year or datetime.now().year
+        month_from = (date_from or f"{year}-01")[:7]
+        month_to = (date_to or f"{year}-12")[:7]
+    else:
+        year = year or datetime.now().year
+        if month:
+            month_from = month_to = f"{year}-{month:02d}"
+        elif quarter:
+            month_from, month_to = f"{year}-{quarter * 3 - 2:02d}", f"{year}-{quarter * 3:02d}"
+        else:
+            month_from, month_to = f"{year}-01", f"{year}-12"
+    if month_from > month_to:
+        raise ValueError(f"Intervallo non valido: {month_from} è successivo a {month_to}")
+
+    def shifted(value, years):
+        return f"{int(value[:4]) - years}{value[4:]}"
+
+    periods = [(shifted(month_from, k), shifted(month_to, k)) for k in range(compare_years + 1)]
+    totals = await load_monthly_totals(periods[-1][0], month_to)
+
+    results = []
+    for period_from, period_to in periods:
+        months = month_range(period_from, period_to)
+        entry = {"dal": period_from, "al": period_to, **summarize_months(totals, months)}
+        if group_by != "total":
+            entry["dettaglio"] = [{"periodo": label, **summarize_months(totals, bucket)}
+                                  for label, bucket in report_buckets(months, group_by)]
+        results.append(entry)
+
+    # Variazione percentuale di ogni periodo rispetto allo stesso periodo dell'anno prima
+    for current, previous in zip(results, results[1:]):
+        current["variazione_su_anno_precedente"] = {
+            metric: percent_change(current[metric], previous[metric])
+            for metric in ("fatturato_netto", "incassato", "costi_netti", "margine")
         }
 
-        response = issued_api.modify_issued_document(
-            company_id=COMPANY_ID,
-            document_id=document_id,
-            modify_issued_document_request=update_data
-        )
+    return {"periodi": results, "fonte": "totali mensili del mirror locale" if get_store() is not None else "documenti da API"}
 
-        return {"success": True, "message": f"Pagamento di €{amount} aggiunto alla fattura {document_id}"}
-    except Exception as e:
-        return {"success": False, "error": str(e)}
+
+# Versamento IVA minimo: importi inferiori si sommano al periodo successivo
+VAT_MIN_PAYMENT = 25.82
+# Interessi dovuti sul versamento dai contribuenti trimestrali
+VAT_QUARTERLY_INTEREST = 0.01
+
+
+async def compute_vat_liquidation(year, periodicity="month", period=None, opening_credit=0):
+    """Liquidazione IVA periodica dai totali mensili: IVA vendite meno IVA detraibile sugli acquisti.
+
+    Per ogni mese o trimestre dell'anno riporta imponibile e imposta per
+    aliquota, escluse dal debito le fatture in split payment; il credito
+    di un periodo e i versamenti sotto VAT_MIN_PAYMENT passano al periodo
+    successivo. Con periodicity="quarter" si aggiungono gli interessi dell'1%.
+    Con period si restituisce solo il mese o trimestre indicato (il saldo
+    riportato tiene comunque conto dei periodi precedenti dell'anno).
+    """
+    totals = await load_monthly_totals(f"{year}-01", f"{year}-12")
+    if periodicity == "quarter":
+        periods = [(f"{year}-Q{q}", month_range(f"{year}-{q * 3 - 2:02d}", f"{year}-{q * 3:02d}")) for q in range(1, 5)]
+    else:
+        periods = [(f"{year}-{m:02d}", [f"{year}-{m:02d}"]) for m in range(1, 13)]
+
+    results = []
+    credit = opening_credit
+    carried_debt = 0
+    for label, months in periods:
+        summary = summarize_months(totals, months)
+        output_vat = sum(r.get("iva", 0) for r in summary["iva_vendite"].values())
+        split_payment = summary["iva_split_payment"]
+        deductible = sum(r.get("detraibile", 0) for r in summary["iva_acquisti"].values())
+        balance = output_vat - split_payment - deductible
+        entry = {
+            "periodo": label,
+            "iva_vendite": summary["iva_vendite"],
+            "iva_acquisti": summary["iva_acquisti"],
+            "iva_a_debito": round(output_vat - split_payment, 2),
+            "iva_split_payment": round(split_payment, 2),
+            "iva_detraibile": round(deductible, 2),
+            "saldo_periodo": round(balance, 2),
+            "credito_precedente": round(credit, 2),
+            "debito_precedente": round(carried_debt, 2),
+        }
+        due = balance - credit + carried_debt
+        interest = due * VAT_QUARTERLY_INTEREST if periodicity == "quarter" and due > 0 else 0
+        if due <= 0:
+            credit, carried_debt, payment = -due, 0, 0
+        elif due + interest < VAT_MIN_PAYMENT:
+            credit, carried_debt, payment, interest = 0, due, 0, 0
+        else:
+            credit, carried_debt, payment = 0, 0, due + interest
+        entry.update({
+            "interessi": round(interest, 2),
+            "da_versare": round(payment, 2),
+            "credito_da_riportare": round(credit, 2),
+            "debito_da_riportare": round(carried_debt, 2),
+        })
+        results.append(entry)
+
+    if period:
+        results = [results[period - 1]]
+    return {
+        "anno": year,
+        "periodicita": "trimestrale" if periodicity == "quarter" else "mensile",
+        "periodi": results,
+        "totale_da_versare": round(sum(r["da_versare"] for r in results), 2),
+        "nota": "Calcolo indicativo sulla data dei documenti: verificare registrazioni, detraibilità e acconti con il commercialista"
+    }
+
+
+# Direzione di cassa delle rate aperte: +1 entrata (crediti), -1 uscita (debiti)
+CASH_DIRECTIONS = {
+    "issued:invoice": 1,
+    "issued:credit_note": -1,
+    "received:expense": -1,
+    "received:passive_credit_note": 1,
+}
+# Fasce di anzianità dello scaduto: (giorni di ritardo fino a, etichetta)
+AGING_BUCKETS = [(0, "a scadere"), (30, "1-30 giorni"), (60, "31-60 giorni"), (90, "61-90 giorni"),
+                 (180, "91-180 giorni"), (None, "oltre 180 giorni")]
+
+
+async def load_open_payments(due_to):
+    """Rate non pagate con scadenza fino a due_to e totali per risorsa di quelle successive.
+
+    Con il mirror si interroga l'indice per scadenza delle rate aperte; senza,
+    si scorre lo storico dei documenti scaricando solo i campi necessari.
+    """
+    store = get_store()
+    if store is not None:
+        await asyncio.gather(*(sync_store(resource, resource_list_func(resource), type=resource.partition(":")[2])
+                               for resource in CASH_DIRECTIONS))
+        return await run_store(store.open_payments, current_company().id, list(CASH_DIRECTIONS), due_to)
+
+    rows, later = [], {}
+
+    async def collect(resource, documents):
+        async for d in documents:
+            for due_date, amount, number, entity_id, entity_name in open_payments_of(d):
+                if due_date <= due_to:
+                    rows.append({"resource": resource, "doc_id": d.get("id"), "number": number, "entity_id": entity_id,
+                                 "entity_name": entity_name, "due_date": due_date, "amount": amount})
+                else:
+                    count, total = later.get(resource, (0, 0))
+                    later[resource] = (count + 1, total + amount)
+
+    sources = []
+    for resource in CASH_DIRECTIONS:
+        kind, _, doc_type = resource.partition(":")
+        if kind == "issued":
+            sources.append(collect(resource, iter_issued_documents(doc_type, fields=ISSUED_PAYMENT_FIELDS)))
+        else:
+            sources.append(collect(resource, iter_received_documents(doc_type, fields=RECEIVED_PAYMENT_FIELDS)))
+    await asyncio.gather(*sources)
+    rows.sort(key=lambda r: r["due_date"])
+    return rows, later
+
+
+async def compute_cash_forecast(weeks=12, as_of=None, opening_balance=0, top=10):
+    """Anzianità di crediti e debiti aperti e previsione settimanale di cassa.
+
+    Le rate scadute vengono suddivise per giorni di ritardo (AGING_BUCKETS)
+    e per controparte; quelle a scadere entro l'orizzonte di weeks settimane
+    formano la previsione di entrate, uscite e saldo cumulato a partire da
+    opening_balance.
+    """
+    start = datetime.strptime(as_of, "%Y-%m-%d") if as_of else datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    horizon = (start + timedelta(days=weeks * 7 - 1)).strftime("%Y-%m-%d")
+    rows, later = await load_open_payments(horizon)
+
+    def new_section():
+        return {"totale": 0, "scaduto": 0, "a_scadere": 0, "rate_aperte": 0,
+                "fasce": {label: {"fascia": label, "importo": 0, "rate": 0} for _, label in AGING_BUCKETS},
+                "controparti": {}}
+
+    sections = {1: new_section(), -1: new_section()}
+    forecast = [{
+        "dal": (start + timedelta(days=7 * i)).strftime("%Y-%m-%d"),
+        "al": (start + timedelta(days=7 * i + 6)).strftime("%Y-%m-%d"),
+        "entrate": 0, "uscite": 0
+    } for i in range(weeks)]
+
+    for r in rows:
+        direction = CASH_DIRECTIONS[r["resource"]]
+        section = sections[direction]
+        amount = r["amount"] or 0
+        try:
+            days_late = (start - datetime.strptime(r["due_date"][:10], "%Y-%m-%d")).days
+        except ValueError:
+            days_late = 0
+        section["totale"] += amount
+        section["rate_aperte"] += 1
+        label = next(label for limit, label in AGING_BUCKETS if limit is None or days_late <= limit)
+        section["fasce"][label]["importo"] += amount
+        section["fasce"][label]["rate"] += 1
+        if days_late > 0:
+            section["scaduto"] += amount
+            counterpart = section["controparti"].setdefault(r["entity_id"] or r["entity_name"], {
+                "controparte": r["entity_name"], "importo": 0, "rate": 0, "giorni_ritardo_max": 0
+            })
+            counterpart["importo"] += amount
+            counterpart["rate"] += 1
+            counterpart["giorni_ritardo_max"] = max(counterpart["giorni_ritardo_max"], days_late)
+        else:
+            section["a_scadere"] += amount
+            forecast[-days_late // 7]["entrate" if direction > 0 else "uscite"] += amount
+
+    beyond = {"entrate": 0, "uscite": 0}
+    for resource, (count, amount) in later.items():
+        direction = CASH_DIRECTIONS[resource]
+        section = sections[direction]
+        section["totale"] += amount
+        section["a_scadere"] += amount
+        section["rate_aperte"] += count
+        section["fasce"]["a scadere"]["importo"] += amount
+        section["fasce"]["a scadere"]["rate"] += count
+        beyond["entrate" if direction > 0 else "uscite"] += amount
+
+    balance = opening_balance
+    for week in forecast:
+        week["netto"] = round(week["entrate"] - week["uscite"], 2)
+        balance += week["entrate"] - week["uscite"]
+        week["saldo_cumulato"] = round(balance, 2)
+        week["entrate"] = round(week["entrate"], 2)
+        week["uscite"] = round(week["uscite"], 2)
+
+    def finish(section):
+        counterparts = heapq.nlargest(top, section.pop("controparti").values(), key=lambda c: c["importo"])
+        for c in counterparts:
+            c["importo"] = round(c["importo"], 2)
+        for bucket in section["fasce"].values():
+            bucket["importo"] = round(bucket["importo"], 2)
+        return {
+            **{k: round(v, 2) if isinstance(v, float) else v for k, v in section.items() if k != "fasce"},
+            "fasce": list(section["fasce"].values()),
+            "principali_scaduti": counterparts
+        }
+
+    return {
+        "data_riferimento": start.strftime("%Y-%m-%d"),
+        "settimane": weeks,
+        "crediti": finish(sections[1]),
+        "debiti": finish(sections[-1]),
+        "previsione_settimanale": forecast,
+        "oltre_orizzonte": {k: round(v, 2) for k, v in beyond.items()},
+        "saldo_finale_previsto": round(balance, 2)
+    }
 
 
 @app.list_tools()
 async def list_tools():
-    return [
+    tools = [
         Tool(
             name="list_invoices",
-            description="Lista fatture emesse. Parametri: year (int), month (int opzionale), query (str opzionale)",
+            description="Lista fatture emesse. Parametri: year (int), month (int opzionale), query (str opzionale), limit e cursor (opzionali) per leggere a pagine",
             inputSchema={
                 "type": "object",
                 "properties": {
                     "year": {"type": "integer", "description": "Anno (es. 2024)"},
                     "month": {"type": "integer", "description": "Mese 1-12 (opzionale)"},
-                    "query": {"type": "string", "description": "Filtro testuale (opzionale)"}
+                    "query": {"type": "string", "description": "Filtro testuale (opzionale)"},
+                    "limit": {"type": "integer", "description": f"Righe per pagina (opzionale, massimo {MAX_ROWS}): la risposta contiene next_cursor per la pagina successiva, da ripassare come cursor a questo tool"},
+                    "cursor": {"type": "string", "description": "next_cursor della pagina precedente (opzionale): riprende lo stesso elenco, gli altri parametri sono ignorati. Il more_cursor degli elenchi senza limit va invece a get_more_results"},
+                    "format": {"type": "string", "enum": OUTPUT_FORMATS, "description": "Formato: json (default), columns (intestazione + righe) o tsv, più compatti per elenchi lunghi"}
                 },
                 "required": ["year"]
             }
@@ -300,19 +3200,53 @@ async def list_tools():
         ),
         Tool(
             name="list_clients",
-            description="Lista clienti",
+            description="Lista clienti, completa o a pagine con limit e cursor",
             inputSchema={
                 "type": "object",
                 "properties": {
-                    "query": {"type": "string", "description": "Filtro nome/ragione sociale (opzionale)"}
+                    "query": {"type": "string", "description": "Filtro su nome/ragione sociale, partita IVA o codice fiscale (opzionale)"},
+                    "limit": {"type": "integer", "description": f"Righe per pagina (opzionale, massimo {MAX_ROWS}): la risposta contiene next_cursor per la pagina successiva, da ripassare come cursor a questo tool"},
+                    "cursor": {"type": "string", "description": "next_cursor della pagina precedente (opzionale): riprende lo stesso elenco, gli altri parametri sono ignorati. Il more_cursor degli elenchi senza limit va invece a get_more_results"},
+                    "format": {"type": "string", "enum": OUTPUT_FORMATS, "description": "Formato: json (default), columns (intestazione + righe) o tsv, più compatti per elenchi lunghi"}
                 }
             }
         ),
+        Tool(
+            name="search",
+            description="Ricerca fuzzy in clienti, fatture emesse e fatture passive per nome, partita IVA, codice fiscale, email, oggetto o righe, con risultati ordinati per somiglianza (es. \"Rossi srl\" trova \"ROSSI S.R.L.\")",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "query": {"type": "string", "description": "Testo da cercare"},
+                    "scopes": {"type": "array", "items": {"type": "string", "enum": list(SEARCH_SCOPES)}, "description": "Dove cercare: clients, invoices, received (default: tutti)"},
+                    "year": {"type": "integer", "description": "Limita i documenti a un anno (opzionale; senza mirror locale default anno corrente)"},
+                    "limit": {"type": "integer", "description": "Numero massimo di risultati (default: 20)"}
+                },
+                "required": ["query"]
+            }
+        ),
+        Tool(
+            name="get_more_results",
+            description="Righe successive di un elenco troppo lungo per una sola risposta, dal more_cursor restituito da list_invoices, list_clients o list_received_documents senza limit (il next_cursor delle pagine lette con limit va invece ripassato come cursor allo stesso tool)",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "cursor": {"type": "string", "description": "Valore more_cursor della risposta precedente"},
+                    "format": {"type": "string", "enum": OUTPUT_FORMATS, "description": "Formato: json (default), columns o tsv"}
+                },
+                "required": ["cursor"]
+            }
+        ),
         Tool(
             name="get_company_info",
             description="Info azienda collegata",
             inputSchema={"type": "object", "properties": {}}
         ),
+        Tool(
+            name="list_companies",
+            description="Aziende configurate su questo server, utilizzabili con il parametro company_id di ogni tool",
+            inputSchema={"type": "object", "properties": {}}
+        ),
         Tool(
             name="create_invoice",
             description="Crea nuova fattura (bozza). IMPORTANTE: Chiedere sempre conferma all'utente prima di eseguire.",
@@ -412,21 +3346,24 @@ async def list_tools():
         ),
         Tool(
             name="list_received_documents",
-            description="Lista fatture PASSIVE (ricevute dai fornitori). Parametri: year, month (opzionale), type (opzionale: expense, credit_note)",
+            description="Lista fatture PASSIVE (ricevute dai fornitori). Parametri: year, month (opzionale), type (opzionale: expense, credit_note), limit e cursor (opzionali) per leggere a pagine",
             inputSchema={
                 "type": "object",
                 "properties": {
                     "year": {"type": "integer", "description": "Anno"},
                     "month": {"type": "integer", "description": "Mese 1-12 (opzionale)"},
                     "type": {"type": "string", "description": "Tipo: expense, credit_note (default: expense)"},
-                    "query": {"type": "string", "description": "Filtro testuale (opzionale)"}
+                    "query": {"type": "string", "description": "Filtro testuale (opzionale)"},
+                    "limit": {"type": "integer", "description": f"Righe per pagina (opzionale, massimo {MAX_ROWS}): la risposta contiene next_cursor per la pagina successiva, da ripassare come cursor a questo tool"},
+                    "cursor": {"type": "string", "description": "next_cursor della pagina precedente (opzionale): riprende lo stesso elenco, gli altri parametri sono ignorati. Il more_cursor degli elenchi senza limit va invece a get_more_results"},
+                    "format": {"type": "string", "enum": OUTPUT_FORMATS, "description": "Formato: json (default), columns (intestazione + righe) o tsv, più compatti per elenchi lunghi"}
                 },
                 "required": ["year"]
             }
         ),
         Tool(
             name="get_situation",
-            description="Dashboard anno: fatturato totale, incassato, da incassare, costi, margine",
+            description="Dashboard anno: fatturato totale, incassato, da incassare, costi, margine, con dettaglio per mese e principali clienti",
             inputSchema={
                 "type": "object",
                 "properties": {
@@ -434,13 +3371,68 @@ async def list_tools():
                 }
             }
         ),
+        Tool(
+            name="get_portfolio_report",
+            description="Situazione dell'anno su più aziende (tutte quelle configurate o quelle indicate): fatturato, incassato, da incassare, scaduto, costi e fatture rifiutate o scartate dallo SDI, per azienda e in totale. Le aziende in errore sono riportate a parte senza bloccare le altre.",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "year": {"type": "integer", "description": "Anno (default: corrente)"},
+                    "company_ids": {"type": "array", "items": {"type": "integer"}, "description": "ID aziende (opzionale, default: tutte quelle di list_companies)"},
+                    "rejected_limit": {"type": "integer", "description": "Fatture rifiutate elencate per azienda (default: 10)"}
+                }
+            }
+        ),
+        Tool(
+            name="get_report",
+            description="Report su periodi arbitrari (anno, trimestre, mese o intervallo di mesi) con confronto con gli anni precedenti: fatturato, incassato, costi, margine e IVA per aliquota. Usa i totali mensili precalcolati del mirror locale.",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "year": {"type": "integer", "description": "Anno (default: corrente)"},
+                    "quarter": {"type": "integer", "minimum": 1, "maximum": 4, "description": "Trimestre 1-4 (opzionale)"},
+                    "month": {"type": "integer", "minimum": 1, "maximum": 12, "description": "Mese 1-12 (opzionale)"},
+                    "date_from": {"type": "string", "description": "Inizio intervallo YYYY-MM (in alternativa a year/quarter/month)"},
+                    "date_to": {"type": "string", "description": "Fine intervallo YYYY-MM, incluso"},
+                    "compare_years": {"type": "integer", "minimum": 0, "maximum": 10, "description": "Numero di anni precedenti da confrontare sullo stesso periodo (default: 0)"},
+                    "group_by": {"type": "string", "enum": ["total", "month", "quarter", "year"], "description": "Dettaglio all'interno di ogni periodo (default: total)"}
+                }
+            }
+        ),
+        Tool(
+            name="get_cash_forecast",
+            description="Crediti e debiti aperti per anzianità dello scaduto (fasce di giorni e principali controparti) e previsione settimanale di entrate, uscite e saldo dalle scadenze di fatture emesse e ricevute",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "weeks": {"type": "integer", "minimum": 1, "maximum": 52, "description": "Settimane di previsione (default: 12)"},
+                    "as_of": {"type": "string", "description": "Data di riferimento YYYY-MM-DD (default: oggi)"},
+                    "opening_balance": {"type": "number", "description": "Saldo di cassa iniziale per il saldo cumulato (default: 0)"}
+                }
+            }
+        ),
+        Tool(
+            name="get_vat_liquidation",
+            description="Liquidazione IVA periodica (mensile o trimestrale): IVA vendite e acquisti per aliquota, IVA detraibile, split payment, credito riportato e importo da versare",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "year": {"type": "integer", "description": "Anno (default: corrente)"},
+                    "periodicity": {"type": "string", "enum": ["month", "quarter"], "description": "Liquidazione mensile o trimestrale (default: month)"},
+                    "period": {"type": "integer", "minimum": 1, "maximum": 12, "description": "Solo questo mese (1-12) o trimestre (1-4) (opzionale)"},
+                    "opening_credit": {"type": "number", "description": "Credito IVA dall'anno precedente (default: 0)"}
+                }
+            }
+        ),
         Tool(
             name="check_numeration",
-            description="Verifica continuità numerica delle fatture emesse per un dato anno. Segnala buchi nella numerazione.",
+            description="Verifica continuità numerica dei documenti emessi per un dato anno, per ogni numerazione (sezionale). Segnala numeri mancanti (come intervalli), duplicati e date non in ordine.",
             inputSchema={
                 "type": "object",
                 "properties": {
-                    "year": {"type": "integer", "description": "Anno da verificare (es. 2025)"}
+                    "year": {"type": "integer", "description": "Anno da verificare (es. 2025)"},
+                    "type": {"type": "string", "enum": ["invoice", "credit_note", "proforma", "receipt", "delivery_note"], "description": "Tipo di documento (default: invoice)"},
+                    "numeration": {"type": "string", "description": "Solo questa numerazione/sezionale, es. '/A' (opzionale; '' per quella principale)"}
                 },
                 "required": ["year"]
             }
@@ -464,58 +3456,168 @@ async def list_tools():
                 "required": ["document_id", "amount", "payment_date", "payment_method_id"]
             }
         ),
+        Tool(
+            name="reconcile_payments",
+            description="Registra in blocco più pagamenti su fatture esistenti (riconciliazione bancaria). Ogni voce identifica la fattura per document_id oppure per number (+ year). Restituisce l'esito per ogni voce. IMPORTANTE: Chiedere conferma all'utente prima di eseguire.",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "payments": {
+                        "type": "array",
+                        "description": "Lista pagamenti da registrare",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "document_id": {"type": "integer", "description": "ID fattura"},
+                                "number": {"type": "integer", "description": "Numero fattura (alternativo a document_id)"},
+                                "year": {"type": "integer", "description": "Anno della fattura (default: anno del pagamento, poi quello precedente)"},
+                                "numeration": {"type": "string", "description": "Sezionale della fattura (opzionale)"},
+                                "amount": {"type": "number", "description": "Importo del pagamento"},
+                                "payment_date": {"type": "string", "description": "Data del pagamento (AAAA-MM-GG)"},
+                                "payment_method_id": {"type": "integer", "description": "ID metodo di pagamento (default: quello generale)"}
+                            },
+                            "required": ["amount", "payment_date"]
+                        }
+                    },
+                    "payment_method_id": {"type": "integer", "description": "ID metodo di pagamento usato per le voci che non lo indicano"}
+                },
+                "required": ["payments"]
+            }
+        ),
+        Tool(
+            name="send_to_sdi_bulk",
+            description="Invia in blocco più fatture allo SDI: verifica prima tutte le bozze, invia quelle valide e segue lo stato SDI fino all'esito (o fino a max_wait_seconds). Restituisce un riepilogo per stato. ATTENZIONE: Azione irreversibile! Chiedere SEMPRE conferma esplicita all'utente.",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "document_ids": {
+                        "type": "array",
+                        "description": "ID delle fatture da inviare",
+                        "items": {"type": "integer"}
+                    },
+                    "wait": {"type": "boolean", "description": "Attendere l'esito SDI dopo l'invio (default: true)"},
+                    "max_wait_seconds": {"type": "integer", "description": "Attesa massima dell'esito in secondi (default: 120)"},
+                    "verify_xml": {"type": "boolean", "description": "Verificare l'XML prima dell'invio (default: true)"}
+                },
+                "required": ["document_ids"]
+            }
+        ),
+        Tool(
+            name="create_invoices_bulk",
+            description="Crea in blocco più fatture (bozze): da una lista di specifiche (come create_invoice) e/o duplicando tutte le fatture di un mese. Restituisce l'esito per ogni fattura. IMPORTANTE: Chiedere sempre conferma all'utente prima di eseguire.",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "invoices": {
+                        "type": "array",
+                        "description": "Fatture da creare",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "client_id": {"type": "integer", "description": "ID cliente"},
+                                "items": {
+                                    "type": "array",
+                                    "description": "Lista articoli",
+                                    "items": {
+                                        "type": "object",
+                                        "properties": {
+                                            "name": {"type": "string", "description": "Nome prodotto/servizio"},
+                                            "description": {"type": "string", "description": "Descrizione estesa"},
+                                            "qty": {"type": "number", "description": "Quantità"},
+                                            "net_price": {"type": "number", "description": "Prezzo netto unitario"},
+                                            "vat_rate": {"type": "number", "description": "Aliquota IVA (es. 22)"}
+                                        },
+                                        "required": ["name", "qty", "net_price"]
+                                    }
+                                },
+                                "date": {"type": "string", "description": "Data fattura YYYY-MM-DD (default: oggi)"},
+                                "payment_days": {"type": "integer", "description": "Giorni pagamento (default: 30)"},
+                                "visible_subject": {"type": "string", "description": "Oggetto visibile in fattura"}
+                            },
+                            "required": ["client_id", "items"]
+                        }
+                    },
+                    "duplicate": {
+                        "type": "object",
+                        "description": "Duplica tutte le fatture di un mese (es. fatturazione ricorrente)",
+                        "properties": {
+                            "year": {"type": "integer", "description": "Anno delle fatture da duplicare"},
+                            "month": {"type": "integer", "description": "Mese 1-12 delle fatture da duplicare"},
+                            "query": {"type": "string", "description": "Filtro testuale su cliente/oggetto (opzionale)"},
+                            "new_date": {"type": "string", "description": "Data delle nuove fatture YYYY-MM-DD (default: oggi)"},
+                            "payment_days": {"type": "integer", "description": "Giorni pagamento (default: eredita da originale)"},
+                            "description_replace": {
+                                "type": "object",
+                                "description": "Sostituzioni testo nella descrizione (es. 2025->2026)",
+                                "properties": {
+                                    "old": {"type": "string"},
+                                    "new": {"type": "string"}
+                                }
+                            }
+                        },
+                        "required": ["year", "month"]
+                    }
+                }
+            }
+        ),
     ]
+    # Ogni tool può lavorare su una qualsiasi delle aziende configurate
+    for tool in tools:
+        if tool.name in ("list_companies", "get_portfolio_report"):
+            continue
+        tool.inputSchema.setdefault("properties", {})["company_id"] = {
+            "type": "integer",
+            "description": f"ID azienda (opzionale, default {DEFAULT_COMPANY_ID}; vedi list_companies)"
+        }
+    return tools
 
 
 @app.call_tool()
 async def call_tool(name: str, arguments: dict) -> list[TextContent]:
+    """Esegue il tool per l'azienda indicata da company_id (default DEFAULT_COMPANY_ID).
+
+    L'azienda resta quella corrente per tutta la chiamata, compresi i task
+    avviati da gather/ensure_future, che ne ereditano il contesto.
+    """
+    try:
+        company = get_company(arguments.get("company_id"))
+    except (KeyError, TypeError, ValueError):
+        return text_result({
+            "success": False,
+            "error": f"Azienda {arguments.get('company_id')} non configurata: vedi list_companies"
+        })
+    token = _current_company.set(company)
+    try:
+        return await handle_tool(name, arguments)
+    finally:
+        _current_company.reset(token)
+
+
+async def handle_tool(name: str, arguments: dict) -> list[TextContent]:
     try:
         if name == "list_invoices":
+            try:
+                arguments, limit, position = list_paging(arguments)
+            except ValueError as e:
+                return text_result({"success": False, "error": str(e)})
             year = arguments.get("year", 2024)
             month = arguments.get("month")
             query = arguments.get("query")
             
-            q = f"date >= '{year}-01-01' and date <= '{year}-12-31'"
-            if month:
-                last_day = 31 if month in [1,3,5,7,8,10,12] else 30 if month in [4,6,9,11] else 29
-                q = f"date >= '{year}-{month:02d}-01' and date <= '{year}-{month:02d}-{last_day}'"
-            
-            response = issued_api.list_issued_documents(
-                company_id=COMPANY_ID,
-                type="invoice",
-                q=q,
-                per_page=100,
-                fieldset="detailed"
-            )
-            
-            invoices = []
-            for doc in (response.data or []):
-                d = doc.to_dict()
-                inv = {
-                    "id": d.get("id"),
-                    "number": d.get("number"),
-                    "date": str(d.get("date", "")),
-                    "client": d.get("entity", {}).get("name") if d.get("entity") else None,
-                    "total": get_total_from_doc(d),
-                    "subject": d.get("subject"),
-                    "description": d.get("visible_subject")
-                }
-                if query:
-                    search_text = f"{inv['client']} {inv['subject']} {inv['description']}".lower()
-                    if query.lower() not in search_text:
-                        continue
-                invoices.append(inv)
+            date_from, date_to = period_bounds(year, month)
             
-            return [TextContent(type="text", text=json.dumps(invoices, indent=2, ensure_ascii=False))]
+            if limit:
+                docs, position = await load_page("issued", "invoice", date_from, date_to,
+                    INVOICE_LIST_FIELDS, query, limit, position)
+                invoices = [invoice_list_row(d) for d in docs]
+                return page_result(invoices, arguments.get("format", "json"), next_list_cursor(arguments, position))
+            # Letti a blocchi: table_result si ferma a MAX_ROWS righe, il resto con get_more_results
+            docs = iter_issued_documents("invoice", date_from, date_to, fields=INVOICE_LIST_FIELDS, query=query)
+            return await table_result((invoice_list_row(d) async for d in docs), arguments.get("format", "json"))
             
         elif name == "get_invoice":
             doc_id = arguments["document_id"]
-            response = issued_api.get_issued_document(
-                company_id=COMPANY_ID,
-                document_id=doc_id,
-                fieldset="detailed"
-            )
-            d = response.data.to_dict()
+            d = await get_document_by_id(doc_id)
             
             items = []
             for i in d.get("items_list", []):
@@ -550,33 +3652,60 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
                 "payments": payments,
                 "ei_status": d.get("ei_status")
             }
-            return [TextContent(type="text", text=json.dumps(result, indent=2, ensure_ascii=False))]
+            return text_result(result)
             
         elif name == "list_clients":
+            try:
+                arguments, limit, position = list_paging(arguments)
+            except ValueError as e:
+                return text_result({"success": False, "error": str(e)})
             query = arguments.get("query")
-            response = clients_api.list_clients(
-                company_id=COMPANY_ID,
-                per_page=100
-            )
-            clients = []
-            for c in (response.data or []):
-                cd = c.to_dict()
-                client = {
-                    "id": cd.get("id"), 
-                    "name": cd.get("name"), 
-                    "vat": cd.get("vat_number"), 
-                    "tax_code": cd.get("tax_code"),
-                    "email": cd.get("email")
-                }
-                if query:
-                    search_text = f"{client['name']}".lower()
-                    if query.lower() not in search_text:
-                        continue
-                clients.append(client)
-            return [TextContent(type="text", text=json.dumps(clients, indent=2, ensure_ascii=False))]
+            if limit:
+                rows, position = await load_page("clients", fields=CLIENT_LIST_FIELDS, query=query,
+                    limit=limit, position=position)
+                clients = [client_list_row(cd) for cd in rows]
+                return page_result(clients, arguments.get("format", "json"), next_list_cursor(arguments, position))
+            rows = iter_clients(fields=CLIENT_LIST_FIELDS, query=query)
+            return await table_result((client_list_row(cd) async for cd in rows), arguments.get("format", "json"))
+            
+        elif name == "search":
+            limit = max(1, min(int(arguments.get("limit") or 20), MAX_ROWS))
+            try:
+                result = await search_records(arguments["query"], arguments.get("scopes"), arguments.get("year"), limit)
+            except ValueError as e:
+                return text_result({"success": False, "error": str(e)})
+            return text_result(result)
+            
+        elif name == "get_more_results":
+            state = result_cursors.get(arguments["cursor"])
+            if state is not None and state["company_id"] != current_company().id:
+                return text_result({
+                    "success": False,
+                    "error": f"Il cursore appartiene all'azienda {state['company_id']}: ripetere la richiesta con quel company_id"
+                })
+            if state is None:
+                try:
+                    decode_cursor(arguments["cursor"])
+                except ValueError:
+                    return text_result({
+                        "success": False,
+                        "error": "Cursore scaduto o non valido: ripetere la richiesta originale"
+                    })
+                return text_result({
+                    "success": False,
+                    "error": "Questo è il next_cursor di un elenco letto con limit: passarlo come cursor al tool che lo ha restituito"
+                })
+            result_cursors.invalidate(arguments["cursor"])
+            return await table_result(state["rows"], arguments.get("format", "json"), state["offset"], state["head"])
+            
+        elif name == "list_companies":
+            return text_result([
+                {"company_id": company_id, "name": company_name, "default": company_id == DEFAULT_COMPANY_ID}
+                for company_id, (company_name, _) in COMPANIES.items()
+            ])
             
         elif name == "get_company_info":
-            response = companies_api.get_company_info(company_id=COMPANY_ID)
+            response = await run_sdk(companies_api.get_company_info, company_id=current_company().id)
             d = response.data.to_dict()
             info = d.get("info", d)
             result = {
@@ -587,7 +3716,7 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
                 "city": info.get("address_city"),
                 "province": info.get("address_province")
             }
-            return [TextContent(type="text", text=json.dumps(result, indent=2, ensure_ascii=False))]
+            return text_result(result)
         
         elif name == "create_invoice":
             client_id = arguments["client_id"]
@@ -597,52 +3726,23 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
             visible_subject = arguments.get("visible_subject", "")
             
             # v1.3: Costruisce entity completa con ei_code
-            client_data = get_client_by_id(client_id)
+            client_data = await get_client_by_id(client_id)
             if not client_data:
-                return [TextContent(type="text", text=json.dumps({
+                return text_result({
                     "success": False,
                     "error": f"Cliente con ID {client_id} non trovato"
-                }, indent=2, ensure_ascii=False))]
-            
-            entity = build_entity_from_client(client_id, client_data)
-            
-            items_list = []
-            for item in items_data:
-                vat_rate = item.get("vat_rate", 22)
-                items_list.append({
-                    "name": item["name"],
-                    "description": item.get("description", ""),
-                    "qty": item["qty"],
-                    "net_price": item["net_price"],
-                    "vat": {"id": 0, "value": vat_rate}
                 })
             
-            invoice_date = datetime.strptime(date_str, "%Y-%m-%d")
-            due_date = invoice_date + timedelta(days=payment_days)
-            total_gross = sum(i["qty"] * i["net_price"] * (1 + i["vat"]["value"]/100) for i in items_list)
+            entity = await build_entity_from_client(client_id, client_data)
             
-            body = {
-                "data": {
-                    "type": "invoice",
-                    "e_invoice": True,
-                    "ei_data": {"payment_method": "MP05"},
-                    "entity": entity,
-                    "date": date_str,
-                    "visible_subject": visible_subject,
-                    "items_list": items_list,
-                    "payments_list": [{
-                        "amount": round(total_gross, 2),
-                        "due_date": due_date.strftime("%Y-%m-%d"),
-                        "status": "not_paid",
-                        "payment_terms": {"days": payment_days, "type": "standard"}
-                    }]
-                }
-            }
+            items_list = items_from_spec(items_data, await get_cached_settings("vat_types"))
+            body, total_gross, due_date = build_invoice_body(entity, items_list, date_str, payment_days, visible_subject)
             
-            response = issued_api.create_issued_document(
-                company_id=COMPANY_ID,
+            response = await run_sdk(issued_api.create_issued_document,
+                company_id=current_company().id,
                 create_issued_document_request=body
             )
+            invalidate_store("issued:invoice")
             
             d = response.data.to_dict()
             result = {
@@ -656,7 +3756,7 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
                 "status": "bozza",
                 "message": f"Fattura #{d.get('number')} creata come bozza. Codice SDI: {entity.get('ei_code', 'N/A')}. Usa send_to_sdi per inviarla."
             }
-            return [TextContent(type="text", text=json.dumps(result, indent=2, ensure_ascii=False))]
+            return text_result(result)
         
         elif name == "duplicate_invoice":
             source_id = arguments["source_document_id"]
@@ -664,75 +3764,32 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
             desc_replace = arguments.get("description_replace", {})
             payment_days_override = arguments.get("payment_days")
             
-            response = issued_api.get_issued_document(
-                company_id=COMPANY_ID,
-                document_id=source_id,
-                fieldset="detailed"
-            )
-            orig = response.data.to_dict()
+            orig = await get_document_by_id(source_id)
             
             # v1.3: Costruisce entity completa con ei_code aggiornato dall'anagrafica
             client_id = orig.get("entity", {}).get("id")
-            client_data = get_client_by_id(client_id) if client_id else None
+            client_data = await get_client_by_id(client_id) if client_id else None
             
             if client_id and client_data:
-                entity = build_entity_from_client(client_id, client_data)
+                entity = await build_entity_from_client(client_id, client_data)
             else:
                 # Fallback: usa entity originale
                 entity = orig.get("entity", {})
             
-            items_list = []
-            for i in orig.get("items_list", []):
-                name = i.get("name", "")
-                desc = i.get("description", "")
-                if desc_replace.get("old") and desc_replace.get("new"):
-                    name = name.replace(desc_replace["old"], desc_replace["new"])
-                    desc = desc.replace(desc_replace["old"], desc_replace["new"])
-                items_list.append({
-                    "name": name,
-                    "description": desc,
-                    "qty": i.get("qty"),
-                    "net_price": i.get("net_price"),
-                    "vat": {"id": 0, "value": i.get("vat", {}).get("value", 22)}
-                })
-            
-            visible_subject = orig.get("visible_subject", "")
-            if desc_replace.get("old") and desc_replace.get("new"):
-                visible_subject = visible_subject.replace(desc_replace["old"], desc_replace["new"])
-            
-            invoice_date = datetime.strptime(new_date_str, "%Y-%m-%d")
+            items_list, visible_subject = duplicate_items(orig, desc_replace)
             
             if payment_days_override is not None:
                 payment_days = payment_days_override
             else:
-                orig_payments = orig.get("payments_list", [{}])
-                payment_days = orig_payments[0].get("payment_terms", {}).get("days", 30) if orig_payments else 30
+                payment_days = payment_days_of(orig)
             
-            due_date = invoice_date + timedelta(days=payment_days)
-            total_gross = sum(i["qty"] * i["net_price"] * (1 + i["vat"]["value"]/100) for i in items_list)
-            
-            body = {
-                "data": {
-                    "type": "invoice",
-                    "e_invoice": True,
-                    "ei_data": {"payment_method": "MP05"},
-                    "entity": entity,
-                    "date": new_date_str,
-                    "visible_subject": visible_subject,
-                    "items_list": items_list,
-                    "payments_list": [{
-                        "amount": round(total_gross, 2),
-                        "due_date": due_date.strftime("%Y-%m-%d"),
-                        "status": "not_paid",
-                        "payment_terms": {"days": payment_days, "type": "standard"}
-                    }]
-                }
-            }
+            body, total_gross, due_date = build_invoice_body(entity, items_list, new_date_str, payment_days, visible_subject)
             
-            response = issued_api.create_issued_document(
-                company_id=COMPANY_ID,
+            response = await run_sdk(issued_api.create_issued_document,
+                company_id=current_company().id,
                 create_issued_document_request=body
             )
+            invalidate_store("issued:invoice")
             
             d = response.data.to_dict()
             result = {
@@ -748,29 +3805,26 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
                 "status": "bozza",
                 "message": f"Fattura #{d.get('number')} creata come bozza (duplicata da #{orig.get('number')}). Codice SDI: {entity.get('ei_code', 'N/A')}. Scadenza: {due_date.strftime('%d/%m/%Y')}. Usa send_to_sdi per inviarla."
             }
-            return [TextContent(type="text", text=json.dumps(result, indent=2, ensure_ascii=False))]
+            return text_result(result)
         
         elif name == "delete_invoice":
             doc_id = arguments["document_id"]
             
-            check = issued_api.get_issued_document(
-                company_id=COMPANY_ID,
-                document_id=doc_id,
-                fieldset="detailed"
-            )
-            check_data = check.data.to_dict()
+            check_data = await get_document_by_id(doc_id)
             current_status = check_data.get("ei_status")
             
             if current_status and current_status not in ["null", "not_sent", None]:
-                return [TextContent(type="text", text=json.dumps({
+                return text_result({
                     "success": False,
                     "error": f"Impossibile eliminare: fattura già inviata allo SDI. Stato attuale: {current_status}"
-                }, indent=2, ensure_ascii=False))]
+                })
             
-            issued_api.delete_issued_document(
-                company_id=COMPANY_ID,
+            await run_sdk(issued_api.delete_issued_document,
+                company_id=current_company().id,
                 document_id=doc_id
             )
+            invalidate_document(doc_id)
+            invalidate_store("issued:invoice", deleted_id=doc_id)
             
             result = {
                 "success": True,
@@ -779,30 +3833,27 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
                 "client": check_data.get("entity", {}).get("name"),
                 "message": f"Fattura #{check_data.get('number')} eliminata con successo."
             }
-            return [TextContent(type="text", text=json.dumps(result, indent=2, ensure_ascii=False))]
+            return text_result(result)
         
         elif name == "send_to_sdi":
             doc_id = arguments["document_id"]
             
-            check = issued_api.get_issued_document(
-                company_id=COMPANY_ID,
-                document_id=doc_id,
-                fieldset="detailed"
-            )
-            check_data = check.data.to_dict()
+            check_data = await get_document_by_id(doc_id)
             current_status = check_data.get("ei_status")
             
-            if current_status and current_status not in ["null", "rejected", None, "not_sent"]:
-                return [TextContent(type="text", text=json.dumps({
+            if current_status and current_status not in EI_SENDABLE_STATUSES:
+                return text_result({
                     "success": False,
                     "error": f"Fattura già inviata o in elaborazione. Stato attuale: {current_status}"
-                }, indent=2, ensure_ascii=False))]
+                })
             
-            response = einvoice_api.send_e_invoice(
-                company_id=COMPANY_ID,
+            response = await run_sdk(einvoice_api.send_e_invoice,
+                company_id=current_company().id,
                 document_id=doc_id,
                 send_e_invoice_request={"data": {"withholding_tax_causal": None}}
             )
+            invalidate_document(doc_id)
+            invalidate_store("issued:invoice")
             
             result = {
                 "success": True,
@@ -811,39 +3862,24 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
                 "client": check_data.get("entity", {}).get("name"),
                 "message": f"Fattura #{check_data.get('number')} inviata allo SDI con successo!"
             }
-            return [TextContent(type="text", text=json.dumps(result, indent=2, ensure_ascii=False))]
+            return text_result(result)
         
         elif name == "get_invoice_status":
             doc_id = arguments["document_id"]
             
-            response = issued_api.get_issued_document(
-                company_id=COMPANY_ID,
-                document_id=doc_id,
-                fieldset="detailed"
-            )
-            d = response.data.to_dict()
+            d = await get_document_by_id(doc_id)
             
             ei_status = d.get("ei_status")
-            status_map = {
-                None: "Bozza (non inviata)",
-                "not_sent": "Bozza (non inviata)",
-                "pending": "In attesa di invio",
-                "sent": "Inviata, in attesa di risposta SDI",
-                "delivered": "Consegnata al destinatario",
-                "accepted": "Accettata",
-                "rejected": "Rifiutata",
-                "not_delivered": "Non consegnata (messa a disposizione)"
-            }
             
             result = {
                 "id": d.get("id"),
                 "number": d.get("number"),
                 "client": d.get("entity", {}).get("name"),
                 "ei_status": ei_status,
-                "ei_status_description": status_map.get(ei_status, ei_status),
+                "ei_status_description": EI_STATUS_DESCRIPTIONS.get(ei_status, ei_status),
                 "date": str(d.get("date", ""))
             }
-            return [TextContent(type="text", text=json.dumps(result, indent=2, ensure_ascii=False))]
+            return text_result(result)
         
         elif name == "send_email":
             doc_id = arguments["document_id"]
@@ -851,25 +3887,20 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
             subject = arguments.get("subject")
             body_text = arguments.get("body")
             
-            check = issued_api.get_issued_document(
-                company_id=COMPANY_ID,
-                document_id=doc_id,
-                fieldset="detailed"
-            )
-            check_data = check.data.to_dict()
+            check_data = await get_document_by_id(doc_id)
             
             recipient_email = recipient or check_data.get("entity", {}).get("email", "")
             if not recipient_email:
-                return [TextContent(type="text", text=json.dumps({
+                return text_result({
                     "success": False,
                     "error": "Nessuna email specificata e cliente senza email in anagrafica"
-                }, indent=2, ensure_ascii=False))]
+                })
             
             if not SENDER_EMAIL:
-                return [TextContent(type="text", text=json.dumps({
+                return text_result({
                     "success": False,
                     "error": "FIC_SENDER_EMAIL non configurato. Imposta l'email mittente nel file .env"
-                }, indent=2, ensure_ascii=False))]
+                })
             
             email_data = {
                 "data": {
@@ -889,11 +3920,12 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
                 }
             }
             
-            response = issued_api.schedule_email(
-                company_id=COMPANY_ID,
+            response = await run_sdk(issued_api.schedule_email,
+                company_id=current_company().id,
                 document_id=doc_id,
                 schedule_email_request=email_data
             )
+            invalidate_document(doc_id)
             
             result = {
                 "success": True,
@@ -902,188 +3934,109 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
                 "recipient": recipient_email,
                 "message": f"Email con fattura #{check_data.get('number')} inviata a {recipient_email}"
             }
-            return [TextContent(type="text", text=json.dumps(result, indent=2, ensure_ascii=False))]
+            return text_result(result)
         
         elif name == "list_received_documents":
+            try:
+                arguments, limit, position = list_paging(arguments)
+            except ValueError as e:
+                return text_result({"success": False, "error": str(e)})
             year = arguments.get("year", datetime.now().year)
             month = arguments.get("month")
             doc_type = arguments.get("type", "expense")
             query = arguments.get("query")
             
-            q = f"date >= '{year}-01-01' and date <= '{year}-12-31'"
-            if month:
-                last_day = 31 if month in [1,3,5,7,8,10,12] else 30 if month in [4,6,9,11] else 29
-                q = f"date >= '{year}-{month:02d}-01' and date <= '{year}-{month:02d}-{last_day}'"
-            
-            response = received_api.list_received_documents(
-                company_id=COMPANY_ID,
-                type=doc_type,
-                q=q,
-                per_page=100,
-                fieldset="detailed"
-            )
-            
-            docs = []
-            for doc in (response.data or []):
-                d = doc.to_dict()
-                supplier_name = d.get('entity', {}).get('name', '') if d.get('entity') else ''
-                desc = d.get('description', '') or ''
-                
-                if query:
-                    search_text = f"{supplier_name} {desc}".lower()
-                    if query.lower() not in search_text:
-                        continue
-                
-                total = d.get('amount_gross') or d.get('amount_net') or 0
-                
-                docs.append({
-                    "id": d.get("id"),
-                    "number": d.get("number"),
-                    "date": str(d.get("date", "")),
-                    "supplier": supplier_name,
-                    "description": desc[:80],
-                    "total": total
-                })
+            date_from, date_to = period_bounds(year, month)
             
-            return [TextContent(type="text", text=json.dumps(docs, indent=2, ensure_ascii=False))]
+            if limit:
+                rows, position = await load_page("received", doc_type, date_from, date_to,
+                    RECEIVED_LIST_FIELDS, query, limit, position)
+                docs = [received_list_row(d) for d in rows]
+                return page_result(docs, arguments.get("format", "json"), next_list_cursor(arguments, position))
+            rows = iter_received_documents(doc_type, date_from, date_to, fields=RECEIVED_LIST_FIELDS, query=query)
+            return await table_result((received_list_row(d) async for d in rows), arguments.get("format", "json"))
         
         elif name == "get_situation":
             year = arguments.get("year", datetime.now().year)
-            
-            q = f"date >= '{year}-01-01' and date <= '{year}-12-31'"
-            
-            emesse_resp = issued_api.list_issued_documents(
-                company_id=COMPANY_ID,
-                type="invoice",
-                q=q,
-                per_page=100,
-                fieldset="detailed"
+            result = await compute_situation(year)
+            return text_result(result)
+        
+        elif name == "get_portfolio_report":
+            result = await compute_portfolio(
+                arguments.get("year", datetime.now().year),
+                company_ids=arguments.get("company_ids"),
+                rejected_limit=max(0, arguments.get("rejected_limit", 10))
             )
-            
-            totale_fatturato = 0
-            totale_incassato = 0
-            fatture_non_pagate = []
-            
-            for doc in (emesse_resp.data or []):
-                d = doc.to_dict()
-                total = get_total_from_doc(d)
-                totale_fatturato += total
-                
-                for p in d.get('payments_list', []):
-                    status = str(p.get('status', '')).replace('IssuedDocumentStatus.', '')
-                    if status == 'paid':
-                        totale_incassato += p.get('amount', 0)
-                    elif status == 'not_paid':
-                        fatture_non_pagate.append({
-                            "number": d.get("number"),
-                            "client": d.get('entity', {}).get('name', '') if d.get('entity') else '',
-                            "amount": p.get('amount', 0),
-                            "due_date": str(p.get('due_date', ''))
-                        })
-            
-            ricevute_resp = received_api.list_received_documents(
-                company_id=COMPANY_ID,
-                type="expense",
-                q=q,
-                per_page=100,
-                fieldset="detailed"
+            return text_result(result)
+        
+        elif name == "get_report":
+            try:
+                result = await compute_report(
+                    year=arguments.get("year"),
+                    quarter=arguments.get("quarter"),
+                    month=arguments.get("month"),
+                    date_from=arguments.get("date_from"),
+                    date_to=arguments.get("date_to"),
+                    compare_years=arguments.get("compare_years", 0),
+                    group_by=arguments.get("group_by", "total")
+                )
+            except ValueError as e:
+                return text_result({"success": False, "error": str(e)})
+            return text_result(result)
+        
+        elif name == "get_cash_forecast":
+            result = await compute_cash_forecast(
+                weeks=arguments.get("weeks", 12),
+                as_of=arguments.get("as_of"),
+                opening_balance=arguments.get("opening_balance", 0)
             )
-            
-            totale_costi = 0
-            for doc in (ricevute_resp.data or []):
-                d = doc.to_dict()
-                totale_costi += d.get('amount_gross') or d.get('amount_net') or 0
-            
-            fatture_non_pagate.sort(key=lambda x: x.get('due_date', ''))
-            
-            result = {
-                "anno": year,
-                "fatturato_totale": round(totale_fatturato, 2),
-                "incassato": round(totale_incassato, 2),
-                "da_incassare": round(totale_fatturato - totale_incassato, 2),
-                "costi_totali": round(totale_costi, 2),
-                "margine_lordo": round(totale_fatturato - totale_costi, 2),
-                "prossime_scadenze": fatture_non_pagate[:10]
-            }
-            return [TextContent(type="text", text=json.dumps(result, indent=2, ensure_ascii=False))]
+            return text_result(result)
+        
+        elif name == "get_vat_liquidation":
+            periodicity = arguments.get("periodicity", "month")
+            period = arguments.get("period")
+            if period and period > (4 if periodicity == "quarter" else 12):
+                return text_result({
+                    "success": False,
+                    "error": f"Periodo {period} non valido per la liquidazione {'trimestrale' if periodicity == 'quarter' else 'mensile'}"
+                })
+            result = await compute_vat_liquidation(
+                arguments.get("year", datetime.now().year),
+                periodicity=periodicity,
+                period=period,
+                opening_credit=arguments.get("opening_credit", 0)
+            )
+            return text_result(result)
         
         elif name == "check_numeration":
             year = arguments.get("year", datetime.now().year)
+            doc_type = arguments.get("type", "invoice")
             
-            q = f"date >= '{year}-01-01' and date <= '{year}-12-31'"
+            # Numeri dell'anno per ogni numerazione (indice del mirror o paginazione completa)
+            series = await check_numbering(year, doc_type, arguments.get("numeration"))
             
-            # Prima pagina
-            response = issued_api.list_issued_documents(
-                company_id=COMPANY_ID,
-                type="invoice",
-                q=q,
-                per_page=100
-            )
-            docs = [d.to_dict() for d in (response.data or [])]
-            
-            # Paginazione: recupera tutte le fatture dell'anno
-            total_pages = getattr(response, 'last_page', 1) or 1
-            if total_pages > 1:
-                for page in range(2, total_pages + 1):
-                    page_resp = issued_api.list_issued_documents(
-                        company_id=COMPANY_ID,
-                        type="invoice",
-                        q=q,
-                        per_page=100,
-                        page=page
-                    )
-                    docs.extend([d.to_dict() for d in (page_resp.data or [])])
-            
-            if not docs:
-                return [TextContent(type="text", text=json.dumps({
+            if not series:
+                return text_result({
                     "year": year,
-                    "status": "Nessuna fattura trovata per questo anno"
-                }, indent=2, ensure_ascii=False))]
-            
-            # Estrai numeri, escludi None/0, e ordina
-            numbers = sorted(set(
-                d.get("number") for d in docs
-                if d.get("number") is not None and d.get("number") > 0
-            ))
-            
-            gaps = []
-            if numbers:
-                # Verifica partenza da 1
-                if numbers[0] != 1:
-                    gaps.append({
-                        "type": "start",
-                        "expected": 1,
-                        "actual": numbers[0],
-                        "missing": list(range(1, numbers[0])),
-                        "note": f"La numerazione parte da {numbers[0]} invece che da 1"
-                    })
-                
-                # Cerca buchi nella sequenza
-                for i in range(len(numbers) - 1):
-                    if numbers[i + 1] - numbers[i] > 1:
-                        missing = list(range(numbers[i] + 1, numbers[i + 1]))
-                        gaps.append({
-                            "type": "gap",
-                            "after": numbers[i],
-                            "before": numbers[i + 1],
-                            "missing": missing,
-                            "note": f"Mancano i numeri {missing} tra fattura {numbers[i]} e {numbers[i+1]}"
-                        })
+                    "type": doc_type,
+                    "status": "Nessun documento trovato per questo anno"
+                })
             
+            problems = sum(s["gap_count"] + s["duplicate_count"] + s["date_inversion_count"] for s in series)
             result = {
                 "year": year,
-                "total_invoices": len(numbers),
-                "first_number": numbers[0] if numbers else None,
-                "last_number": numbers[-1] if numbers else None,
-                "continuous": len(gaps) == 0,
-                "status": "✓ Numerazione continua" if len(gaps) == 0 else f"⚠ Trovati {len(gaps)} problemi",
-                "gaps": gaps if gaps else []
+                "type": doc_type,
+                "total_documents": sum(s["total"] for s in series),
+                "continuous": all(s["continuous"] for s in series),
+                "dates_in_order": all(s["dates_in_order"] for s in series),
+                "status": "✓ Numerazione continua" if not problems else f"⚠ Trovati {problems} problemi",
+                "numerations": series
             }
-            return [TextContent(type="text", text=json.dumps(result, indent=2, ensure_ascii=False))]
+            return text_result(result)
             
         elif name == "get_payment_methods":
-            methods = get_payment_methods()
-            return [TextContent(type="text", text=json.dumps(methods, indent=2, ensure_ascii=False))]
+            methods = await get_payment_methods()
+            return text_result(methods)
             
         elif name == "add_payment_to_invoice":
             document_id = arguments["document_id"]
@@ -1091,13 +4044,44 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
             payment_date = arguments["payment_date"]
             payment_method_id = arguments["payment_method_id"]
             
-            result = add_payment_to_invoice(document_id, amount, payment_date, payment_method_id)
-            return [TextContent(type="text", text=json.dumps(result, indent=2, ensure_ascii=False))]
+            result = await add_payment_to_invoice(document_id, amount, payment_date, payment_method_id)
+            return text_result(result)
+            
+        elif name == "reconcile_payments":
+            result = await reconcile_payments(arguments["payments"], arguments.get("payment_method_id"))
+            return text_result(result)
+            
+        elif name == "send_to_sdi_bulk":
+            result = await send_to_sdi_bulk(
+                arguments["document_ids"],
+                wait=arguments.get("wait", True),
+                max_wait=arguments.get("max_wait_seconds", 120),
+                verify_xml=arguments.get("verify_xml", True)
+            )
+            return text_result(result)
+            
+        elif name == "create_invoices_bulk":
+            if not arguments.get("invoices") and not arguments.get("duplicate"):
+                return text_result({
+                    "success": False,
+                    "error": "Indicare invoices oppure duplicate"
+                })
+            try:
+                check_query((arguments.get("duplicate") or {}).get("query"))
+            except ValueError as e:
+                return text_result({"success": False, "error": str(e)})
+            result = await create_invoices_bulk(arguments.get("invoices"), arguments.get("duplicate"))
+            return text_result(result)
             
         else:
             return [TextContent(type="text", text=f"Tool {name} non trovato")]
             
     except Exception as e:
+        if isinstance(e, ApiException) and e.status == 429:
+            return text_result({
+                "success": False,
+                "error": "Limite di richieste API di Fatture in Cloud raggiunto anche dopo i tentativi automatici. Riprovare tra qualche minuto."
+            })
         return [TextContent(type="text", text=f"Errore: {str(e)}\n{traceback.format_exc()}")]
 
 
@@ -1107,5 +4091,4 @@ async def main():
 
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
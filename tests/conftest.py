@@ -0,0 +1,278 @@
+"""Backend Fatture in Cloud finto per i test: nessuna chiamata di rete.
+
+Le API finte implementano solo i metodi usati dai tool sotto test e
+interpretano il sottoinsieme del filtro q prodotto da q_filter e
+sync_store (confronti su date, updated_at e ID, like su più campi).
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import re
+import sys
+
+os.environ.setdefault("FIC_COMPANY_ID", "1")
+os.environ.setdefault("FIC_ACCESS_TOKEN", "a/test")
+os.environ.setdefault("FIC_DB_PATH", ":memory:")
+os.environ.setdefault("FIC_RATE_LIMIT", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fattureincloud_python_sdk as sdk  # noqa: E402
+import pytest  # noqa: E402
+
+import server  # noqa: E402
+
+Q_CONDITION = re.compile(r"([\w.]+) (>=|<=|=|like) (?:'((?:[^'\\]|\\.)*)'|(\d+))")
+
+
+def field_value(record, path):
+    for key in path.split("."):
+        record = record.get(key) if isinstance(record, dict) else None
+    return "" if record is None else str(record)
+
+
+def unescape(value):
+    return re.sub(r"\\(.)", r"\1", value)
+
+
+def matches_q(record, q):
+    """Valuta un filtro q: condizioni in and, gruppi tra parentesi in or"""
+    if not q:
+        return True
+    for part in re.split(r" and (?![^(]*\))", q):
+        alternatives = []
+        for field, op, value, number in Q_CONDITION.findall(part):
+            current, value = field_value(record, field), unescape(value) or number
+            if op == "=":
+                alternatives.append(current == value)
+            elif op == "like":
+                alternatives.append(value.strip("%").lower() in current.lower())
+            elif op == ">=":
+                alternatives.append(current >= value)
+            else:
+                alternatives.append(current <= value)
+        if not any(alternatives):
+            return False
+    return True
+
+
+def call(name, **arguments):
+    """Esegue un tool come farebbe il client MCP e ne decodifica la risposta JSON"""
+    result = asyncio.run(server.call_tool(name, arguments))
+    return json.loads(result[0].text)
+
+
+class Model:
+    def __init__(self, data):
+        self.data = data
+
+    def to_dict(self):
+        return json.loads(json.dumps(self.data))
+
+
+class Response:
+    def __init__(self, data):
+        self.data = data
+
+
+class RawResponse:
+    """Risposta urllib3 dei metodi *_without_preload_content"""
+
+    def __init__(self, payload):
+        self.status = 200
+        self.reason = "OK"
+        self.headers = {}
+        self.data = json.dumps(payload).encode()
+
+    def getheaders(self):
+        return self.headers
+
+
+class FakeListApi:
+    """Elenco paginato di record con il filtro q"""
+
+    def __init__(self, records):
+        self.records = records
+        self.created = []
+        self.modified = []
+        self.queries = []
+        self.sorts = []
+
+    def page(self, type=None, q=None, page=1, per_page=50, fields=None, sort=None, **kwargs):
+        self.queries.append(q)
+        self.sorts.append(sort)
+        rows = [r for r in self.records.values()
+                if (type is None or r.get("type") == type) and matches_q(r, q)]
+        rows.sort(key=lambda r: r["id"])
+        for key in reversed(sort.split(",") if sort else []):
+            field = key.lstrip("-")
+            numeric = field == "id"
+            rows.sort(key=lambda r: r["id"] if numeric else field_value(r, field), reverse=key.startswith("-"))
+        if fields:
+            rows = [{k: v for k, v in r.items() if k in fields.split(",")} for r in rows]
+        last_page = max(1, -(-len(rows) // per_page))
+        return {"data": rows[(page - 1) * per_page:page * per_page],
+                "current_page": page, "last_page": last_page, "per_page": per_page, "total": len(rows)}
+
+
+class FakeIssuedApi(FakeListApi):
+    def list_issued_documents(self, company_id, **kwargs):
+        return sdk.ListIssuedDocumentsResponse.from_dict(self.page(**kwargs))
+
+    def list_issued_documents_without_preload_content(self, company_id, **kwargs):
+        return RawResponse(self.page(**kwargs))
+
+    def record(self, document_id, fields=None):
+        record = self.records[document_id]
+        if fields:
+            record = {k: v for k, v in record.items() if k in fields.split(",")}
+        return record
+
+    def get_issued_document(self, company_id, document_id, fields=None, **kwargs):
+        return Response(Model(self.record(document_id, fields)))
+
+    def get_issued_document_without_preload_content(self, company_id, document_id, fields=None, **kwargs):
+        return RawResponse({"data": self.record(document_id, fields)})
+
+    def modify_issued_document(self, company_id, document_id, modify_issued_document_request, **kwargs):
+        self.modified.append((document_id, modify_issued_document_request))
+        self.records[document_id].update(modify_issued_document_request["data"])
+        return Response(Model(self.records[document_id]))
+
+    def create_issued_document(self, company_id, create_issued_document_request, **kwargs):
+        document_id = max(self.records, default=0) + 1000 + len(self.created)
+        self.created.append(create_issued_document_request)
+        return Response(Model({"id": document_id, "number": len(self.created)}))
+
+
+class FakeReceivedApi(FakeListApi):
+    def list_received_documents(self, company_id, **kwargs):
+        return sdk.ListReceivedDocumentsResponse.from_dict(self.page(**kwargs))
+
+    def list_received_documents_without_preload_content(self, company_id, **kwargs):
+        return RawResponse(self.page(**kwargs))
+
+
+class FakeClientsApi(FakeListApi):
+    def __init__(self, records):
+        super().__init__(records)
+        self.gets = []
+
+    def list_clients(self, company_id, **kwargs):
+        return sdk.ListClientsResponse.from_dict(self.page(**kwargs))
+
+    def list_clients_without_preload_content(self, company_id, **kwargs):
+        return RawResponse(self.page(**kwargs))
+
+    def get_client(self, company_id, client_id, **kwargs):
+        self.gets.append(client_id)
+        return Response(Model(self.records[client_id]))
+
+    def modify_client(self, company_id, client_id, modify_client_request, **kwargs):
+        self.records[client_id].update(modify_client_request["data"])
+        return Response(Model(self.records[client_id]))
+
+    def delete_client(self, company_id, client_id, **kwargs):
+        del self.records[client_id]
+
+
+class FakeInfoApi:
+    """Impostazioni dell'azienda: metodi e conti di pagamento, tipi IVA"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.calls = []
+
+    def list(self, kind):
+        self.calls.append(kind)
+        return Response([Model(item) for item in self.settings[kind]])
+
+    def list_payment_methods(self, company_id, **kwargs):
+        return self.list("payment_methods")
+
+    def list_payment_accounts(self, company_id, **kwargs):
+        return self.list("payment_accounts")
+
+    def list_vat_types(self, company_id, **kwargs):
+        return self.list("vat_types")
+
+
+class FakeEInvoiceApi:
+    """Invio allo SDI: il documento passa a "sent", gli esiti successivi li imposta il test"""
+
+    def __init__(self, records):
+        self.records = records
+        self.sent = []
+
+    def verify_e_invoice_xml(self, company_id, document_id, **kwargs):
+        return Response(Model({"success": True}))
+
+    def send_e_invoice(self, company_id, document_id, **kwargs):
+        self.sent.append(document_id)
+        self.records[document_id]["ei_status"] = "sent"
+        return Response(Model({}))
+
+
+CLIENT_NAMES = ["Rossi Mario S.R.L.", "Rossetti Mario", "Verdi Rosa S.P.A.", "Bianchi-Neri SNC"]
+
+
+def make_client(client_id):
+    return {"id": client_id, "name": CLIENT_NAMES[client_id - 1], "vat_number": f"IT{client_id:011d}",
+            "tax_code": f"{client_id:011d}", "ei_code": "ABC1234", "updated_at": "2025-01-01 00:00:00"}
+
+
+def make_invoice(document_id, client, day):
+    amount = 100.0 + document_id
+    return {
+        "id": document_id, "type": "invoice", "number": document_id, "numeration": "",
+        "date": f"2025-03-{day:02d}", "entity": {key: client[key] for key in ("id", "name", "vat_number", "tax_code")},
+        "subject": f"Servizio {document_id}", "visible_subject": f"Canone marzo {document_id}",
+        "amount_net": amount, "amount_vat": 0.0, "amount_gross": amount,
+        "items_list": [{"name": "Consulenza", "description": "Marzo", "qty": 1, "net_price": amount,
+                        "gross_price": amount, "vat": {"id": 0, "value": 0}}],
+        "payments_list": [{"amount": amount, "due_date": "2025-04-30", "status": "not_paid",
+                           "payment_terms": {"days": 30, "type": "standard"}}],
+        "updated_at": "2025-03-31 00:00:00",
+    }
+
+
+@pytest.fixture
+def backend():
+    """Tre fatture di marzo 2025 per ciascuno dei clienti di CLIENT_NAMES"""
+    clients = {i: make_client(i) for i in range(1, len(CLIENT_NAMES) + 1)}
+    ids = itertools.count(1)
+    invoices = {}
+    for client in clients.values():
+        for day in (3, 12, 24):
+            document_id = next(ids)
+            invoices[document_id] = make_invoice(document_id, client, day)
+    settings = {
+        "payment_methods": [{"id": 7, "name": "Bonifico", "type": "standard",
+                             "default_payment_account": {"id": 3, "name": "Banca"}}],
+        "payment_accounts": [{"id": 3, "name": "Banca", "type": "bank"}],
+        "vat_types": [{"id": 0, "value": 22.0, "description": "22%"},
+                      {"id": 12, "value": 10.0, "description": "10%"},
+                      {"id": 21, "value": 0.0, "description": "Esente art. 10", "ei_type": "N4"},
+                      {"id": 40, "value": 10.0, "description": "10% vecchio", "is_disabled": True}],
+    }
+    return {"clients": clients, "issued": invoices, "received": {}, "settings": settings}
+
+
+@pytest.fixture(params=[True, False], ids=["mirror", "api"])
+def fic(request, backend, monkeypatch):
+    """Server collegato al backend finto, con mirror locale (in memoria) o letture dirette dall'API"""
+    monkeypatch.setattr(server, "LOCAL_STORE", request.param)
+    monkeypatch.setattr(server, "DB_PATH", ":memory:")
+    monkeypatch.setattr(server, "RAW_LISTINGS", True)
+    monkeypatch.setattr(server, "_store", None)
+    monkeypatch.setattr(server, "_sync_locks", {})
+    monkeypatch.setattr(server, "_companies", {})
+    company = server.get_company()
+    company.issued_api = FakeIssuedApi(backend["issued"])
+    company.received_api = FakeReceivedApi(backend["received"])
+    company.clients_api = FakeClientsApi(backend["clients"])
+    company.einvoice_api = FakeEInvoiceApi(backend["issued"])
+    company.info_api = FakeInfoApi(backend["settings"])
+    return company
+
@@ -0,0 +1,36 @@
+"""create_invoices_bulk: anagrafiche lette una volta, solo per i clienti usati"""
+
+import server
+from conftest import call
+
+
+def spec(client_id):
+    return {"client_id": client_id, "date": "2025-04-01",
+            "items": [{"name": "Consulenza", "qty": 1, "net_price": 100}]}
+
+
+def test_prefetches_only_used_clients(fic, backend):
+    result = call("create_invoices_bulk", invoices=[spec(2), spec(3), spec(2)])
+    assert result["succeeded"] == 3
+    assert [r["client"] for r in result["results"]] == ["Rossetti Mario", "Verdi Rosa S.P.A.", "Rossetti Mario"]
+    assert fic.clients_api.gets == []
+    if not server.LOCAL_STORE:
+        assert fic.clients_api.queries == ["(id = 2 or id = 3)"]
+    # I clienti letti per la chiamata non finiscono nella cache condivisa
+    assert server.client_cache.get(2) is None
+
+
+def test_unknown_client_fails_only_its_job(fic):
+    result = call("create_invoices_bulk", invoices=[spec(2), spec(99)])
+    assert [r["success"] for r in result["results"]] == [True, False]
+    assert "99" in result["results"][1]["error"]
+
+
+def test_vat_ids_from_company_vat_types(fic):
+    items = [{"name": name, "qty": 1, "net_price": 100, "vat_rate": rate}
+             for name, rate in (("Standard", 22), ("Ridotta", 10), ("Esente", 0), ("Altra", 4))]
+    result = call("create_invoices_bulk", invoices=[dict(spec(1), items=items), dict(spec(2), items=items[:1])])
+    assert result["succeeded"] == 2
+    vats = [i["vat"] for i in fic.issued_api.created[0]["data"]["items_list"]]
+    assert vats == [{"id": 0, "value": 22}, {"id": 12, "value": 10}, {"id": 21, "value": 0}, {"id": 0, "value": 4}]
+    assert fic.info_api.calls == ["vat_types"]
@@ -0,0 +1,48 @@
+"""Elenchi lunghi a blocchi di MAX_ROWS righe, letti con get_more_results"""
+
+import asyncio
+import json
+
+import server
+from conftest import call
+
+
+def read_all(name, **arguments):
+    """Prima risposta e blocchi successivi, nello stesso event loop del server"""
+    async def run():
+        chunks = [json.loads((await server.call_tool(name, arguments))[0].text)]
+        while chunks[-1]["more_cursor"]:
+            result = await server.call_tool("get_more_results", {"cursor": chunks[-1]["more_cursor"]})
+            chunks.append(json.loads(result[0].text))
+        return chunks
+    return asyncio.run(run())
+
+
+def test_chunks_cover_the_listing(fic, backend, monkeypatch):
+    monkeypatch.setattr(server, "MAX_ROWS", 5)
+    chunks = read_all("list_invoices", year=2025, month=3)
+    assert [c["returned"] for c in chunks] == [5, 5, 2]
+    assert [c["total"] for c in chunks] == [None, None, 12]
+    assert sorted(i["id"] for c in chunks for i in c["items"]) == sorted(backend["issued"])
+
+
+def test_first_chunk_stops_reading(fic, monkeypatch):
+    monkeypatch.setattr(server, "MAX_ROWS", 5)
+    converted = []
+    invoice_list_row = server.invoice_list_row
+
+    def counting_row(d):
+        converted.append(d["id"])
+        return invoice_list_row(d)
+
+    monkeypatch.setattr(server, "invoice_list_row", counting_row)
+
+    async def first_chunk():
+        return json.loads((await server.call_tool("list_invoices", {"year": 2025, "month": 3}))[0].text)
+
+    assert asyncio.run(first_chunk())["returned"] == 5
+    assert len(converted) == 6
+
+
+def test_short_listing_is_a_plain_list(fic):
+    assert [c["name"] for c in call("list_clients", query="Rossi")] == ["Rossi Mario S.R.L."]
@@ -0,0 +1,41 @@
+"""client_cache: le scritture su un cliente tolgono la copia in cache"""
+
+import asyncio
+
+import server
+
+
+def test_modify_client_evicts_cache(fic, backend):
+    async def run():
+        before = await server.get_client_by_id(2)
+        await server.run_sdk(server.clients_api.modify_client, company_id=fic.id, client_id=2,
+                             modify_client_request={"data": {"ei_code": "NEW0001"}})
+        return before, await server.get_client_by_id(2)
+
+    before, after = asyncio.run(run())
+    assert before["ei_code"] == "ABC1234"
+    assert after["ei_code"] == "NEW0001"
+    assert fic.clients_api.gets == [2, 2]
+
+
+def test_delete_client_evicts_cache_and_mirror(fic, backend):
+    async def run():
+        assert len(await server.load_clients()) == 4
+        assert await server.get_client_by_id(3) is not None
+        await server.run_sdk(server.clients_api.delete_client, company_id=fic.id, client_id=3)
+        return await server.get_client_by_id(3), await server.load_clients()
+
+    deleted, clients = asyncio.run(run())
+    assert deleted is None
+    assert 3 not in [c["id"] for c in clients]
+
+
+def test_other_writes_keep_cached_clients(fic):
+    async def run():
+        await server.get_client_by_id(2)
+        await server.run_sdk(server.issued_api.modify_issued_document, company_id=fic.id, document_id=1,
+                             modify_issued_document_request={"data": {"subject": "Nuovo"}})
+        await server.get_client_by_id(2)
+
+    asyncio.run(run())
+    assert fic.clients_api.gets == [2]
@@ -0,0 +1,170 @@
+"""Chiamate all'API: rate limit, ritentativi su 429/5xx e letture unificate (single-flight)"""
+
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+from fattureincloud_python_sdk.exceptions import ApiException
+
+import server
+
+
+def api_error(status, retry_after=None):
+    error = ApiException(status=status, reason="Errore")
+    error.headers = {"Retry-After": retry_after} if retry_after else {}
+    return error
+
+
+class Endpoint:
+    """Metodi finti dell'SDK: contano le chiamate e sollevano gli errori in coda"""
+
+    def __init__(self, errors=(), delay=0.0):
+        self.errors = list(errors)
+        self.delay = delay
+        self.calls = 0
+
+    def handle(self, value):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"value": value, "call": self.calls}
+
+    def list_things(self, value, **kwargs):
+        return self.handle(value)
+
+    def get_thing(self, value, **kwargs):
+        return self.handle(value)
+
+    def create_thing(self, value, **kwargs):
+        return self.handle(value)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Attese registrate e non eseguite, con l'orologio monotonic che avanza di conseguenza"""
+    recorded = []
+    sleep = asyncio.sleep
+    monotonic = server.time.monotonic
+    monkeypatch.setattr(server.time, "monotonic", lambda: monotonic() + sum(recorded))
+
+    async def fast_sleep(delay, *args):
+        recorded.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(asyncio, "sleep", fast_sleep)
+    return recorded
+
+
+@pytest.fixture
+def company(monkeypatch):
+    monkeypatch.setattr(server, "_companies", {})
+    return server.get_company()
+
+
+def test_retry_delay_reads_retry_after():
+    assert server.retry_delay(api_error(429, "3"), 0, Endpoint.create_thing) == 3.0
+    when = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < server.retry_delay(api_error(429, when), 0, Endpoint.create_thing) <= 30
+    assert 4 <= server.retry_delay(api_error(429), 2, Endpoint.create_thing) <= 4.5
+
+
+def test_retry_delay_retries_5xx_only_for_reads(monkeypatch):
+    assert 1 <= server.retry_delay(api_error(503), 0, Endpoint.list_things) <= 1.5
+    assert server.retry_delay(api_error(503), 0, Endpoint.create_thing) is None
+    assert server.retry_delay(api_error(404), 0, Endpoint.list_things) is None
+    monkeypatch.setattr(server, "MAX_RETRIES", 2)
+    assert server.retry_delay(api_error(429, "1"), 2, Endpoint.list_things) is None
+
+
+def test_429_waits_retry_after_and_blocks_the_company(company, sleeps):
+    endpoint = Endpoint([api_error(429, "3")])
+    result = asyncio.run(server.call_sdk(endpoint.create_thing, 1))
+    assert (result["call"], endpoint.calls) == (2, 2)
+    assert sleeps == [3.0]
+    assert company.rate_limiter.blocked_until > 0
+
+
+def test_write_5xx_is_not_retried(company, sleeps):
+    endpoint = Endpoint([api_error(503)])
+    with pytest.raises(ApiException):
+        asyncio.run(server.call_sdk(endpoint.create_thing, 1))
+    assert endpoint.calls == 1 and sleeps == []
+
+
+def test_retries_stop_at_max_retries(company, sleeps, monkeypatch):
+    monkeypatch.setattr(server, "MAX_RETRIES", 2)
+    endpoint = Endpoint([api_error(429, "1")] * 5)
+    with pytest.raises(ApiException):
+        asyncio.run(server.call_sdk(endpoint.list_things, 1))
+    assert endpoint.calls == 3 and sleeps == [1.0, 1.0]
+
+
+def test_token_bucket_allows_burst_then_paces(sleeps):
+    async def run():
+        bucket = server.TokenBucket(rate=2, capacity=3)
+        for _ in range(4):
+            await bucket.acquire()
+        burst = len(sleeps)
+        bucket.block(10)
+        await bucket.acquire()
+        return burst
+
+    assert asyncio.run(run()) == 1
+    assert 0.4 < sleeps[0] <= 0.5
+    assert 9.9 < sleeps[1] <= 10
+
+
+def test_concurrent_identical_reads_share_one_call(company):
+    endpoint = Endpoint(delay=0.05)
+
+    async def run():
+        first = await asyncio.gather(*(server.run_sdk(endpoint.get_thing, 1) for _ in range(5)))
+        other = await server.run_sdk(endpoint.get_thing, 2)
+        cached = await server.run_sdk(endpoint.get_thing, 1)
+        return first, other, cached
+
+    first, other, cached = asyncio.run(run())
+    assert endpoint.calls == 2
+    assert all(result is first[0] for result in first + [cached])
+    assert other["value"] == 2
+
+
+def test_write_and_fresh_bypass_shared_reads(company):
+    endpoint = Endpoint()
+
+    async def run():
+        before = await server.run_sdk(endpoint.get_thing, 1)
+        await server.run_sdk(endpoint.create_thing, 1)
+        after = await server.run_sdk(endpoint.get_thing, 1)
+        fresh = await server.run_sdk(endpoint.get_thing, 1, fresh=True)
+        return before, after, fresh
+
+    before, after, fresh = asyncio.run(run())
+    assert [before["call"], after["call"], fresh["call"]] == [1, 3, 4]
+
+
+def test_write_during_read_is_not_served_stale(company):
+    endpoint = Endpoint(delay=0.1)
+    started = threading.Event()
+    get_thing = endpoint.get_thing
+
+    def slow_read(value, **kwargs):
+        started.set()
+        return get_thing(value)
+
+    slow_read.__name__ = "get_thing"
+
+    async def run():
+        pending = asyncio.ensure_future(server.run_sdk(slow_read, 1))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        await server.run_sdk(endpoint.create_thing, 1)
+        stale = await pending
+        after = await server.run_sdk(slow_read, 1)
+        return stale, after
+
+    stale, after = asyncio.run(run())
+    assert after is not stale and after["call"] > stale["call"]
@@ -0,0 +1,41 @@
+"""Elenchi letti con i modelli SDK (FIC_RAW_LISTINGS=0) o come JSON grezzo: stessi totali"""
+
+import pytest
+
+import server
+from conftest import call
+
+
+@pytest.mark.parametrize("raw", [True, False], ids=["raw", "sdk"])
+def test_list_invoices_totals(fic, backend, monkeypatch, raw):
+    monkeypatch.setattr(server, "RAW_LISTINGS", raw)
+    invoices = call("list_invoices", year=2025, month=3)
+    assert {i["id"]: i["total"] for i in invoices} == {
+        d["id"]: d["amount_gross"] for d in backend["issued"].values()}
+
+
+@pytest.mark.parametrize("raw", [True, False], ids=["raw", "sdk"])
+def test_list_invoices_paged_totals(fic, backend, monkeypatch, raw):
+    monkeypatch.setattr(server, "RAW_LISTINGS", raw)
+    page = call("list_invoices", year=2025, month=3, limit=5)
+    assert all(i["total"] == backend["issued"][i["id"]]["amount_gross"] for i in page["items"])
+
+
+def test_to_plain_keeps_read_only_amounts(backend):
+    document = backend["issued"][1]
+    model = server.fic.IssuedDocument.from_dict(document)
+    plain = server.to_plain(model)
+    assert (plain["amount_net"], plain["amount_vat"], plain["amount_gross"]) == (
+        document["amount_net"], document["amount_vat"], document["amount_gross"])
+
+
+def test_listings_share_mirror_order(fic, backend):
+    """Con e senza mirror gli elenchi escono nello stesso ordine: documenti per data e ID, clienti per nome"""
+    invoices = call("list_invoices", year=2025, month=3)
+    assert [i["id"] for i in invoices] == sorted(
+        backend["issued"], key=lambda document_id: (backend["issued"][document_id]["date"], document_id))
+    clients = call("list_clients")
+    assert [c["name"] for c in clients] == sorted(c["name"] for c in backend["clients"].values())
+    if not server.LOCAL_STORE:
+        assert set(fic.issued_api.sorts) == {server.DOCUMENT_SORT}
+        assert set(fic.clients_api.sorts) == {server.CLIENT_SORT}
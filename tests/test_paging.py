@@ -0,0 +1,66 @@
+"""Elenchi con limit e cursor: pagine oltre le 100 righe per pagina dell'API"""
+
+import asyncio
+import json
+
+import server
+from conftest import call, make_invoice
+
+
+def read_pages(name, **arguments):
+    """Tutte le pagine di un elenco, seguendo next_cursor"""
+    pages = []
+    while True:
+        pages.append(call(name, **arguments))
+        if not pages[-1]["next_cursor"]:
+            return pages
+        arguments = {"cursor": pages[-1]["next_cursor"]}
+
+
+def test_limit_above_api_page_size(fic, backend, monkeypatch):
+    monkeypatch.setattr(server, "PER_PAGE", 5)
+    for document_id in range(13, 26):
+        backend["issued"][document_id] = make_invoice(document_id, backend["clients"][2], 28)
+    pages = read_pages("list_invoices", year=2025, month=3, limit=7)
+    assert [p["returned"] for p in pages] == [7, 7, 7, 4]
+    ids = [i["id"] for p in pages for i in p["items"]]
+    assert sorted(ids) == sorted(backend["issued"])
+
+
+def test_exact_multiple_has_no_empty_page(fic, monkeypatch):
+    monkeypatch.setattr(server, "PER_PAGE", 5)
+    pages = read_pages("list_invoices", year=2025, month=3, limit=6)
+    assert [p["returned"] for p in pages] == [6, 6]
+
+
+def test_cursors_of_both_mechanisms(fic, backend, monkeypatch):
+    """Elenco più lungo sia della pagina dell'API sia del blocco di get_more_results"""
+    monkeypatch.setattr(server, "PER_PAGE", 3)
+    monkeypatch.setattr(server, "MAX_ROWS", 4)
+
+    async def run():
+        async def acall(name, **arguments):
+            return json.loads((await server.call_tool(name, arguments))[0].text)
+
+        paged, page = [], await acall("list_invoices", year=2025, month=3, limit=4)
+        paged += page["items"]
+        assert "more_cursor" not in page
+        wrong = await acall("get_more_results", cursor=page["next_cursor"])
+        assert not wrong["success"] and "cursor" in wrong["error"]
+        while page["next_cursor"]:
+            page = await acall("list_invoices", cursor=page["next_cursor"])
+            paged += page["items"]
+
+        chunked, chunk = [], await acall("list_invoices", year=2025, month=3)
+        chunked += chunk["items"]
+        assert "next_cursor" not in chunk
+        wrong = await acall("list_invoices", cursor=chunk["more_cursor"])
+        assert not wrong["success"] and "get_more_results" in wrong["error"]
+        while chunk["more_cursor"]:
+            chunk = await acall("get_more_results", cursor=chunk["more_cursor"])
+            chunked += chunk["items"]
+        return paged, chunked
+
+    paged, chunked = asyncio.run(run())
+    assert [i["id"] for i in paged] == [i["id"] for i in chunked]
+    assert sorted(i["id"] for i in paged) == sorted(backend["issued"])
@@ -0,0 +1,19 @@
+"""get_portfolio_report: stessi totali di get_situation"""
+
+import server
+from conftest import call
+from server import PORTFOLIO_TOTALS
+
+
+def test_portfolio_matches_situation(fic, backend):
+    backend["issued"][1]["payments_list"][0].update(status="paid", paid_date="2025-04-30")
+    backend["issued"][2]["ei_status"] = "rejected"
+    backend["received"][500] = {"id": 500, "type": "expense", "date": "2025-05-02", "amount_net": 40.0,
+                                "amount_gross": 48.8, "entity": {"id": 9, "name": "Fornitore"},
+                                "updated_at": "2025-05-02 00:00:00"}
+    situation = call("get_situation", year=2025)
+    report = call("get_portfolio_report", year=2025, company_ids=[fic.id])
+    company = report["per_azienda"][0]
+    assert {k: company[k] for k in PORTFOLIO_TOTALS} == {k: situation[k] for k in PORTFOLIO_TOTALS}
+    assert company["incassato"] == 101.0 and company["costi_totali"] == 48.8
+    assert [r["id"] for r in company["fatture_rifiutate"]] == [2]
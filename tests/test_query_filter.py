@@ -0,0 +1,71 @@
+"""Filtro query degli elenchi e della duplicazione in blocco: stesso risultato con e senza mirror"""
+
+from conftest import call
+
+
+def clients_of(invoices):
+    return sorted({invoice["client"] for invoice in invoices})
+
+
+def test_list_invoices_query_is_substring(fic):
+    invoices = call("list_invoices", year=2025, month=3, query="Rossi")
+    assert clients_of(invoices) == ["Rossi Mario S.R.L."]
+    assert len(invoices) == 3
+
+
+def test_list_invoices_query_does_not_match_fuzzily(fic):
+    # "Rosi" è un errore di battitura: la ricerca per somiglianza è solo nel tool search
+    assert call("list_invoices", year=2025, month=3, query="Rosi") == []
+
+
+def test_list_invoices_query_with_punctuation(fic):
+    invoices = call("list_invoices", year=2025, month=3, query="Bianchi-Neri")
+    assert clients_of(invoices) == ["Bianchi-Neri SNC"]
+
+
+def test_list_invoices_rejects_query_without_letters_or_digits(fic):
+    result = call("list_invoices", year=2025, month=3, query="-")
+    assert result["success"] is False
+    assert "lettera o una cifra" in result["error"]
+
+
+def test_list_invoices_paged_query_matches_full_listing(fic):
+    page = call("list_invoices", year=2025, month=3, query="mario", limit=2)
+    invoices = page["items"]
+    while page["next_cursor"]:
+        page = call("list_invoices", cursor=page["next_cursor"])
+        invoices += page["items"]
+    assert invoices == call("list_invoices", year=2025, month=3, query="mario")
+    assert clients_of(invoices) == ["Rossetti Mario", "Rossi Mario S.R.L."]
+
+
+def test_list_clients_query_on_vat_number(fic):
+    clients = call("list_clients", query="00000000003")
+    assert [c["name"] for c in clients] == ["Verdi Rosa S.P.A."]
+
+
+def test_duplicate_selects_only_matching_invoices(fic):
+    result = call("create_invoices_bulk", duplicate={"year": 2025, "month": 3, "query": "Rossi", "new_date": "2025-04-01"})
+    assert result["succeeded"] == 3
+    assert sorted(r["source_invoice"] for r in result["results"]) == [1, 2, 3]
+    assert len(fic.issued_api.created) == 3
+
+
+def test_duplicate_rejects_query_without_letters_or_digits(fic):
+    result = call("create_invoices_bulk", duplicate={"year": 2025, "month": 3, "query": "-", "new_date": "2025-04-01"})
+    assert result["success"] is False
+    assert fic.issued_api.created == []
+
+
+def test_duplicate_without_query_copies_whole_month(fic):
+    result = call("create_invoices_bulk", duplicate={"year": 2025, "month": 3, "new_date": "2025-04-01"})
+    assert result["succeeded"] == 12
+
+
+def test_search_tool_stays_fuzzy(fic):
+    hits = call("search", query="rosi srl", scopes=["clients"], year=2025)
+    assert hits["results"][0]["name"] == "Rossi Mario S.R.L."
+
+
+def test_search_tool_rejects_query_without_letters_or_digits(fic):
+    assert call("search", query="--")["success"] is False
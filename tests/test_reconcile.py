@@ -0,0 +1,77 @@
+"""reconcile_payments: fatture indicate per numero, senza anno"""
+
+import pytest
+
+import server
+from conftest import call, make_invoice
+
+
+@pytest.fixture
+def paid(monkeypatch):
+    """Registra i pagamenti invece di modificare le fatture"""
+    payments = []
+
+    async def add_payment_to_invoice(document_id, amount, payment_date, payment_method_id):
+        payments.append((document_id, payment_date))
+        return {"success": True}
+
+    monkeypatch.setattr(server, "add_payment_to_invoice", add_payment_to_invoice)
+    return payments
+
+
+def add_invoice(backend, document_id, number, date):
+    client = backend["clients"][1]
+    invoice = make_invoice(document_id, client, 1)
+    backend["issued"][document_id] = dict(invoice, number=number, date=date)
+
+
+def reconcile(*entries):
+    payments = [{"amount": 10.0, "payment_method_id": 7, **entry} for entry in entries]
+    return call("reconcile_payments", payments=payments)
+
+
+def test_january_payment_finds_previous_year_invoice(fic, paid):
+    result = reconcile({"number": 5, "payment_date": "2026-01-20"})
+    assert result["succeeded"] == 1
+    assert paid == [(5, "2026-01-20")]
+
+
+def test_payment_year_invoice_comes_first(fic, backend, paid):
+    add_invoice(backend, 100, 5, "2026-01-10")
+    reconcile({"number": 5, "payment_date": "2026-01-20"})
+    assert paid == [(100, "2026-01-20")]
+
+
+def test_invoice_dated_after_payment_is_skipped(fic, backend, paid):
+    add_invoice(backend, 100, 5, "2026-02-10")
+    reconcile({"number": 5, "payment_date": "2026-01-20"})
+    assert paid == [(5, "2026-01-20")]
+
+
+def test_explicit_year_has_no_fallback(fic, paid):
+    result = reconcile({"number": 5, "year": 2026, "payment_date": "2026-01-20"})
+    assert result["failed"] == 1
+    assert "non trovata" in result["results"][0]["error"]
+    assert paid == []
+
+
+def test_payments_use_cached_settings(fic):
+    """Metodo e conto di pagamento letti una volta per tutto il lotto"""
+    result = reconcile({"document_id": 1, "payment_date": "2025-04-10", "amount": 101.0},
+                       {"document_id": 2, "payment_date": "2025-04-11", "amount": 102.0})
+    assert result["succeeded"] == 2
+    assert sorted(fic.info_api.calls) == ["payment_accounts", "payment_methods"]
+    for _, request in fic.issued_api.modified:
+        payment = request["data"]["payments_list"][0]
+        assert payment["payment_account"] == {"id": 3, "name": "Banca"}
+        assert payment["status"] == "IssuedDocumentStatus.paid"
+
+
+def test_malformed_date_fails_only_its_entry(fic, paid):
+    result = reconcile({"number": 5, "payment_date": "20-01-2026"},
+                       {"number": 6, "payment_date": "2025-04-10"},
+                       {"number": 7, "year": "duemila", "payment_date": "2025-04-10"})
+    assert [r["success"] for r in result["results"]] == [False, True, False]
+    assert "AAAA-MM-GG" in result["results"][0]["error"]
+    assert "Anno" in result["results"][2]["error"]
+    assert paid == [(6, "2025-04-10")]
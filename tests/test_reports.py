@@ -0,0 +1,118 @@
+"""Report, previsione di cassa, liquidazione IVA e numerazione: stessi risultati con e senza mirror"""
+
+import pytest
+
+from conftest import call, make_client
+
+
+def document(document_id, doc_type, number, day, net, rate, payments=(), numeration="", entity=None, **extra):
+    vat = round(net * rate / 100, 2)
+    return {
+        "id": document_id, "type": doc_type, "number": number, "numeration": numeration, "date": day,
+        "entity": entity or {"id": 1, "name": "Rossi Mario S.R.L."},
+        "amount_net": net, "amount_vat": vat, "amount_gross": net + vat,
+        "items_list": [{"name": "Consulenza", "qty": 1, "net_price": net, "vat": {"id": 0, "value": rate}}],
+        "payments_list": [{"amount": net + vat, "due_date": due, "status": "paid" if paid else "not_paid",
+                           **({"paid_date": paid} if paid else {})} for due, paid in payments],
+        "updated_at": "2025-06-01 00:00:00", **extra,
+    }
+
+
+@pytest.fixture
+def books(backend):
+    """Primo trimestre 2025 (più marzo 2024) con incassi, split payment, numeri mancanti e duplicati"""
+    supplier = {"id": 9, "name": "Fornitore Energia"}
+    backend["clients"] = {1: make_client(1)}
+    backend["issued"].clear()
+    backend["issued"].update({d["id"]: d for d in [
+        document(1, "invoice", 1, "2025-01-10", 100, 22, [("2025-02-09", "2025-02-15")]),
+        document(2, "invoice", 2, "2025-02-05", 200, 22, [("2025-05-01", None)]),
+        document(3, "invoice", 4, "2025-03-01", 50, 10, [("2025-06-20", None)]),
+        document(4, "invoice", 5, "2025-03-10", 100, 10, [("2025-03-31", "2025-03-31")], use_split_payment=True),
+        document(5, "invoice", 5, "2025-03-12", 30, 0, [("2025-07-10", None)]),
+        document(6, "invoice", 8, "2025-03-05", 10, 22, [("2025-03-05", "2025-03-05")]),
+        document(7, "invoice", 1, "2025-03-20", 40, 22, [("2025-03-20", "2025-03-20")], numeration="/A"),
+        document(8, "credit_note", 1, "2025-03-25", 20, 22),
+        document(9, "invoice", 3, "2024-03-15", 80, 22, [("2024-03-30", "2024-03-30")]),
+    ]})
+    backend["received"].update({d["id"]: d for d in [
+        document(101, "expense", None, "2025-02-10", 100, 22, [("2025-03-01", None)], entity=supplier),
+        document(102, "expense", None, "2025-03-15", 300, 22, [("2025-03-20", "2025-03-20")], entity=supplier),
+    ]})
+    return backend
+
+
+def test_report_quarter_with_previous_year(fic, books):
+    current, previous = call("get_report", year=2025, quarter=1, compare_years=1)["periodi"]
+    assert (current["dal"], current["al"], previous["dal"], previous["al"]) == ("2025-01", "2025-03", "2024-01", "2024-03")
+    assert current["fatturato_netto"] == 510
+    assert current["incassato"] == pytest.approx(122 + 110 + 12.2 + 48.8)
+    assert (current["costi_netti"], current["pagato"], current["margine"]) == (400, 366, 110)
+    assert current["iva_split_payment"] == 10
+    assert current["iva_vendite"] == {
+        "0": {"imponibile": 30, "iva": 0}, "10": {"imponibile": 150, "iva": 15}, "22": {"imponibile": 330, "iva": 72.6}}
+    assert current["iva_acquisti"] == {"22": {"imponibile": 400, "iva": 88, "detraibile": 88}}
+    assert previous["fatturato_netto"] == 80
+    assert current["variazione_su_anno_precedente"]["fatturato_netto"] == 537.5
+
+
+def test_report_group_by_month(fic, books):
+    period = call("get_report", year=2025, quarter=1, group_by="month")["periodi"][0]
+    assert [(m["periodo"], m["fatturato_netto"]) for m in period["dettaglio"]] == [
+        ("2025-01", 100), ("2025-02", 200), ("2025-03", 210)]
+
+
+def test_report_rejects_reversed_range(fic, books):
+    result = call("get_report", date_from="2025-03", date_to="2025-01")
+    assert not result["success"] and "2025-03" in result["error"]
+
+
+def test_cash_forecast_aging_and_weeks(fic, books):
+    result = call("get_cash_forecast", as_of="2025-06-15", weeks=2, opening_balance=1000)
+    credits, debts = result["crediti"], result["debiti"]
+    assert (credits["totale"], credits["scaduto"], credits["a_scadere"], credits["rate_aperte"]) == (329, 244, 85, 3)
+    assert {b["fascia"]: b["importo"] for b in credits["fasce"] if b["rate"]} == {"a scadere": 85, "31-60 giorni": 244}
+    assert credits["principali_scaduti"] == [
+        {"controparte": "Rossi Mario S.R.L.", "importo": 244, "rate": 1, "giorni_ritardo_max": 45}]
+    assert {b["fascia"]: b["importo"] for b in debts["fasce"] if b["rate"]} == {"91-180 giorni": 122}
+    assert [(w["dal"], w["entrate"], w["saldo_cumulato"]) for w in result["previsione_settimanale"]] == [
+        ("2025-06-15", 55, 1055), ("2025-06-22", 0, 1055)]
+    assert result["oltre_orizzonte"] == {"entrate": 30, "uscite": 0}
+    assert result["saldo_finale_previsto"] == 1055
+
+
+def test_vat_liquidation_carries_debt_and_credit(fic, books):
+    months = call("get_vat_liquidation", year=2025)["periodi"][:3]
+    assert [m["periodo"] for m in months] == ["2025-01", "2025-02", "2025-03"]
+    # Gennaio sotto il versamento minimo: il debito passa a febbraio
+    assert (months[0]["da_versare"], months[0]["debito_da_riportare"]) == (0, 22)
+    assert (months[1]["debito_precedente"], months[1]["da_versare"]) == (22, 44)
+    assert months[2]["iva_a_debito"] == pytest.approx(11.6)
+    assert months[2]["iva_split_payment"] == 10
+    assert months[2]["credito_da_riportare"] == pytest.approx(54.4)
+
+    quarter = call("get_vat_liquidation", year=2025, periodicity="quarter", period=1)["periodi"]
+    assert [q["periodo"] for q in quarter] == ["2025-Q1"]
+    assert (quarter[0]["iva_a_debito"], quarter[0]["iva_detraibile"]) == (77.6, 88)
+    assert (quarter[0]["da_versare"], quarter[0]["credito_da_riportare"]) == (0, pytest.approx(10.4))
+
+
+def test_vat_liquidation_rejects_period_out_of_range(fic, books):
+    result = call("get_vat_liquidation", year=2025, periodicity="quarter", period=5)
+    assert not result["success"]
+
+
+def test_check_numeration_per_series(fic, books):
+    result = call("check_numeration", year=2025)
+    assert (result["total_documents"], result["continuous"]) == (7, False)
+    main, series_a = result["numerations"]
+    assert (main["numeration"], main["first_number"], main["last_number"]) == ("", 1, 8)
+    assert [g["missing"] for g in main["gaps"]] == ["3", "6-7"]
+    assert main["missing_count"] == 3
+    assert [(d["number"], sorted(d["ids"])) for d in main["duplicates"]] == [(5, [4, 5])]
+    assert [i["number"] for i in main["date_inversions"]] == [8]
+    assert (series_a["numeration"], series_a["continuous"], series_a["total"]) == ("/A", True, 1)
+
+    only_a = call("check_numeration", year=2025, numeration="/A")
+    assert [s["numeration"] for s in only_a["numerations"]] == ["/A"]
+    assert only_a["continuous"] is True
@@ -0,0 +1,45 @@
+"""send_to_sdi_bulk: monitoraggio di ei_status fino all'esito SDI"""
+
+import asyncio
+
+import pytest
+
+import server
+from conftest import call
+
+
+@pytest.fixture
+def outcomes(fic, backend, monkeypatch):
+    """Esiti SDI per giro di controllo: all'n-esima attesa i documenti passano agli stati indicati.
+
+    Le attese non durano davvero: fanno solo avanzare l'orologio monotonic.
+    """
+    steps = []
+    sleeps = []
+    sleep = asyncio.sleep
+    monotonic = server.time.monotonic
+    monkeypatch.setattr(server.time, "monotonic", lambda: monotonic() + sum(sleeps))
+
+    async def fast_sleep(delay, *args):
+        sleeps.append(delay)
+        if len(sleeps) <= len(steps):
+            for document_id, status in steps[len(sleeps) - 1].items():
+                backend["issued"][document_id]["ei_status"] = status
+        await sleep(0)
+
+    monkeypatch.setattr(asyncio, "sleep", fast_sleep)
+    return steps
+
+
+def test_sent_keeps_polling_until_accepted(fic, outcomes):
+    outcomes += [{}, {1: "processing"}, {1: "accepted", 2: "delivered"}]
+    result = call("send_to_sdi_bulk", document_ids=[1, 2], max_wait_seconds=60)
+    assert result["sent"] == 2
+    assert result["still_processing"] == 0
+    assert result["by_status"] == {"accepted": 1, "delivered": 1}
+
+
+def test_still_sent_at_deadline_is_processing(fic, outcomes):
+    result = call("send_to_sdi_bulk", document_ids=[1], max_wait_seconds=25)
+    assert result["still_processing"] == 1
+    assert result["results"][0]["ei_status"] == "sent"
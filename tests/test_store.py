@@ -0,0 +1,82 @@
+"""Mirror locale: lavoro SQLite fuori dall'event loop, allineamenti incrementali"""
+
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+import server
+from conftest import call
+
+
+@pytest.mark.parametrize("fic", [True], indirect=True, ids=["mirror"])
+def test_store_runs_in_its_own_thread(fic, monkeypatch):
+    threads = set()
+    save = server.LocalStore.save
+
+    def recording_save(self, *args, **kwargs):
+        threads.add(threading.current_thread().name)
+        return save(self, *args, **kwargs)
+
+    monkeypatch.setattr(server.LocalStore, "save", recording_save)
+    call("list_invoices", year=2025, month=3)
+    assert threads and all(name.startswith("fic-store") for name in threads)
+
+
+@pytest.mark.parametrize("fic", [True], indirect=True, ids=["mirror"])
+def test_empty_resource_syncs_incrementally(fic, monkeypatch):
+    monkeypatch.setattr(server, "SYNC_INTERVAL", 0)
+    assert call("list_received_documents", year=2025) == []
+    assert call("list_received_documents", year=2025) == []
+    syncs = [q for q in fic.received_api.queries if q is None or "updated_at" in q]
+    assert len(syncs) == 2
+    assert syncs[0] is None
+    assert syncs[1].startswith("updated_at >= ")
+
+
+def count_invoices():
+    store = server.get_store()
+    return asyncio.run(server.run_store(
+        lambda: store.conn.execute("SELECT COUNT(*) FROM issued_documents").fetchone()[0]))
+
+
+@pytest.mark.parametrize("fic", [True], indirect=True, ids=["mirror"])
+def test_sync_saves_in_batches(fic, backend, monkeypatch):
+    monkeypatch.setattr(server, "STORE_BATCH", 5)
+    batches = []
+    save = server.LocalStore.save
+
+    def recording_save(self, company_id, resource, rows, full=False):
+        batches.append((len(rows), full))
+        return save(self, company_id, resource, rows, full)
+
+    monkeypatch.setattr(server.LocalStore, "save", recording_save)
+    assert len(call("list_invoices", year=2025)) == 12
+    assert batches == [(5, True), (5, False), (2, False)]
+    assert fic.issued_api.sorts[0] == "updated_at"
+
+
+@pytest.mark.parametrize("fic", [True], indirect=True, ids=["mirror"])
+def test_interrupted_sync_resumes(fic, backend, monkeypatch):
+    monkeypatch.setattr(server, "STORE_BATCH", 5)
+    for document_id, d in backend["issued"].items():
+        d["updated_at"] = f"2025-03-31 00:00:{document_id:02d}"
+    save = server.LocalStore.save
+    saved = []
+
+    def failing_save(self, *args, **kwargs):
+        if saved:
+            raise sqlite3.OperationalError("disk I/O error")
+        saved.append(args)
+        return save(self, *args, **kwargs)
+
+    monkeypatch.setattr(server.LocalStore, "save", failing_save)
+    result = asyncio.run(server.call_tool("list_invoices", {"year": 2025}))
+    assert result[0].text.startswith("Errore: disk I/O error")
+    assert count_invoices() == 5
+
+    monkeypatch.setattr(server.LocalStore, "save", save)
+    assert len(call("list_invoices", year=2025)) == 12
+    # Riprende dal blocco salvato, poi verifica gli ID: il completo non era finito
+    assert fic.issued_api.queries[-2:] == ["updated_at >= '2025-03-31 00:00:05'", None]